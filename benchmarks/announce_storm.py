@@ -0,0 +1,83 @@
+"""
+Simulates the announce storm after a restart: every peer announces within the first few
+seconds, then comes back whenever the interval it was handed says so. Prints the peak and mean
+announces per second for each hour, with the intervals handed out the old way (announce
+interval plus the number of seeders, up to 600) and with the AnnounceSmoother.
+"""
+
+from argparse import ArgumentParser
+import random
+
+from margay.config import Config
+from margay.smoothing import AnnounceSmoother
+
+
+def simulate(interval, peers, storm, duration):
+    """
+    :param interval: gives the interval of the peer (index) that announces at now
+    :return: announces for every second
+    """
+    counts = [0] * duration
+    due = [[] for _ in range(duration)]
+    generator = random.Random(peers)
+    for peer in range(peers):
+        due[generator.randrange(storm)].append(peer)
+    for now in range(duration):
+        arrivals = due[now]
+        counts[now] = len(arrivals)
+        for peer in arrivals:
+            later = now + interval(peer, now)
+            if later < duration:
+                due[later].append(peer)
+        due[now] = None
+    return counts
+
+
+def summarize(name, counts, base):
+    print(name)
+    for start in range(0, len(counts), 3600):
+        hour = counts[start:start + 3600]
+        mean = sum(hour) / len(hour)
+        ordered = sorted(hour)
+        p99 = ordered[len(hour) * 99 // 100]
+        print(f'  hour {start // 3600 + 1}: mean {mean:7.1f}/s, p99 {p99:6}/s, '
+              f'peak {ordered[-1]:6}/s, peak/mean {ordered[-1] / max(mean, 0.001):6.2f}')
+    settled = counts[2 * (base + 600):]
+    if len(settled) > 0:
+        mean = sum(settled) / len(settled)
+        print(f'  after two rounds: peak/mean {max(settled) / max(mean, 0.001):.2f}')
+
+
+def main():
+    parser = ArgumentParser(description='Simulate the announces after a restart')
+    parser.add_argument('-p', '--peers', type=int, default=200000)
+    parser.add_argument('-t', '--torrents', type=int, default=20000)
+    parser.add_argument('-s', '--storm', type=int, default=30,
+                        help='seconds over which every peer announces after the restart')
+    parser.add_argument('-d', '--hours', type=int, default=6)
+    args = parser.parse_args()
+
+    config = Config()
+    base = config['tracker']['announce_interval']
+    duration = args.hours * 3600
+
+    # peers are spread over the torrents with a long tail, like real swarms
+    generator = random.Random(args.torrents)
+    torrent_of = [min(int(generator.paretovariate(1.2)) - 1, args.torrents - 1)
+                  for _ in range(args.peers)]
+    swarm = [0] * args.torrents
+    for torrent in torrent_of:
+        swarm[torrent] += 1
+
+    summarize('seeders spread', simulate(lambda peer, now: base + min(600, swarm[torrent_of[peer]]),
+                                         args.peers, args.storm, duration), base)
+
+    smoother = AnnounceSmoother(config)
+    keys = [f'{peer:020}' for peer in range(args.peers)]
+    summarize('smoothed', simulate(lambda peer, now: smoother.interval(keys[peer], base, now),
+                                   args.peers, args.storm, duration), base)
+    print(smoother.report(), end='')
+
+
+if __name__ == '__main__':
+    main()
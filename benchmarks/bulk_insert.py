@@ -0,0 +1,121 @@
+"""
+Rows per second of the user and torrent flushes written with executemany, as they used to be,
+against the BulkWriter's multi-row INSERTs and its staging table merge.
+
+Needs a scratch database with the tables from margay.sql, its users_main and torrents are
+filled with the rows the flushes update:
+
+    mysql -e 'CREATE DATABASE margay_bench' && mysql margay_bench < margay.sql
+    python benchmarks/bulk_insert.py --db margay_bench --user root
+"""
+
+from argparse import ArgumentParser
+import random
+import time
+# noinspection PyPackageRequirements
+import MySQLdb
+
+from margay.bulk import BulkWriter, merge_torrents, merge_users
+
+USERS_EXECUTEMANY = ('INSERT INTO users_main (ID, Uploaded, Downloaded) VALUES (%s, %s, %s) '
+                     'ON DUPLICATE KEY UPDATE Uploaded = Uploaded + Values(Uploaded), '
+                     'Downloaded = Downloaded + Values(Downloaded)')
+USERS_TAIL = (' ON DUPLICATE KEY UPDATE Uploaded = Uploaded + Values(Uploaded), '
+              'Downloaded = Downloaded + Values(Downloaded)')
+TORRENTS_EXECUTEMANY = ('INSERT INTO torrents (ID, Seeders, Leechers, Snatched, Balance) '
+                        'VALUES (%s, %s, %s, %s, %s) '
+                        'ON DUPLICATE KEY UPDATE Seeders=VALUES(Seeders), '
+                        'Leechers=VALUES(Leechers), Snatched = Snatched + VALUES(Snatched), '
+                        'Balance=VALUES(Balance), '
+                        'last_action=IF(VALUES(Seeders) > 0, NOW(), last_action)')
+TORRENTS_TAIL = (' ON DUPLICATE KEY UPDATE Seeders=VALUES(Seeders), Leechers=VALUES(Leechers), '
+                 'Snatched = Snatched + VALUES(Snatched), Balance=VALUES(Balance), '
+                 'last_action=IF(VALUES(Seeders) > 0, NOW(), last_action)')
+
+
+def seed(conn, count):
+    writer = BulkWriter(conn)
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM users_main')
+    cursor.execute('DELETE FROM torrents')
+    cursor.close()
+    writer.insert('INSERT INTO users_main (ID, torrent_pass) VALUES ',
+                  ((uid, f'{uid:032x}') for uid in range(1, count + 1)))
+    writer.insert('INSERT INTO torrents (ID, info_hash) VALUES ',
+                  ((tid, tid.to_bytes(20, 'big')) for tid in range(1, count + 1)))
+    conn.commit()
+
+
+def executemany(conn, users, torrents):
+    cursor = conn.cursor()
+    cursor.executemany(USERS_EXECUTEMANY, users)
+    cursor.executemany(TORRENTS_EXECUTEMANY, torrents)
+    cursor.close()
+    conn.commit()
+
+
+def bulk(conn, users, torrents):
+    writer = BulkWriter(conn)
+    writer.insert('INSERT INTO users_main (ID, Uploaded, Downloaded) VALUES ', users, USERS_TAIL)
+    writer.insert('INSERT INTO torrents (ID, Seeders, Leechers, Snatched, Balance) VALUES ',
+                  torrents, TORRENTS_TAIL)
+    conn.commit()
+
+
+def staging(conn, users, torrents):
+    writer = BulkWriter(conn)
+    writer.merge('ID int(10) unsigned NOT NULL PRIMARY KEY, Uploaded bigint(20) NOT NULL, '
+                 'Downloaded bigint(20) NOT NULL',
+                 'users_main_delta', 'ID, Uploaded, Downloaded', merge_users(users),
+                 'UPDATE users_main AS u JOIN users_main_delta AS d ON d.ID = u.ID '
+                 'SET u.Uploaded = u.Uploaded + d.Uploaded, '
+                 'u.Downloaded = u.Downloaded + d.Downloaded')
+    writer.merge('ID int(10) NOT NULL PRIMARY KEY, Seeders int(6) NOT NULL, '
+                 'Leechers int(6) NOT NULL, Snatched int(10) unsigned NOT NULL, '
+                 'Balance bigint(20) NOT NULL, Active tinyint(1) NOT NULL',
+                 'torrents_delta', 'ID, Seeders, Leechers, Snatched, Balance, Active',
+                 merge_torrents(torrents),
+                 'UPDATE torrents AS t JOIN torrents_delta AS d ON d.ID = t.ID '
+                 'SET t.Seeders = d.Seeders, t.Leechers = d.Leechers, '
+                 't.Snatched = t.Snatched + d.Snatched, t.Balance = d.Balance, '
+                 't.last_action = IF(d.Active, NOW(), t.last_action)')
+    conn.commit()
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark the flush statements against MySQL')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=3306)
+    parser.add_argument('--user', default='root')
+    parser.add_argument('--passwd', default='')
+    parser.add_argument('--db', default='margay_bench')
+    parser.add_argument('-r', '--rows', type=int, default=100000,
+                        help='rows per flush, for users and for torrents')
+    parser.add_argument('-i', '--ids', type=int, default=50000,
+                        help='distinct users and torrents the rows are spread over')
+    parser.add_argument('-n', '--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    conn = MySQLdb.connect(host=args.host, port=args.port, user=args.user, passwd=args.passwd,
+                           db=args.db)
+    seed(conn, args.ids)
+    generator = random.Random(args.rows)
+    users = [(generator.randint(1, args.ids), generator.randrange(1 << 30),
+              generator.randrange(1 << 30)) for _ in range(args.rows)]
+    torrents = [(generator.randint(1, args.ids), generator.randrange(100),
+                 generator.randrange(100), generator.randrange(2), generator.randrange(1 << 30))
+                for _ in range(args.rows)]
+
+    for name, flush in (('executemany', executemany), ('bulk', bulk), ('staging', staging)):
+        timings = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            flush(conn, users, torrents)
+            timings.append(time.perf_counter() - start)
+        best = min(timings)
+        print(f'{name:12} {2 * args.rows / best:10.0f} rows/s (best of {args.runs}, '
+              f'{best * 1000:.0f}ms per flush)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+"""
+Announce throughput of the aiohttp path against the AnnounceProtocol fast path, with and
+without uvloop.
+
+Each configuration runs the tracker in a child process against an in-memory stand-in for the
+database, then a number of keep-alive client connections hammer it with announces for a fixed
+amount of time. Optionally a share of the requests are user updates from the site, which log,
+with the log written to a file either directly or through the background writer.
+"""
+
+from argparse import ArgumentParser
+import asyncio
+import logging
+import multiprocessing
+import os
+import random
+import time
+
+from margay.catalog import TorrentCatalog, UserCatalog
+from margay.config import Config
+from margay.database import NullDatabase
+from margay.site_comm import SiteComm
+from margay.structs import LeechType
+from margay.worker import Worker
+
+
+class MemoryDatabase(NullDatabase):
+    def __init__(self, users, torrents):
+        self.users = users
+        self.torrents = torrents
+        super().__init__(dict(), Config()['flush'])
+
+    def load_torrents(self, torrents=None, users=None):
+        torrents = TorrentCatalog()
+        for tid in range(1, self.torrents + 1):
+            torrents.add(info_hash(tid), tid, LeechType.NORMAL)
+        return torrents
+
+    def load_users(self, users=None):
+        users = UserCatalog()
+        users.load((passkey(uid), uid, True, False) for uid in range(1, self.users + 1))
+        return users
+
+    @property
+    def rows(self):
+        """
+        Rows recorded so far, whether they were written, merged away or are still waiting
+        """
+        return self.backlog() + sum(queue.written + queue.merged + queue.dropped
+                                    for queue in self.queues)
+
+
+def info_hash(tid):
+    return f'{tid:020d}'
+
+
+def passkey(uid):
+    return f'{uid:032d}'
+
+
+SITE_PASSWORD = 's' * 32
+
+
+def start_logging(config, mode, path):
+    config['logging']['log_console'] = False
+    config['logging']['log_file'] = True
+    config['logging']['log_path'] = path
+    if mode == 'queued':
+        # noinspection PyUnresolvedReferences
+        from margay.logs import start_logging
+        start_logging(config)
+    elif mode == 'direct':
+        handler = logging.FileHandler(path)
+        handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)-5.5s]  %(message)s"))
+        logging.getLogger().addHandler(handler)
+        logging.getLogger().setLevel(logging.INFO)
+
+
+def serve(port, fast_path, uvloop, users, torrents, log, log_path):
+    config = Config()
+    config['internal']['fast_path'] = fast_path
+    config['internal']['uvloop'] = uvloop
+    config['internal']['keepalive_timeout'] = 60
+    config['gazelle']['site_password'] = SITE_PASSWORD
+    if log != 'off':
+        start_logging(config, log, log_path)
+    worker = Worker(MemoryDatabase(users, torrents), SiteComm(config), config)
+    worker.create_server(port)
+
+
+async def client(port, users, torrents, updates, deadline, counts):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    while time.perf_counter() < deadline:
+        uid = random.randint(1, users)
+        tid = random.randint(1, torrents)
+        if random.random() < updates:
+            request = (f'GET /{SITE_PASSWORD}/update?action=update_user&passkey={passkey(uid)}'
+                       f'&can_leech=1&visible=1 HTTP/1.1\r\nHost: tracker\r\n\r\n')
+        else:
+            request = (f'GET /{passkey(uid)}/announce?info_hash={info_hash(tid)}'
+                       f'&peer_id=-qB4100-{uid:012d}&port=6881&uploaded=0&downloaded=0'
+                       f'&left={random.choice((0, 1000))}&compact=1 HTTP/1.1\r\n'
+                       f'Host: tracker\r\nUser-Agent: qBittorrent/4.1.0\r\n'
+                       f'X-Forwarded-For: 8.{uid % 256}.{tid % 256}.1\r\n\r\n')
+        writer.write(request.encode())
+        head = await reader.readuntil(b'\r\n\r\n')
+        length = int(head.lower().split(b'content-length: ')[1].split(b'\r\n')[0])
+        await reader.readexactly(length)
+        counts.append(1)
+    writer.close()
+
+
+async def load(port, connections, users, torrents, updates, duration):
+    counts = []
+    deadline = time.perf_counter() + duration
+    await asyncio.gather(*(client(port, users, torrents, updates, deadline, counts)
+                           for _ in range(connections)))
+    return len(counts) / duration
+
+
+def run(port, fast_path, uvloop, args):
+    process = multiprocessing.Process(target=serve, args=(port, fast_path, uvloop, args.users,
+                                                          args.torrents, args.log,
+                                                          args.log_path), daemon=True)
+    process.start()
+    time.sleep(args.startup)
+    try:
+        return asyncio.run(load(port, args.connections, args.users, args.torrents,
+                                args.updates / 100, args.duration))
+    finally:
+        process.terminate()
+        process.join()
+        if args.log != 'off' and os.path.exists(args.log_path):
+            os.remove(args.log_path)
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark the HTTP announce paths')
+    parser.add_argument('-p', '--port', type=int, default=34100)
+    parser.add_argument('-c', '--connections', type=int, default=32)
+    parser.add_argument('-d', '--duration', type=float, default=5)
+    parser.add_argument('-u', '--users', type=int, default=10000)
+    parser.add_argument('-t', '--torrents', type=int, default=1000)
+    parser.add_argument('--startup', type=float, default=2,
+                        help='seconds to wait for the tracker to load')
+    parser.add_argument('--updates', type=float, default=0,
+                        help='percentage of requests that are user updates from the site')
+    parser.add_argument('--log', choices=('off', 'direct', 'queued'), default='off',
+                        help='write the log to a file directly from the loop or through the '
+                             'background writer')
+    parser.add_argument('--log-path', default='/tmp/margay-benchmark.log')
+    args = parser.parse_args()
+
+    for i, (name, fast_path, uvloop) in enumerate((('aiohttp', False, False),
+                                                   ('fast path', True, False),
+                                                   ('aiohttp + uvloop', False, True),
+                                                   ('fast path + uvloop', True, True))):
+        rate = run(args.port + i, fast_path, uvloop, args)
+        print(f'{name:20} {rate:10.0f} announces/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""
+Memory saved by interning user agents and keeping peer IPs packed.
+
+Every announce hands us freshly decoded header and query strings, so without interning each
+buffered heavy peer row and each Peer holds its own copy. This builds the same rows and peers
+both ways and compares what tracemalloc sees.
+"""
+
+from argparse import ArgumentParser
+import random
+import socket
+import tracemalloc
+from time import perf_counter
+
+from margay.interning import InternTable
+from margay.structs import Peer
+
+USER_AGENTS = [f'qBittorrent/4.{i}.{j}' for i in range(10) for j in range(10)] + \
+              [f'Transmission/2.{i}' for i in range(100)] + \
+              [f'Deluge {i}.0.{j}' for i in range(3) for j in range(100)]
+
+
+def fresh(value: str) -> str:
+    # what aiohttp hands us for every request, a new str decoded from the raw header
+    return value.encode('utf-8').decode('utf-8')
+
+
+def build(count, interned):
+    user_agents = InternTable(4096)
+    rows = []
+    peers = []
+    for i in range(count):
+        user_agent = fresh(random.choice(USER_AGENTS))
+        ip = fresh(f'{random.randint(1, 223)}.{random.randint(0, 255)}.'
+                   f'{random.randint(0, 255)}.{random.randint(1, 254)}')
+        peer = Peer()
+        if interned:
+            user_agent = user_agents.intern(user_agent)
+            ip = socket.inet_pton(socket.AF_INET, ip)
+        peer.ip = ip
+        peers.append(peer)
+        rows.append((i, i, 1, 0, 0, 0, 0, 0, 0, 0, 1, ip, '-qB4100-%012d' % i, user_agent, 0))
+    return rows, peers
+
+
+def measure(count, interned):
+    random.seed(0)
+    tracemalloc.start()
+    start = perf_counter()
+    result = build(count, interned)
+    elapsed = perf_counter() - start
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return size, elapsed
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark interning and packed IPs')
+    parser.add_argument('-n', '--count', type=int, default=200000)
+    args = parser.parse_args()
+
+    plain_size, plain_time = measure(args.count, False)
+    interned_size, interned_time = measure(args.count, True)
+    print(f'{args.count} heavy rows and peers')
+    print(f'plain:    {plain_size / 2 ** 20:8.1f} MiB {plain_time:6.2f}s')
+    print(f'interned: {interned_size / 2 ** 20:8.1f} MiB {interned_time:6.2f}s')
+    print(f'saved:    {(plain_size - interned_size) / 2 ** 20:8.1f} MiB '
+          f'({(plain_size - interned_size) / args.count:.0f} bytes per row and peer)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""
+Replay a capture (see the capture section of margay.conf) against a Worker backed by an
+in-memory stand-in for the database, at the speed it was captured, N times that or as fast as
+possible.
+
+Every passkey and info hash in the capture becomes a user or torrent, numbered in the order
+they first show up, so the same capture always starts from the same state. The swarm checksum
+printed at the end only depends on the requests, not on how fast they were replayed, so it
+should stay the same across changes that aren't meant to change behaviour.
+"""
+
+from argparse import ArgumentParser
+import time
+
+from margay.capture import checksum, read_capture
+from margay.catalog import TorrentCatalog, UserCatalog
+from margay.config import Config
+from margay.site_comm import SiteComm
+from margay.standby import DeltaPublisher
+from margay.structs import LeechType
+from margay.util import parse_query, query_values
+from margay.worker import Worker
+
+from http_announce import MemoryDatabase
+
+
+class ReplayDatabase(MemoryDatabase):
+    def __init__(self, requests):
+        self.passkeys = dict()
+        self.info_hashes = dict()
+        for request in requests:
+            self.passkeys.setdefault(request.passkey, len(self.passkeys) + 1)
+            if request.action == 'announce':
+                hashes = [parse_query(request.query_string).get('info_hash')]
+            else:
+                hashes = query_values(request.query_string, 'info_hash')
+            for info_hash in hashes:
+                if info_hash is not None:
+                    self.info_hashes.setdefault(info_hash, len(self.info_hashes) + 1)
+        super().__init__(len(self.passkeys), len(self.info_hashes))
+
+    def load_torrents(self, torrents=None, users=None):
+        torrents = TorrentCatalog()
+        for info_hash, tid in self.info_hashes.items():
+            torrents.add(info_hash, tid, LeechType.NORMAL)
+        return torrents
+
+    def load_users(self, users=None):
+        users = UserCatalog()
+        users.load((passkey, uid, True, False) for passkey, uid in self.passkeys.items())
+        return users
+
+
+def percentile(latencies, fraction):
+    return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))]
+
+
+def main():
+    parser = ArgumentParser(description='Replay a capture against the worker')
+    parser.add_argument('capture', help='capture file written by the tracker')
+    parser.add_argument('-s', '--speed', type=float, default=0,
+                        help='multiple of the captured rate to replay at, 0 for full speed')
+    parser.add_argument('-n', '--limit', type=int, default=0,
+                        help='only replay the first n requests')
+    parser.add_argument('--default-gc', action='store_true',
+                        help='leave the garbage collector as Python sets it up')
+    parser.add_argument('--publish', action='store_true',
+                        help='encode swarm deltas as if a standby was connected')
+    args = parser.parse_args()
+
+    requests = []
+    for request in read_capture(args.capture):
+        requests.append(request)
+        if len(requests) == args.limit:
+            break
+    if len(requests) == 0:
+        parser.error(f'{args.capture} has no requests')
+
+    config = Config()
+    config['gc']['enabled'] = not args.default_gc
+    database = ReplayDatabase(requests)
+    worker = Worker(database, SiteComm(config), config)
+    if args.publish:
+        # the deltas are only collected, there's no loop to write them out, so this measures
+        # what publishing costs the announces
+        worker.publisher = DeltaPublisher(worker, config)
+        worker.publisher.subscribers.append(None)
+
+    latencies = []
+    captured_start = requests[0].timestamp
+    start = time.perf_counter()
+    for request in requests:
+        if args.speed > 0:
+            delay = (request.timestamp - captured_start) / args.speed - \
+                    (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+        before = time.perf_counter()
+        worker.work(request.passkey, request.action, request.query_string, request.headers,
+                    request.remote_ip)
+        latencies.append(time.perf_counter() - before)
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    print(f'requests      {len(requests)} ({len(database.passkeys)} users, '
+          f'{len(database.info_hashes)} torrents)')
+    print(f'throughput    {len(requests) / elapsed:.0f} requests/s')
+    for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('p99.9', 0.999)):
+        print(f'{name:13} {percentile(latencies, fraction) * 1000000:.0f}us')
+    print(f'max           {latencies[-1] * 1000000:.0f}us')
+    print(f'rows          {database.rows}')
+    print(f'checksum      {checksum(worker.torrents, worker.users)}')
+    if args.publish:
+        print(f'published     {worker.publisher.records} records, '
+              f'{len(worker.publisher.buffer)} bytes')
+    print(worker.gc.report(), end='')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+Announce throughput of the UDP tracker against HTTP announces on the fast path.
+
+The tracker runs in a child process against the same in-memory database stand-in as
+http_announce.py. Each UDP client connects once, then sends announces one after the other,
+each carrying its passkey in the BEP 41 URL data option.
+"""
+
+from argparse import ArgumentParser
+import asyncio
+import multiprocessing
+import random
+import struct
+import time
+
+from margay.config import Config
+from margay.site_comm import SiteComm
+from margay.udp import ANNOUNCE, ANNOUNCE_REQUEST, CONNECT, CONNECT_RESPONSE, HEADER, \
+    PROTOCOL_ID, URL_DATA
+from margay.worker import Worker
+
+from http_announce import MemoryDatabase, info_hash, load, passkey
+
+
+def serve(port, udp_port, users, torrents):
+    config = Config()
+    config['internal']['fast_path'] = True
+    config['internal']['keepalive_timeout'] = 60
+    config['udp']['enabled'] = True
+    config['udp']['listen_host'] = '127.0.0.1'
+    config['udp']['listen_port'] = udp_port
+    worker = Worker(MemoryDatabase(users, torrents), SiteComm(config), config)
+    worker.create_server(port)
+
+
+class UdpClient(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.transport = None
+        self.responses = asyncio.Queue()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.responses.put_nowait(data)
+
+    async def request(self, data):
+        self.transport.sendto(data)
+        return await asyncio.wait_for(self.responses.get(), 1)
+
+
+async def udp_client(port, users, torrents, deadline, counts):
+    loop = asyncio.get_running_loop()
+    _, client = await loop.create_datagram_endpoint(UdpClient,
+                                                    remote_addr=('127.0.0.1', port))
+    response = await client.request(HEADER.pack(PROTOCOL_ID, CONNECT, 0))
+    _, _, connection_id = CONNECT_RESPONSE.unpack(response)
+    while time.perf_counter() < deadline:
+        uid = random.randint(1, users)
+        tid = random.randint(1, torrents)
+        path = f'/{passkey(uid)}/announce'.encode()
+        request = HEADER.pack(connection_id, ANNOUNCE, tid) + ANNOUNCE_REQUEST.pack(
+            info_hash(tid).encode(), f'-qB4100-{uid:012d}'.encode(), 0,
+            random.choice((0, 1000)), 0, 0, 0, 0, -1, 6881) + \
+            struct.pack('!BB', URL_DATA, len(path)) + path
+        try:
+            response = await client.request(request)
+        except asyncio.TimeoutError:
+            continue
+        action, = struct.unpack_from('!i', response)
+        if action != ANNOUNCE:
+            raise RuntimeError(response[8:].decode())
+        counts.append(1)
+    client.transport.close()
+
+
+async def udp_load(port, clients, users, torrents, duration):
+    counts = []
+    deadline = time.perf_counter() + duration
+    await asyncio.gather(*(udp_client(port, users, torrents, deadline, counts)
+                           for _ in range(clients)))
+    return len(counts) / duration
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark UDP announces against HTTP announces')
+    parser.add_argument('-p', '--port', type=int, default=34200)
+    parser.add_argument('-c', '--connections', type=int, default=32)
+    parser.add_argument('-d', '--duration', type=float, default=5)
+    parser.add_argument('-u', '--users', type=int, default=10000)
+    parser.add_argument('-t', '--torrents', type=int, default=1000)
+    parser.add_argument('--startup', type=float, default=2,
+                        help='seconds to wait for the tracker to load')
+    args = parser.parse_args()
+
+    process = multiprocessing.Process(target=serve, args=(args.port, args.port + 1, args.users,
+                                                          args.torrents), daemon=True)
+    process.start()
+    time.sleep(args.startup)
+    try:
+        http = asyncio.run(load(args.port, args.connections, args.users, args.torrents, 0,
+                                args.duration))
+        udp = asyncio.run(udp_load(args.port + 1, args.connections, args.users, args.torrents,
+                                   args.duration))
+    finally:
+        process.terminate()
+        process.join()
+    print(f'{"http (fast path)":20} {http:10.0f} announces/s')
+    print(f'{"udp":20} {udp:10.0f} announces/s')
+
+
+if __name__ == '__main__':
+    main()
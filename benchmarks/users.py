@@ -0,0 +1,70 @@
+"""
+Memory and passkey lookup latency of the UserCatalog against the dict of User objects it
+replaced, for hex and for alphanumeric passkeys.
+"""
+
+from argparse import ArgumentParser
+import gc
+import random
+import string
+import time
+import tracemalloc
+
+from margay.catalog import UserCatalog
+from margay.structs import User
+
+
+def passkeys(count, alphabet):
+    generator = random.Random(count)
+    return [''.join(generator.choice(alphabet) for _ in range(32)) for _ in range(count)]
+
+
+def build_dict(keys):
+    return {passkey: User(uid, True, False) for uid, passkey in enumerate(keys, 1)}
+
+
+def build_catalog(keys):
+    users = UserCatalog()
+    users.load((passkey, uid, True, False) for uid, passkey in enumerate(keys, 1))
+    return users
+
+
+def measure(build, keys):
+    gc.collect()
+    tracemalloc.start()
+    users = build(keys)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return users, size
+
+
+def lookups(lookup, keys, count):
+    # requests come with freshly parsed passkeys, copy them so their hashes aren't cached
+    sample = [passkey.encode().decode() for passkey in random.choices(keys, k=count)]
+    sample += ['x' * 32] * (count // 10)
+    random.shuffle(sample)
+    start = time.perf_counter()
+    for passkey in sample:
+        lookup(passkey)
+    return (time.perf_counter() - start) / len(sample)
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark the user catalog')
+    parser.add_argument('-u', '--users', type=int, default=1000000)
+    parser.add_argument('-l', '--lookups', type=int, default=1000000)
+    args = parser.parse_args()
+
+    for name, alphabet in (('hex', '0123456789abcdef'),
+                           ('alphanumeric', string.ascii_letters + string.digits)):
+        keys = passkeys(args.users, alphabet)
+        for kind, build in (('dict of User', build_dict), ('UserCatalog', build_catalog)):
+            users, size = measure(build, keys)
+            latency = lookups(users.get, keys, args.lookups)
+            print(f'{name:13} {kind:13} {size / 2 ** 20:8.1f} MiB '
+                  f'{latency * 1e9:6.0f}ns/lookup')
+            del users
+
+
+if __name__ == '__main__':
+    main()
@@ -105,4 +105,9 @@ CREATE TABLE IF NOT EXISTS `xbt_snatched` (
   KEY `fid` (`fid`),
   KEY `tstamp` (`tstamp`),
   KEY `uid_tstamp` (`uid`,`tstamp`)
-) ENGINE=InnoDB CHARSET utf8;
\ No newline at end of file
+) ENGINE=InnoDB CHARSET utf8;
+CREATE TABLE IF NOT EXISTS `margay_spool` (
+  `category` varchar(16) NOT NULL,
+  `seq` bigint(20) NOT NULL,
+  PRIMARY KEY (`category`)
+) ENGINE=InnoDB CHARSET utf8;
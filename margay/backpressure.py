@@ -0,0 +1,85 @@
+import logging
+
+import margay.stats as stats
+
+
+class Backpressure(object):
+    """
+    Admission control for announces. The pressure level is derived from the database flush
+    backlog and the event loop lag, and each level stretches the announce interval we hand out,
+    cuts numwant and, past shed_level, drops light peer updates altogether. The level rises as
+    soon as pressure is seen, but only falls one step per check so that we don't flap.
+    """
+    def __init__(self, database, config):
+        self.logger = logging.getLogger()
+        self.database = database
+
+        self.enabled = True
+        self.max_backlog = 0
+        self.max_loop_lag = 0
+        self.max_level = 0
+        self.max_interval_multiplier = 1
+        self.shed_level = 0
+
+        self.level = 0
+        self.interval_factor = 1.0
+        self.numwant_factor = 1.0
+        self.shed_light = False
+
+        self.load_config(config)
+
+    def load_config(self, config):
+        self.enabled = config['backpressure']['enabled']
+        self.max_backlog = max(1, config['backpressure']['max_backlog'])
+        self.max_loop_lag = max(1, config['backpressure']['max_loop_lag'])
+        self.max_level = max(1, config['backpressure']['max_level'])
+        self.max_interval_multiplier = max(1, config['backpressure']['max_interval_multiplier'])
+        self.shed_level = config['backpressure']['shed_level']
+
+    def reload_config(self, config):
+        self.load_config(config)
+        self._set_level(min(self.level, self.max_level))
+
+    def update(self, loop_lag: float) -> None:
+        """
+        :param loop_lag: how late (in seconds) the last periodic check ran on the event loop
+        """
+        backlog = self.database.backlog()
+        stats.flush_backlog = backlog
+        stats.loop_lag = int(loop_lag * 1000)
+        if not self.enabled:
+            if self.level != 0:
+                self._set_level(0)
+            return
+
+        pressure = max(backlog / self.max_backlog, stats.loop_lag / self.max_loop_lag)
+        target = min(self.max_level, int(pressure * self.max_level))
+        if target > self.level:
+            self._set_level(target)
+        elif target < self.level:
+            self._set_level(self.level - 1)
+
+    def _set_level(self, level: int) -> None:
+        if level != self.level:
+            self.logger.info(f'Backpressure level changed from {self.level} to {level} '
+                             f'(backlog: {stats.flush_backlog} rows, '
+                             f'loop lag: {stats.loop_lag}ms)')
+        self.level = level
+        ratio = level / self.max_level
+        self.interval_factor = 1 + (self.max_interval_multiplier - 1) * ratio
+        # Never cut numwant all the way to 0 as that would stall leechers completely
+        self.numwant_factor = 1 - ratio * (self.max_level / (self.max_level + 1))
+        self.shed_light = 0 < self.shed_level <= level
+        stats.backpressure_level = level
+        stats.backpressure_interval_factor = round(self.interval_factor, 2)
+        stats.backpressure_numwant_factor = round(self.numwant_factor, 2)
+
+    def interval(self, interval: int) -> int:
+        if self.level == 0:
+            return interval
+        return int(interval * self.interval_factor)
+
+    def numwant(self, numwant: int) -> int:
+        if self.level == 0 or numwant == 0:
+            return numwant
+        return max(1, int(numwant * self.numwant_factor))
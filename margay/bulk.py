@@ -0,0 +1,121 @@
+import logging
+from typing import Iterable, List, Sequence, Tuple
+
+# Room left in a packet for the protocol header and the statement tail
+HEADROOM = 1024
+
+
+class BulkWriter(object):
+    """
+    Writes rows as multi-row INSERT statements, each as large as max_allowed_packet allows, so
+    a batch of a hundred thousand rows goes out as a handful of statements instead of one per
+    row. Values are escaped with the connection's own literal(), mysqlclient doesn't expose
+    server side prepared statements.
+    """
+    def __init__(self, conn, max_statement_size=0):
+        self.logger = logging.getLogger()
+        self.conn = conn
+        limit = self.max_allowed_packet()
+        if 0 < max_statement_size < limit:
+            limit = max_statement_size
+        self.limit = max(limit - HEADROOM, HEADROOM)
+        self.statements = 0
+
+    def max_allowed_packet(self) -> int:
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT @@max_allowed_packet')
+        row = cursor.fetchone()
+        cursor.close()
+        # MySQL's default since 8.0, and large enough for anything we write
+        return int(row[0]) if row is not None else 64 * 1024 * 1024
+
+    def insert(self, head: str, rows: Iterable[Sequence], tail: str = '') -> int:
+        """
+        :param head: the statement up to and including VALUES
+        :param tail: anything that goes after the values, like ON DUPLICATE KEY UPDATE
+        :return: the number of statements it took
+        """
+        literal = self.conn.literal
+        head = head.encode()
+        tail = tail.encode()
+        statements = 0
+        statement = bytearray(head)
+        count = 0
+        cursor = self.conn.cursor()
+        for row in rows:
+            values = b'(' + b','.join([literal(value) for value in row]) + b')'
+            if count > 0 and len(statement) + len(values) + len(tail) + 1 > self.limit:
+                cursor.execute(bytes(statement + tail))
+                statements += 1
+                statement = bytearray(head)
+                count = 0
+            if count > 0:
+                statement += b','
+            statement += values
+            count += 1
+        if count > 0:
+            cursor.execute(bytes(statement + tail))
+            statements += 1
+        cursor.close()
+        self.statements += statements
+        return statements
+
+    def merge(self, create: str, staging: str, columns: str, rows: Iterable[Sequence],
+              update: str) -> int:
+        """
+        Load rows into a temporary staging table and apply them with a single UPDATE ... JOIN.
+        A temporary table can't be named twice in one statement, so rows have to be unique on
+        the key already.
+
+        :param create: the staging table's column definitions
+        :return: the number of statements it took
+        """
+        cursor = self.conn.cursor()
+        cursor.execute(f'CREATE TEMPORARY TABLE IF NOT EXISTS {staging} ({create}) '
+                       f'ENGINE=MEMORY')
+        cursor.execute(f'DELETE FROM {staging}')
+        cursor.close()
+        statements = self.insert(f'INSERT INTO {staging} ({columns}) VALUES ', rows)
+        cursor = self.conn.cursor()
+        cursor.execute(update)
+        cursor.close()
+        self.statements += 3
+        return statements + 3
+
+
+def merge_users(rows: List[Tuple[int, int, int]]) -> List[Tuple[int, int, int]]:
+    """
+    Sum the uploaded and downloaded deltas of every user
+    """
+    merged = dict()
+    for uid, uploaded, downloaded in rows:
+        total = merged.get(uid)
+        if total is None:
+            merged[uid] = [uploaded, downloaded]
+        else:
+            total[0] += uploaded
+            total[1] += downloaded
+    return [(uid, total[0], total[1]) for uid, total in merged.items()]
+
+
+def merge_torrents(rows: List[Tuple[int, int, int, int, int]]) -> \
+        List[Tuple[int, int, int, int, int, int]]:
+    """
+    Keep the last seeder and leecher counts and balance of every torrent, sum its snatches and
+    remember whether it had seeders at any point, which is what decides its last_action
+
+    :return: (id, seeders, leechers, snatched, balance, active) rows
+    """
+    merged = dict()
+    for tid, seeders, leechers, snatched, balance in rows:
+        last = merged.get(tid)
+        if last is None:
+            merged[tid] = [seeders, leechers, snatched, balance, seeders > 0]
+        else:
+            last[0] = seeders
+            last[1] = leechers
+            last[2] += snatched
+            last[3] = balance
+            last[4] = last[4] or seeders > 0
+    return [(tid, last[0], last[1], last[2], last[3], int(last[4]))
+            for tid, last in merged.items()]
@@ -0,0 +1,113 @@
+import hashlib
+import logging
+import struct
+from typing import Dict, Iterator, NamedTuple
+
+from .catalog import TorrentCatalog, UserCatalog
+from .structs import Action
+
+MAGIC = b'MARGAYC1'
+# timestamp, action, then the lengths of passkey, query string, remote ip, x-forwarded-for
+# and user agent, which follow the header in that order
+HEADER = struct.Struct('<dBHHHHH')
+
+
+class Request(NamedTuple):
+    timestamp: float
+    action: str
+    passkey: str
+    query_string: str
+    remote_ip: str
+    headers: Dict[str, str]
+
+
+class Capture(object):
+    """
+    Appends announces and scrapes to a file as they come in, so the load shape of production
+    (swarm sizes, event mix, churn) can be replayed later, see benchmarks/replay.py. Each
+    request is a fixed header followed by the raw strings, only the headers the worker looks
+    at are kept. Capturing stops once the file reaches max_size.
+    """
+    def __init__(self, path, max_size):
+        self.logger = logging.getLogger()
+        self.path = path
+        self.max_size = max_size
+        self.size = 0
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+        self.size += len(MAGIC)
+        self.logger.info(f'Capturing requests to {path}')
+
+    def record(self, timestamp, action, passkey, query_string, headers, remote_ip):
+        if self.file is None:
+            return
+        passkey = passkey.encode('latin-1')
+        query_string = query_string.encode('latin-1')
+        remote_ip = remote_ip.encode('latin-1')
+        forwarded = headers.get('x-forwarded-for', '').encode('latin-1')
+        user_agent = headers.get('user-agent', '').encode('utf-8')
+        record = HEADER.pack(timestamp, action, len(passkey), len(query_string), len(remote_ip),
+                             len(forwarded), len(user_agent)) + \
+            passkey + query_string + remote_ip + forwarded + user_agent
+        if self.size + len(record) > self.max_size:
+            self.logger.warning(f'Capture file {self.path} is full, no longer capturing')
+            self.close()
+            return
+        self.file.write(record)
+        self.size += len(record)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def read_capture(path) -> Iterator[Request]:
+    """
+    :return: the captured requests in the order they came in
+    """
+    with open(path, 'rb') as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a capture file')
+        while True:
+            header = file.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            timestamp, action, *lengths = HEADER.unpack(header)
+            data = file.read(sum(lengths))
+            if len(data) < sum(lengths):
+                # the tracker died in the middle of writing this request
+                return
+            fields = []
+            offset = 0
+            for length in lengths:
+                fields.append(data[offset:offset + length])
+                offset += length
+            passkey, query_string, remote_ip, forwarded, user_agent = fields
+            headers = {'user-agent': user_agent.decode('utf-8', 'replace')}
+            if len(forwarded) > 0:
+                headers['x-forwarded-for'] = forwarded.decode('latin-1')
+            yield Request(timestamp, Action(action).name.lower(), passkey.decode('latin-1'),
+                          query_string.decode('latin-1'), remote_ip.decode('latin-1'), headers)
+
+
+def checksum(torrents: TorrentCatalog, users: UserCatalog) -> str:
+    """
+    Digest of the swarm state that two runs over the same requests should agree on. Times are
+    left out, everything else that decides what ends up in the database or in an announce
+    response, including the order of the peers, is in.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for info_hash in sorted(torrents):
+        tid, _, completed, balance = torrents.record(info_hash)
+        digest.update(f'{info_hash}|{tid}|{completed}|{balance}'.encode('latin-1'))
+        tor = torrents.swarms.get(info_hash)
+        if tor is None:
+            continue
+        digest.update(tor.last_selected_seeder.encode('latin-1'))
+        for kind, peers in ((b'S', tor.seeders), (b'L', tor.leechers)):
+            for key, peer in peers.items():
+                digest.update(kind + f'{key}|{users.ids[peer.user]}|{peer.uploaded}|{peer.downloaded}|'
+                              f'{peer.corrupt}|{peer.left}|{peer.announces}|{peer.port}|'
+                              f'{peer.visible}'.encode('latin-1') + peer.ip)
+    return digest.hexdigest()
@@ -0,0 +1,310 @@
+from array import array
+import re
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from .structs import LeechType, Torrent
+
+# A passkey that packs to 16 bytes, checked up front because falling back on the ValueError of
+# bytes.fromhex costs more than the lookup itself. Only lowercase, which is what Gazelle
+# generates and what bytes.hex gives back, so passkeys keep matching exactly.
+HEX_PASSKEY = re.compile(r'[0-9a-f]{32}')
+
+
+class TorrentCatalog(object):
+    """
+    Every torrent the site knows about, indexed by info hash. Most of them don't have a single
+    peer at any given time, so a torrent is normally just a slot in a handful of arrays (id,
+    free leech type, snatches and balance). The full Torrent with its seeder and leecher dicts
+    only exists while the torrent has a swarm: it is created on the first announce by swarm()
+    and folded back into its slot by collapse() once the reaper finds it empty, so memory
+    grows with the number of active torrents rather than with the catalog.
+
+    Torrents with tokens keep their list of tokened users in tokens, which an active Torrent
+    shares as its tokened_users.
+    """
+    def __init__(self):
+        self.slots = dict()  # type: Dict[str, int]
+        self.ids = array('q')
+        self.free_torrents = array('B')
+        self.completed = array('q')
+        self.balances = array('q')
+        self.unused = []  # type: List[int]
+        self.swarms = dict()  # type: Dict[str, Torrent]
+        self.tokens = dict()  # type: Dict[str, List[int]]
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, info_hash):
+        return info_hash in self.slots
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.slots)
+
+    def add(self, info_hash, tid, free_torrent, completed=0):
+        """
+        Add a torrent, or only update its free leech type if it's already known
+        """
+        slot = self.slots.get(info_hash)
+        if slot is not None:
+            self.set_free_torrent(info_hash, free_torrent)
+            return
+        if len(self.unused) > 0:
+            slot = self.unused.pop()
+            self.ids[slot] = tid
+            self.free_torrents[slot] = free_torrent
+            self.completed[slot] = completed
+            self.balances[slot] = 0
+        else:
+            slot = len(self.ids)
+            self.ids.append(tid)
+            self.free_torrents.append(free_torrent)
+            self.completed.append(completed)
+            self.balances.append(0)
+        self.slots[info_hash] = slot
+
+    def remove(self, info_hash) -> Optional[Torrent]:
+        """
+        :return: the swarm of the torrent if it had one, so its peers can be accounted for
+        """
+        slot = self.slots.pop(info_hash)
+        self.unused.append(slot)
+        self.tokens.pop(info_hash, None)
+        return self.swarms.pop(info_hash, None)
+
+    def id(self, info_hash) -> int:
+        return self.ids[self.slots[info_hash]]
+
+    def free_torrent(self, info_hash) -> LeechType:
+        tor = self.swarms.get(info_hash)
+        if tor is not None:
+            return tor.free_torrent
+        return LeechType(self.free_torrents[self.slots[info_hash]])
+
+    def set_free_torrent(self, info_hash, free_torrent):
+        self.free_torrents[self.slots[info_hash]] = free_torrent
+        tor = self.swarms.get(info_hash)
+        if tor is not None:
+            tor.free_torrent = free_torrent
+
+    def swarm(self, info_hash) -> Optional[Torrent]:
+        """
+        :return: the Torrent of info_hash, created if the torrent was idle, or None if the
+                 torrent isn't in the catalog
+        """
+        tor = self.swarms.get(info_hash)
+        if tor is not None:
+            return tor
+        slot = self.slots.get(info_hash)
+        if slot is None:
+            return None
+        tor = Torrent(self.ids[slot], self.completed[slot])
+        tor.balance = self.balances[slot]
+        tor.free_torrent = LeechType(self.free_torrents[slot])
+        tor.tokened_users = self.tokens.setdefault(info_hash, [])
+        self.swarms[info_hash] = tor
+        return tor
+
+    def collapse(self, info_hash):
+        """
+        Fold an empty swarm back into its slot
+        """
+        tor = self.swarms.pop(info_hash)
+        slot = self.slots[info_hash]
+        self.completed[slot] = tor.completed
+        self.balances[slot] = tor.balance
+        self.free_torrents[slot] = tor.free_torrent
+        if len(tor.tokened_users) == 0:
+            self.tokens.pop(info_hash, None)
+
+    def counts(self, info_hash) -> Tuple[int, int, int]:
+        """
+        :return: (seeders, leechers, snatches) of a torrent without creating its swarm
+        """
+        tor = self.swarms.get(info_hash)
+        if tor is not None:
+            return len(tor.seeders), len(tor.leechers), tor.completed
+        return 0, 0, self.completed[self.slots[info_hash]]
+
+    def record(self, info_hash) -> Tuple[int, LeechType, int, int]:
+        """
+        :return: (id, free leech type, snatches, balance) of a torrent
+        """
+        tor = self.swarms.get(info_hash)
+        if tor is not None:
+            return tor.id, tor.free_torrent, tor.completed, tor.balance
+        slot = self.slots[info_hash]
+        return (self.ids[slot], LeechType(self.free_torrents[slot]), self.completed[slot],
+                self.balances[slot])
+
+    def add_token(self, info_hash, uid):
+        tokens = self.tokens.setdefault(info_hash, [])
+        if uid not in tokens:
+            tokens.append(uid)
+
+    def remove_token(self, info_hash, uid):
+        tokens = self.tokens.get(info_hash)
+        if tokens is not None and uid in tokens:
+            tokens.remove(uid)
+
+    def clear_tokens(self):
+        for tokens in self.tokens.values():
+            tokens.clear()
+
+
+def pack_passkey(passkey: str) -> bytes:
+    """
+    Passkeys that are lowercase hex, like the ones Gazelle generates, are kept as the 16 bytes
+    they encode, anything else (uppercase hex included) as its 32 raw bytes. Only 32 character
+    passkeys are valid, so the two forms can't collide.
+    """
+    if HEX_PASSKEY.fullmatch(passkey) is not None:
+        return bytes.fromhex(passkey)
+    return passkey.encode('latin-1')
+
+
+class UserCatalog(object):
+    """
+    Every enabled user, looked up by passkey. A user is a row in parallel arrays (id, can
+    leech, protected IP, seeding and leeching counts, deleted) and the passkey index maps the
+    packed passkey to that row. Peers refer to their user by row, so a removed user's row is
+    only marked deleted and isn't handed to anyone else until no peer of theirs is left.
+
+    Going the other way, peers has the (info hash, peer key) of every peer of the users that
+    have any, so all of a user's peers can be found without walking the swarms.
+    """
+    def __init__(self):
+        self.rows = dict()  # type: Dict[bytes, int]
+        self.ids = array('q')
+        self.leech = array('B')
+        self.protect = array('B')
+        self.seeding = array('i')
+        self.leeching = array('i')
+        self.deleted = array('B')
+        self.unused = []  # type: List[int]
+        self.peers = dict()  # type: Dict[int, Set[Tuple[str, str]]]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, passkey):
+        return self.get(passkey) is not None
+
+    def get(self, passkey) -> Optional[int]:
+        """
+        :return: the row of the user with passkey, None if there's no such user
+        """
+        if len(passkey) != 32:
+            return None
+        # pack_passkey inlined, this runs for every request
+        if HEX_PASSKEY.fullmatch(passkey) is not None:
+            return self.rows.get(bytes.fromhex(passkey))
+        return self.rows.get(passkey.encode('latin-1'))
+
+    def add(self, passkey, uid, leech, protect) -> int:
+        """
+        Add a user, or update can leech and protect if the passkey is already known
+
+        :return: the row of the user
+        """
+        key = pack_passkey(passkey)
+        row = self.rows.get(key)
+        if row is not None:
+            self.leech[row] = leech
+            self.protect[row] = protect
+            return row
+        if len(self.unused) > 0:
+            row = self.unused.pop()
+            self.ids[row] = uid
+            self.leech[row] = leech
+            self.protect[row] = protect
+            self.seeding[row] = 0
+            self.leeching[row] = 0
+            self.deleted[row] = 0
+        else:
+            row = len(self.ids)
+            self.ids.append(uid)
+            self.leech.append(leech)
+            self.protect.append(protect)
+            self.seeding.append(0)
+            self.leeching.append(0)
+            self.deleted.append(0)
+        self.rows[key] = row
+        return row
+
+    def remove(self, passkey) -> Optional[int]:
+        """
+        :return: the row the user had, None if there's no such user
+        """
+        row = self.rows.pop(pack_passkey(passkey), None)
+        if row is not None:
+            self.deleted[row] = 1
+        return row
+
+    def rename(self, old_passkey, new_passkey) -> Optional[int]:
+        """
+        :return: the row of the user, None if there's no user with old_passkey or another user
+                 has new_passkey already, in which case nothing changes
+        """
+        new_key = pack_passkey(new_passkey)
+        if new_key in self.rows:
+            return None
+        row = self.rows.pop(pack_passkey(old_passkey), None)
+        if row is not None:
+            self.rows[new_key] = row
+        return row
+
+    def load(self, users: Iterable[Tuple[str, int, bool, bool]]) -> Tuple[int, int]:
+        """
+        Bring the catalog in line with a full list of users. Rows that are still there get
+        marked as they're seen, so working out who is gone doesn't need a set of every passkey.
+
+        :param users: (passkey, id, can leech, protect) of every enabled user
+        :return: the number of users added and removed
+        """
+        seen = array('B', bytes(len(self.ids)))
+        known = len(self.ids)
+        added = 0
+        for passkey, uid, leech, protect in users:
+            count = len(self.rows)
+            row = self.add(passkey, uid, leech, protect)
+            if len(self.rows) > count:
+                added += 1
+            if row < known:
+                seen[row] = 1
+        removed = [key for key, row in self.rows.items() if row < known and not seen[row]]
+        for key in removed:
+            self.deleted[self.rows.pop(key)] = 1
+        self.reclaim()
+        return added, len(removed)
+
+    def add_peer(self, row, info_hash, peer_key):
+        peers = self.peers.get(row)
+        if peers is None:
+            self.peers[row] = {(info_hash, peer_key)}
+        else:
+            peers.add((info_hash, peer_key))
+
+    def remove_peer(self, row, info_hash, peer_key):
+        peers = self.peers.get(row)
+        if peers is not None:
+            peers.discard((info_hash, peer_key))
+            if len(peers) == 0:
+                del self.peers[row]
+
+    def release(self, row):
+        """
+        Hand the row of a deleted user back out once their peers are gone
+        """
+        if self.deleted[row] and row not in self.peers and row not in self.unused:
+            self.unused.append(row)
+
+    def reclaim(self):
+        """
+        Hand the rows of deleted users without any peers left back out to new users
+        """
+        unused = set(self.unused)
+        for row in range(len(self.ids)):
+            if self.deleted[row] and self.seeding[row] == 0 and self.leeching[row] == 0 and \
+                    row not in unused:
+                self.unused.append(row)
@@ -0,0 +1,84 @@
+import gc
+import logging
+from time import perf_counter
+
+import margay.stats as stats
+
+
+class GarbageCollector(object):
+    """
+    Keeps the cyclic garbage collector away from the catalogs. After a load the torrents, users
+    and peers that survived it are moved to the permanent generation with gc.freeze so that
+    full collections stop rescanning them, and the generation thresholds are raised since a
+    request allocates plenty of short lived objects but hardly ever a cycle. Every collection
+    is timed through gc.callbacks either way, so the two behaviours can be compared.
+    """
+    def __init__(self, config):
+        self.logger = logging.getLogger()
+        self.enabled = False
+        self.thresholds = gc.get_threshold()
+        self.default_thresholds = gc.get_threshold()
+        self.collections = [0, 0, 0]
+        self.collected = [0, 0, 0]
+        self.pause_total = [0.0, 0.0, 0.0]  # milliseconds
+        self.pause_max = [0.0, 0.0, 0.0]
+        self._started = 0.0
+        self.reload_config(config)
+        gc.callbacks.append(self._callback)
+
+    def reload_config(self, config):
+        self.enabled = config['gc']['enabled']
+        if self.enabled:
+            self.thresholds = (config['gc']['threshold0'], config['gc']['threshold1'],
+                               config['gc']['threshold2'])
+        else:
+            self.thresholds = self.default_thresholds
+            gc.unfreeze()
+        gc.set_threshold(*self.thresholds)
+
+    def close(self):
+        if self._callback in gc.callbacks:
+            gc.callbacks.remove(self._callback)
+
+    def loading(self):
+        """
+        Called before the catalogs are (re)loaded. Everything frozen goes back to the oldest
+        generation so that whatever the load drops can still be collected, and collections
+        are held off while the load allocates millions of objects that will all survive it.
+        """
+        if self.enabled:
+            gc.unfreeze()
+            gc.disable()
+
+    def loaded(self):
+        if self.enabled:
+            gc.collect()
+            gc.freeze()
+            gc.enable()
+            self.logger.info(f'Froze {gc.get_freeze_count()} objects after loading')
+
+    def _callback(self, phase, info):
+        if phase == 'start':
+            self._started = perf_counter()
+            return
+        pause = (perf_counter() - self._started) * 1000
+        generation = info['generation']
+        self.collections[generation] += 1
+        self.collected[generation] += info['collected']
+        self.pause_total[generation] += pause
+        if pause > self.pause_max[generation]:
+            self.pause_max[generation] = pause
+        stats.gc_collections += 1
+        stats.gc_pause_total += pause
+        if pause > stats.gc_pause_max:
+            stats.gc_pause_max = pause
+
+    def report(self) -> str:
+        output = f"{'tuned' if self.enabled else 'default'} thresholds {self.thresholds}\n" \
+                 f"{gc.get_freeze_count()} frozen objects\n"
+        for generation in range(3):
+            output += f"generation {generation}: {self.collections[generation]} collections, " \
+                      f"{self.collected[generation]} collected, " \
+                      f"{self.pause_total[generation]:.3f}ms total, " \
+                      f"{self.pause_max[generation]:.3f}ms max pause\n"
+        return output
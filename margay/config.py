@@ -10,25 +10,41 @@ class Config(object):
     def __init__(self, config_file=None, daemonize=False):
         self.config = {
             'internal': {
+                'listen_host': '127.0.0.1',
                 'listen_port': 35000,
+                'listen_path': '',
                 'max_connections': 1024,
                 'max_middlemen': 20000,
                 'max_read_buffer': 4096,
                 'connection_timeout': 10,
                 'keepalive_timeout': 0,
+                'fast_path': False,
+                'uvloop': False,
                 'daemonize': daemonize
             },
             'tracker': {
                 'announce_interval': 1800,
                 'max_request_size': 4096,
                 'numwant_limit': 50,
-                'request_log_size': 500
+                'request_log_size': 500,
+                'intern_table_size': 4096
             },
             'timers': {
                 'del_reason_lifetime': 86400,
                 'peers_timeout': 7200,
                 'reap_peers_interval': 1800,
-                'schedule_interval': 3
+                'schedule_interval': 3,
+                'schedule_jitter': 10,
+                'drain_timeout': 30
+            },
+            'database': {
+                # mysql, sqlite or null
+                'backend': 'mysql'
+            },
+            'sqlite': {
+                'path': '/tmp/margay.db',
+                # the tables are created from this schema when they don't exist yet
+                'schema': 'margay.sql'
             },
             # note: host=localhost will cause mysqlclient to use a socket regardless of port,
             # use 127.0.0.1 for the host if you're trying to connect to something with a port
@@ -37,7 +53,60 @@ class Config(object):
                 'db': 'gazelle',
                 'user': 'gazelle',
                 'passwd': 'password',
-                'port': 36000
+                'port': 36000,
+                # largest statement the flush threads build, 0 for the server's
+                # max_allowed_packet
+                'max_statement_size': 0,
+                'staging_tables': False,
+                # read only replica for loading torrents, users, tokens and the whitelist,
+                # '' for none. It uses the user, password and database of the primary.
+                'replica_host': '',
+                'replica_port': 0,
+                'max_replica_lag': 30
+            },
+            'flush': {
+                # rows of each category a flush round writes before moving on to the next
+                # one, 0 for no limit
+                'users_budget': 0,
+                'tokens_budget': 0,
+                'snatches_budget': 0,
+                'torrents_budget': 200000,
+                'peers_budget': 100000,
+                'max_peer_backlog': 1000000
+            },
+            'udp': {
+                'enabled': False,
+                'listen_host': '0.0.0.0',
+                'listen_port': 34001
+            },
+            'spool': {
+                'enabled': True,
+                'path': '/tmp/margay.spool',
+                'max_size': 64 * 1024 * 1024
+            },
+            'upgrade': {
+                'path': '/tmp/margay.upgrade',
+                'timeout': 30
+            },
+            'export': {
+                'enabled': False,
+                'path': '/tmp/margay.swarms',
+                'interval': 60,
+                'chunk': 10000
+            },
+            'capture': {
+                'enabled': False,
+                'path': '/tmp/margay.capture',
+                'max_size': 1024 * 1024 * 1024
+            },
+            'gc': {
+                'enabled': True,
+                'threshold0': 50000,
+                'threshold1': 20,
+                'threshold2': 100
+            },
+            'memory': {
+                'tracemalloc_frames': 0
             },
             'gazelle': {
                 'site_host': '127.0.0.1',
@@ -50,7 +119,52 @@ class Config(object):
                 'log_level': logging.getLevelName(logging.INFO),
                 'log_console': True,
                 'log_file': False,
-                'log_path': '/tmp/margay'
+                'log_path': '/tmp/margay',
+                # records waiting for the writer thread before new ones are dropped
+                'max_queue': 10000,
+                # seconds between the summaries of messages that can come in bursts
+                'summary_interval': 10
+            },
+            'watchdog': {
+                'enabled': True,
+                'interval': 100,
+                'threshold': 250,
+                'log_interval': 10
+            },
+            'mirror': {
+                'enabled': False,
+                'host': '127.0.0.1',
+                'port': 34010,
+                'sample': 1,
+                'max_pending': 64,
+                'timeout': 2000
+            },
+            'standby': {
+                'publish': False,
+                'listen_host': '127.0.0.1',
+                'listen_port': 34002,
+                'flush_interval': 100,
+                'max_buffer': 64 * 1024 * 1024,
+                'primary_host': '',
+                'primary_port': 34002,
+                'retry_interval': 5,
+                'retries': 3
+            },
+            'smoothing': {
+                'enabled': True,
+                'spread': 600,
+                'max_spread': 1800,
+                'slack': 10,
+                'max_rate': 0
+            },
+            'backpressure': {
+                'enabled': True,
+                'check_interval': 1,
+                'max_backlog': 200000,
+                'max_loop_lag': 500,
+                'max_level': 4,
+                'max_interval_multiplier': 3,
+                'shed_level': 3
             },
             'debug': {
                 'readonly': False
@@ -64,7 +178,7 @@ class Config(object):
             for key in config:
                 for value in config[key]:
                     if type(self.config[key][value]) == int:
-                        self.config[key][value] = int(self.config[key][value])
+                        self.config[key][value] = int(config[key][value])
                     elif type(self.config[key][value]) == bool:
                         self.config[key][value] = config[key][value] in ('True', 'true', 'On',
                                                                          'on')
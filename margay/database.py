@@ -1,23 +1,77 @@
-import binascii
 from copy import copy
 import logging
-from time import time
-from typing import Dict
+import socket
+from time import perf_counter, time
 import threading
-# noinspection PyPackageRequirements
-import MySQLdb
+from typing import Any, Callable, Dict, List, Tuple
 
-from .structs import Torrent, User, LeechType
+from .catalog import TorrentCatalog, UserCatalog
+from .logs import summary
+from .spool import Spool
+from .structs import LeechType
 import margay.stats as stats
 
+# Sequence number of a queued batch the flush thread still has to write to the spool, batches
+# that are never spooled (peers, or everything when there's no spool) have 0
+UNSPOOLED = -1
+# Peer rows that have to be queued since the last merge before the peer queue is merged again,
+# as a fraction of max_peer_backlog. A merge goes through the whole backlog, doing it on every
+# flush while over max_peer_backlog would hold up the loop every time.
+MERGE_FRACTION = 10
+
+
+def ip_string(packed: bytes) -> str:
+    """
+    Peer and snatch rows carry their IP packed (or empty for protected users) until they're
+    written out
+    """
+    return socket.inet_ntoa(packed) if len(packed) == 4 else ''
+
+
+class FlushQueue(object):
+    def __init__(self, name, priority, write: Callable[[Any, Any, list], None]):
+        self.name = name
+        self.priority = priority
+        self.write = write
+        self.batches = []  # type: List[Tuple[int, list, float]]
+        self.lock = threading.RLock()
+        # rows a flush round writes before moving on to the next queue, 0 for no limit
+        self.budget = 0
+        self.written = 0
+        self.merged = 0
+        self.dropped = 0
+        self.max_lag = 0.0
+
+    def rows(self) -> int:
+        return sum(len(batch[1]) for batch in list(self.batches))
+
+    def lag(self, now) -> float:
+        """
+        :return: seconds since the oldest batch that's still waiting was queued
+        """
+        batches = self.batches
+        return now - batches[0][2] if len(batches) > 0 else 0.0
+
 
 class Database(object):
-    def __init__(self, settings, readonly=False):
+    """
+    Everything the tracker keeps in or loads from the site's database: the catalogs are loaded
+    from it and the deltas recorded by announces are buffered, queued up by flush() and
+    spooled and written out by a flush thread. Where they're loaded from and how they're
+    written is up to the backend, which implements get_connection, the _write_ methods
+    (_write_watermark included) and _clear_peer_data, and sets errors to the exceptions that
+    mean a flush should be retried. The loaders only use DB-API calls and SQL that MySQL and
+    SQLite both understand.
+    """
+    errors = ()  # type: Tuple[type, ...]
+
+    def __init__(self, settings, flush, readonly=False, spool=None, clear_peers=True):
         self.logger = logging.getLogger()
         self.settings = settings
         self.db = self.get_connection()
 
         self.readonly = readonly
+        self.spool = spool  # type: Spool
 
         self.user_buffer = []
         self.torrent_buffer = []
@@ -26,117 +80,128 @@ class Database(object):
         self.snatch_buffer = []
         self.token_buffer = []
 
-        self.user_queue = []
-        self.torrent_queue = []
-        self.peer_queue = []
-        self.snatch_queue = []
-        self.token_queue = []
-
-        self.u_active = self.t_active = self.p_active = self.s_active = self.tok_active = False
-        self.user_lock = threading.RLock()
-        self.torrent_lock = threading.RLock()
-        self.peer_lock = threading.RLock()
-        self.snatch_lock = threading.RLock()
-        self.token_lock = threading.RLock()
+        # in the order they're written in: credit and tokens first, then snatches, then the
+        # torrent counts and last the peer telemetry, which can be merged and dropped
+        self.user_queue = FlushQueue('users', 1, self._write_users)
+        self.token_queue = FlushQueue('tokens', 2, self._write_tokens)
+        self.snatch_queue = FlushQueue('snatches', 3, self._write_snatches)
+        self.torrent_queue = FlushQueue('torrents', 4, self._write_torrents)
+        self.peer_queue = FlushQueue('peers', 5, self._write_peers)
+        self.queues = [self.user_queue, self.token_queue, self.snatch_queue, self.torrent_queue,
+                       self.peer_queue]  # type: List[FlushQueue]
+        self.max_peer_backlog = 0
+        # peer rows queued since the peer queue was last merged
+        self.unmerged_peers = 0
+        self.reload_config(flush)
+
+        self.flush_active = False
+        self.flush_lock = threading.RLock()
 
         self.torrent_list_lock = threading.RLock()
         self.user_list_lock = threading.RLock()
         self.whitelist_lock = threading.RLock()
 
         if not self.readonly:
-            self.logger.info('Clearing xbt_files_users and resetting peer counts...')
+            # not after an upgrade, they're the ones the old process left us
+            if clear_peers:
+                self.logger.info('Clearing xbt_files_users and resetting peer counts...')
+                self._clear_peer_data()
+                self.logger.info('done')
+            if self.spool is not None:
+                self._replay_spool(clear_peers)
             self.flush()
-            self._clear_peer_data()
-            self.logger.info('done')
 
     def get_connection(self):
-        return MySQLdb.connect(host=self.settings['host'], user=self.settings['user'],
-                               passwd=self.settings['passwd'], db=self.settings['db'],
-                               port=self.settings['port'])
+        """
+        :return: a new DB-API connection, the flush threads each open their own
+        """
+        raise NotImplementedError
+
+    def reader(self, purpose):
+        """
+        :return: the connection the loaders read from, purpose being what they load
+        """
+        return self.db
+
+    def get_writer(self, conn):
+        """
+        :return: whatever the _write_ methods need besides the connection
+        """
+        return None
 
     def connected(self):
         return self.db is not None
 
-    def load_torrents(self, torrents=None):
+    def load_torrents(self, torrents: TorrentCatalog = None, users: UserCatalog = None):
+        """
+        :param users: the users the peers of the current torrents belong to
+        """
         if torrents is None:
-            torrents = dict()
-        cur_keys = set(torrents.keys())
+            torrents = TorrentCatalog()
+        cur_keys = set(torrents)
 
-        cursor = self.db.cursor()
-        # info_hash is a binary blob and using HEX converts it to a hex string and LCASE lowers it
-        # so that we don't have to worry about weird cases
+        cursor = self.reader('torrents').cursor()
+        # info_hash is a binary blob, it's decoded as latin-1 to match how parse_query decodes
+        # the info_hash of a request
         cursor.execute('SELECT ID, info_hash, FreeTorrent, Snatched FROM torrents '
                        'ORDER BY ID')
         with self.torrent_list_lock:
+            torrents.clear_tokens()
             for row in cursor.fetchall():
-                info_hash = row[1].decode('utf-8', 'replace')
+                info_hash = row[1].decode('latin-1')
                 if info_hash == '':
                     continue
-                if info_hash not in torrents:
-                    torrents[info_hash] = Torrent(row[0], row[3])
-                else:
-                    torrents[info_hash].tokened_users.clear()
-                    cur_keys.remove(info_hash)
-                torrents[info_hash].free_torrent = LeechType.to_enum(row[2])
+                cur_keys.discard(info_hash)
+                torrents.add(info_hash, row[0], LeechType.to_enum(row[2]), row[3])
             cursor.close()
 
             for key in cur_keys:
-                stats.leechers -= torrents[key].leechers
-                stats.seeders -= torrents[key].seeders
-                for leecher in torrents[key].leechers:
-                    leecher.user.leeching -= 1
-                for seeder in torrents[key].seeders:
-                    seeder.user.seeding -= 1
-                del torrents[key]
+                torrent = torrents.remove(key)
+                if torrent is None:
+                    continue
+                stats.leechers -= len(torrent.leechers)
+                stats.seeders -= len(torrent.seeders)
+                for peer_key, leecher in torrent.leechers.items():
+                    users.leeching[leecher.user] -= 1
+                    users.remove_peer(leecher.user, key, peer_key)
+                for peer_key, seeder in torrent.seeders.items():
+                    users.seeding[seeder.user] -= 1
+                    users.remove_peer(seeder.user, key, peer_key)
 
         self.logger.info(f'Loaded {len(torrents)} torrents')
         self.load_tokens(torrents)
         return torrents
 
-    def load_users(self, users=None):
+    def load_users(self, users: UserCatalog = None):
         if users is None:
-            users = dict()
-        cur_keys = set(users.keys())
+            users = UserCatalog()
 
-        cursor = self.db.cursor()
-        cursor.execute("SELECT ID, can_leech, torrent_pass, (Visible='0' OR IP='127.0.0.1') AS "
+        cursor = self.reader('users').cursor()
+        cursor.execute("SELECT torrent_pass, ID, can_leech, (Visible='0' OR IP='127.0.0.1') AS "
                        "Protected FROM users_main WHERE Enabled='1'")
         with self.user_list_lock:
-            for row in cursor.fetchall():
-                if row[2] not in users:
-                    users[row[2]] = User(row[0], row[1], row[3])
-                else:
-                    users[row[2]].leech = row[1]
-                    users[row[2]].protect = row[3]
-                    cur_keys.remove(row[2])
+            added, removed = users.load(cursor.fetchall())
             cursor.close()
 
-            for key in cur_keys:
-                del users[key]
-
-        self.logger.info(f'Loaded {len(users)} users')
+        self.logger.info(f'Loaded {len(users)} users ({added} new, {removed} removed)')
         return users
 
-    def load_tokens(self, torrents: Dict[str, Torrent]):
-        """
-
-        :param torrents:
-        :type torrents: Dict[str, Torrent]
-        :return:
-        """
-        cursor = self.db.cursor()
+    def load_tokens(self, torrents: TorrentCatalog):
+        cursor = self.reader('tokens').cursor()
         cursor.execute("SELECT uf.UserID, t.info_hash FROM users_freeleeches AS uf "
                        "JOIN torrents AS t ON t.ID = uf.TorrentID "
                        "WHERE uf.Expired = '0'")
-        for row in cursor.fetchall():
-            info_hash = str(row[1])
-            torrent = torrents[info_hash]
-            torrent.tokened_users.append(row[0])
-        logging.info(f'Loaded {cursor.rownumber} tokens')
+        with self.torrent_list_lock:
+            rows = cursor.fetchall()
+            for row in rows:
+                info_hash = row[1].decode('latin-1')
+                if info_hash in torrents:
+                    torrents.add_token(info_hash, row[0])
+        logging.info(f'Loaded {len(rows)} tokens')
         cursor.close()
 
     def load_whitelist(self):
-        cursor = self.db.cursor()
+        cursor = self.reader('whitelist').cursor()
         whitelist = list()
         cursor.execute("SELECT peer_id FROM xbt_client_whitelist")
         with self.whitelist_lock:
@@ -173,188 +238,403 @@ class Database(object):
                                        downspeed, remaining, corrupt, timespent, announced,
                                        ip, peer_id, user_agent, int(time())))
 
-    def flush(self):
-        self._flush_users()
-        self._flush_torrents()
-        self._flush_snatches()
-        self._flush_peers()
-        self._flush_tokens()
+    def backlog(self) -> int:
+        """
+        Number of rows that are waiting to be written to the database, whether they're still
+        buffered or already queued up for the flush thread.
+        """
+        return (len(self.user_buffer) + len(self.torrent_buffer) + len(self.heavy_peer_buffer) +
+                len(self.light_peer_buffer) + len(self.snatch_buffer) + len(self.token_buffer) +
+                sum(queue.rows() for queue in self.queues))
+
+    def reload_config(self, config):
+        for queue in self.queues:
+            queue.budget = config[f'{queue.name}_budget']
+        self.max_peer_backlog = config['max_peer_backlog']
 
-    def _flush_users(self):
+    def flush(self):
+        """
+        Move the buffers into their queues and start a flush thread if there isn't one. Runs on
+        the loop, so it never touches the spool, the flush thread writes the batches to it.
+        """
+        self._queue(self.user_queue, self.user_buffer)
+        self._queue(self.token_queue, self.token_buffer)
+        self._queue(self.snatch_queue, self.snatch_buffer)
+        self._queue(self.torrent_queue, self.torrent_buffer)
+        self._queue_peers()
         if self.readonly:
-            self.user_buffer.clear()
             return
-
-        with self.user_lock:
-            if len(self.user_queue) > 0:
-                self.logger.info(f'User flush queue size: {len(self.user_queue)}, '
-                                 f'next query length: {len(str(self.token_queue[0]))}')
-            if len(self.user_buffer) == 0:
+        with self.flush_lock:
+            if self.flush_active or self.backlog() == 0:
                 return
-            self.user_queue.extend(copy(self.user_buffer))
-            self.user_buffer.clear()
-        if not self.u_active:
-            threading.Thread(target=self._do_flush_users).start()
-
-    def _do_flush_users(self):
-        self.u_active = True
-        conn = self.get_connection()
-        while len(self.user_queue) > 0:
-            cursor = conn.cursor()
-            cursor.executemany('INSERT INTO users_main (ID, Uploaded, Downloaded) '
-                               'VALUES(%s, %s, %s) '
-                               'ON DUPLICATE KEY UPDATE Uploaded = Uploaded + Values(Uploaded), '
-                               'Downloaded = Downloaded + Values(Downloaded)', self.user_queue[0])
-            cursor.close()
-            with self.user_lock:
-                self.user_queue.pop(0)
-        self.u_active = False
+            self.flush_active = True
+        threading.Thread(target=self._do_flush).start()
+
+    def report(self) -> str:
+        output = ''
+        now = time()
+        for queue in self.queues:
+            output += f"{queue.name}: priority {queue.priority}, budget {queue.budget} rows, " \
+                      f"{len(queue.batches)} batches ({queue.rows()} rows) queued, " \
+                      f"{queue.lag(now):.1f}s behind (max {queue.max_lag:.1f}s), " \
+                      f"{queue.written} rows written, {queue.merged} merged, " \
+                      f"{queue.dropped} dropped\n"
+        return output
+
+    def handoff(self) -> List[Tuple[str, list, float]]:
+        """
+        Stop writing to the database for good and return what's waiting to be written, for the
+        process that takes over from us. Batches that are in the spool are left out, the new
+        process replays them from it, so the spool is closed. Batches that were never spooled
+        are sent along. The caller makes sure no flush
+        is running.
+        """
+        with self.flush_lock:
+            # keeps flush() from starting another flush thread
+            self.flush_active = True
+        self._queue(self.user_queue, self.user_buffer)
+        self._queue(self.token_queue, self.token_buffer)
+        self._queue(self.snatch_queue, self.snatch_buffer)
+        self._queue(self.torrent_queue, self.torrent_buffer)
+        self._queue_peers()
+        batches = []
+        for queue in self.queues:
+            with queue.lock:
+                batches.extend((queue.name, rows, queued_at)
+                               for seq, rows, queued_at in queue.batches if seq <= 0)
+                queue.batches.clear()
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
+        self.readonly = True
+        return batches
+
+    def resume(self, readonly, spool: Spool, batches: List[Tuple[str, list, float]]):
+        """
+        Undo handoff() when the process we were handing over to never got the batches
 
-    def _flush_torrents(self):
-        if self.readonly:
-            self.torrent_buffer.clear()
-            return
+        :param readonly: and spool, what they were before handoff()
+        """
+        self.readonly = readonly
+        self.spool = spool
+        if spool is not None:
+            self._replay_spool(False)
+        self.adopt(batches)
+        with self.flush_lock:
+            self.flush_active = False
+
+    def promote(self, spool: Spool):
+        """
+        Start writing, for a standby that was opened readonly and takes over from its primary.
+        The database and the spool were the primary's until now, so what's left in the spool is
+        replayed like after a restart, without resetting the peer counts.
+        """
+        self.readonly = False
+        self.spool = spool
+        if spool is not None:
+            self._replay_spool(False)
+        self.flush()
 
-        with self.torrent_lock:
-            if len(self.torrent_queue) > 0:
-                self.logger.info(f'Torrent flush queue size: {len(self.torrent_queue)}, '
-                                 f'next query length: {len(str(self.torrent_queue[0]))}')
-            if len(self.torrent_buffer) == 0:
-                return
-            self.torrent_queue.extend(copy(self.torrent_buffer))
-            self.torrent_buffer.clear()
-        if not self.t_active:
-            threading.Thread(target=self._do_flush_torrents).start()
-
-    def _do_flush_torrents(self):
-        self.t_active = True
-        conn = self.get_connection()
-        while len(self.torrent_queue) > 0:
-            cursor = conn.cursor()
-            cursor.executemany('INSERT INTO torrents (ID, Seeders, Leechers, Snatched, Balance) '
-                               'VALUES (%s, %s, %s, %s, %s) '
-                               'ON DUPLICATE KEY UPDATE Seeders=VALUES(Seeders), '
-                               'Leechers=VALUES(Leechers), '
-                               'Snatched = Snatched + VALUES(Snatched), '
-                               'Balance=VALUES(Balance), '
-                               'last_action=IF(VALUES(Seeders) > 0, NOW(), last_action)',
-                               self.torrent_queue[0])
-            cursor.execute("DELETE FROM torrents WHERE info_hash = ''")
-            cursor.close()
-            with self.torrent_lock:
-                self.torrent_queue.pop(0)
-        self.t_active = False
+    def adopt(self, batches: List[Tuple[str, list, float]]):
+        """
+        Queue up the batches the process we took over from handed us
+        """
+        queues = {queue.name: queue for queue in self.queues}
+        for name, rows, queued_at in batches:
+            queue = queues[name]
+            # peer rows are never spooled, see _queue_peers
+            seq = 0 if queue is self.peer_queue else self._unspooled()
+            with queue.lock:
+                queue.batches.append((seq, rows, queued_at))
+
+    def _unspooled(self):
+        return 0 if self.spool is None else UNSPOOLED
+
+    def _spool_queued(self):
+        """
+        Write the batches queued since the last round to the spool and sync it, before any of
+        them is written to the database. Runs on the flush thread.
+        """
+        if self.spool is None:
+            return
+        for queue in self.queues:
+            with queue.lock:
+                for i, (seq, rows, queued_at) in enumerate(queue.batches):
+                    if seq == UNSPOOLED:
+                        queue.batches[i] = (self.spool.append(queue.name, rows), rows,
+                                            queued_at)
+        self.spool.sync()
+
+    def _confirm(self, seq):
+        if self.spool is not None and seq > 0:
+            self.spool.confirm(seq)
+
+    def _replay_spool(self, reset_counts):
+        """
+        Queue up whatever the spool says never made it into the database. Every batch is
+        committed together with its sequence number in margay_spool, and a queue writes its
+        batches in the order they were spooled, so the ones at or below the sequence number
+        of their queue were committed before we died and skipped, which keeps the user deltas
+        from being credited twice. If the peer counts were just reset by _clear_peer_data we
+        don't replay stale ones, only the deltas.
+        """
+        watermarks = self._load_watermarks()
+        queues = {queue.name: queue for queue in self.queues}
+        now = time()
+        committed = 0
+        for seq, category, rows in self.spool.open(max(watermarks.values(), default=0)):
+            if seq <= watermarks.get(category, 0):
+                committed += 1
+                self.spool.confirm(seq)
+                continue
+            if category == 'torrents' and reset_counts:
+                rows = [(row[0], 0, 0, row[3], row[4]) for row in rows]
+            queues[category].batches.append((seq, rows, now))
+        if committed > 0:
+            self.logger.info(f'Skipped {committed} spooled batches the database already has')
+
+    def _load_watermarks(self) -> Dict[str, int]:
+        """
+        :return: the sequence number of the last batch committed, by queue
+        """
+        cursor = self.db.cursor()
+        cursor.execute('SELECT category, seq FROM margay_spool')
+        watermarks = {row[0]: row[1] for row in cursor.fetchall()}
+        cursor.close()
+        return watermarks
 
-    def _flush_snatches(self):
+    def _queue(self, queue: FlushQueue, buffer):
         if self.readonly:
-            self.snatch_buffer.clear()
+            buffer.clear()
             return
 
-        with self.snatch_lock:
-            if len(self.snatch_queue) > 0:
-                self.logger.info(f'Snatch flush queue size: {len(self.snatch_queue)}, '
-                                 f'next query length: {len(str(self.snatch_queue[0]))}')
-            if len(self.snatch_buffer) == 0:
-                return
-            self.snatch_queue.extend(copy(self.snatch_buffer))
-            self.snatch_buffer.clear()
-        if not self.s_active:
-            threading.Thread(target=self._do_flush_snatches).start()
-
-    def _do_flush_snatches(self):
-        self.s_active = True
-        conn = self.get_connection()
-        while len(self.snatch_queue) > 0:
-            cursor = conn.cursor()
-            cursor.executemany('INSERT INTO xbt_snatched (uid, fid, tstamp, IP) '
-                               'VALUES (%s, %s, %s, %s)', self.snatch_queue[0])
-
-            cursor.close()
-            with self.snatch_lock:
-                self.snatch_queue.pop(0)
-        self.s_active = False
+        with queue.lock:
+            if len(buffer) > 0:
+                rows = copy(buffer)
+                buffer.clear()
+                queue.batches.append((self._unspooled(), rows, time()))
+            self._log_lag(queue)
 
-    def _flush_peers(self):
+    def _queue_peers(self):
+        # Peer rows are not spooled, xbt_files_users is truncated on startup anyway
         if self.readonly:
             self.heavy_peer_buffer.clear()
             self.light_peer_buffer.clear()
             return
 
-        with self.peer_lock:
-            if len(self.peer_queue) > 0:
-                self.logger.info(f'Heavy peer queue size: {len(self.peer_queue)}, '
-                                 f'next query length: {len(str(self.peer_queue[0]))}')
+        queue = self.peer_queue
+        with queue.lock:
+            now = time()
+            self.unmerged_peers += len(self.heavy_peer_buffer) + len(self.light_peer_buffer)
             if len(self.heavy_peer_buffer) > 0:
-                if len(self.peer_queue) > 1000:
-                    self.peer_queue.pop(0)
-                self.peer_queue.extend(copy(self.heavy_peer_buffer))
+                queue.batches.append((0, copy(self.heavy_peer_buffer), now))
                 self.heavy_peer_buffer.clear()
             if len(self.light_peer_buffer) > 0:
-                if len(self.peer_queue) > 1000:
-                    self.peer_queue.pop(0)
-                self.peer_queue.extend(copy(self.light_peer_buffer))
+                queue.batches.append((0, copy(self.light_peer_buffer), now))
                 self.light_peer_buffer.clear()
-        if not self.p_active:
-            threading.Thread(target=self._do_flush_peers).start()
-
-    def _do_flush_peers(self):
-        self.p_active = True
-        conn = self.get_connection()
-
-        while len(self.peer_queue) > 0:
-            cursor = conn.cursor()
-            if len(self.peer_queue[0]) == 4:
-                cursor.executemany('INSERT INTO xbt_files_users (uid, fid, timespent, '
-                                   'announced, peer_id, mtime) '
-                                   'VALUES (%s, %s, %s, %s, %s, %s) '
-                                   'ON DUPLICATE KEY UPDATE upspeed=0, downspeed=0, '
-                                   'timespent=VALUES(timespent), announced=VALUES(announced), '
-                                   'mtime=VALUES(mtime)', self.peer_queue[0])
+            if queue.rows() > self.max_peer_backlog and \
+                    self.unmerged_peers >= self.max_peer_backlog // MERGE_FRACTION:
+                start = perf_counter()
+                self._merge_peers(queue)
+                self.unmerged_peers = 0
+                summary.info('Merged the peer flush queue {:,} times',
+                             f'{queue.rows()} rows left, took '
+                             f'{(perf_counter() - start) * 1000:.0f}ms')
+            # newest first, so light rows go before the heavy rows they update and no light row
+            # is left to insert a peer whose heavy row was dropped. The flush thread may be
+            # writing the first batch.
+            while queue.rows() > self.max_peer_backlog and len(queue.batches) > 1:
+                _, rows, _ = queue.batches.pop()
+                queue.dropped += len(rows)
+            self._log_lag(queue)
+
+    # noinspection PyMethodMayBeStatic
+    def _merge_peers(self, queue: FlushQueue):
+        """
+        Fold every queued peer batch but the first, which may be being written, into one heavy
+        and one light batch that only keep the latest row of each peer. A light row older than
+        the peer's heavy row has nothing left to add, newer ones go out after the heavy batch.
+        """
+        heavy = dict()
+        light = dict()
+        count = 0
+        for _, rows, _ in queue.batches[1:]:
+            count += len(rows)
+            if len(rows[0]) == 6:
+                for row in rows:
+                    light[(row[0], row[1], row[4])] = row
             else:
-                cursor.executemany('INSERT INTO xbt_files_users (uid, fid, active, uploaded, '
-                                   'downloaded, upspeed, downspeed, remaining, corrupt, '
-                                   'timespent, announced, ip, peer_id, useragent, mtime) '
-                                   'VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,'
-                                   ' %s, %s) ON DUPLICATE KEY UPDATE active=VALUES(active), '
-                                   'uploaded=VALUES(uploaded), downloaded=VALUES(downloaded), '
-                                   'upspeed=VALUES(upspeed), downspeed=VALUES(downspeed), '
-                                   'remaining=VALUES(remaining), corrupt=VALUES(corrupt), '
-                                   'timespent=VALUES(timespent), announced=VALUES(announced), '
-                                   'mtime=VALUES(mtime)', self.peer_queue[0])
-            cursor.close()
-            with self.peer_lock:
-                self.peer_queue.pop(0)
-        self.p_active = False
+                for row in rows:
+                    heavy[(row[0], row[1], row[12])] = row
+        for key, row in heavy.items():
+            newer = light.get(key)
+            if newer is not None and newer[5] <= row[14]:
+                del light[key]
+        now = time()
+        queued_at = queue.batches[1][2] if len(queue.batches) > 1 else now
+        batches = queue.batches[:1]
+        if len(heavy) > 0:
+            batches.append((0, list(heavy.values()), queued_at))
+        if len(light) > 0:
+            batches.append((0, list(light.values()), queued_at))
+        queue.merged += count - len(heavy) - len(light)
+        queue.batches[:] = batches
+
+    def _log_lag(self, queue: FlushQueue):
+        if len(queue.batches) > 1:
+            summary.info(f'{queue.name.capitalize()} flush queue was behind {{:,}} times',
+                         f'{len(queue.batches)} batches, {queue.rows()} rows, '
+                         f'{queue.lag(time()):.1f}s behind')
+
+    def _do_flush(self):
+        """
+        Write out the queues in priority order. Every round each queue gets to write at least
+        one batch and then keeps going until it has used up its budget, so user credit and
+        tokens never wait for more than a round's worth of torrent and peer rows, and whatever
+        was queued while the lower priorities were being written goes out first next round.
+        """
+        conn = None
+        # set once the queues are empty, from then on another flush thread may be running
+        finished = False
+        try:
+            conn = self.get_connection()
+            writer = self.get_writer(conn)
+            while True:
+                self._spool_queued()
+                for queue in self.queues:
+                    self._write_queue(conn, writer, queue)
+                with self.flush_lock:
+                    if all(len(queue.batches) == 0 for queue in self.queues):
+                        self.flush_active = False
+                        finished = True
+                        break
+            if self.spool is not None:
+                # the confirmations of the last round
+                self.spool.sync()
+        except self.errors:
+            # whatever wasn't committed stays queued for the next flush
+            self.logger.exception('Flush failed')
+        except Exception:
+            # a bug rather than the database going away, but the next flush still gets to try
+            self.logger.exception('Flush failed unexpectedly')
+        finally:
+            if not finished:
+                with self.flush_lock:
+                    self.flush_active = False
+            if conn is not None:
+                try:
+                    conn.close()
+                except self.errors:
+                    pass
+
+    def _write_queue(self, conn, writer, queue: FlushQueue):
+        written = 0
+        while len(queue.batches) > 0 and (queue.budget <= 0 or written < queue.budget):
+            seq, rows, queued_at = queue.batches[0]
+            if seq == UNSPOOLED:
+                # queued during this round, it's spooled at the start of the next one
+                break
+            queue.write(conn, writer, rows)
+            if seq > 0:
+                # in the same transaction as the rows, see _replay_spool
+                self._write_watermark(conn, queue.name, seq)
+            conn.commit()
+            self._confirm(seq)
+            with queue.lock:
+                queue.batches.pop(0)
+            written += len(rows)
+            queue.written += len(rows)
+            queue.max_lag = max(queue.max_lag, time() - queued_at)
+
+    def _write_users(self, conn, writer, rows):
+        raise NotImplementedError
+
+    def _write_tokens(self, conn, writer, rows):
+        raise NotImplementedError
+
+    def _write_snatches(self, conn, writer, rows):
+        raise NotImplementedError
+
+    def _write_torrents(self, conn, writer, rows):
+        raise NotImplementedError
+
+    def _write_peers(self, conn, writer, rows):
+        raise NotImplementedError
+
+    def _write_watermark(self, conn, category, seq):
+        raise NotImplementedError
 
-    def _flush_tokens(self):
-        if self.readonly:
-            self.token_buffer.clear()
-            return
+    def _clear_peer_data(self):
+        raise NotImplementedError
 
-        with self.token_lock:
-            if len(self.token_queue) > 0:
-                self.logger.info(f'Token flush queue size: {len(self.token_queue)}, '
-                                 f'next query length: {len(str(self.token_queue[0]))}')
 
-            if len(self.token_buffer) == 0:
-                return
-            self.token_queue.extend(copy(self.token_buffer))
-            self.token_buffer.clear()
-            if not self.tok_active:
-                threading.Thread(target=self._do_flush_tokens).start()
-
-    def _do_flush_tokens(self):
-        self.tok_active = True
-        conn = self.get_connection()
-        while len(self.token_queue) > 0:
-            cursor = conn.cursor()
-            cursor.executemany('INSERT INTO users_freeleeches (UserID, TorrentID, Downloaded) '
-                               'VALUES(%s, %s, %s)', self.token_queue[0])
-            cursor.close()
-            with self.token_lock:
-                self.token_queue.pop(0)
-        self.tok_active = False
+class NullConnection(object):
+    """
+    A DB-API connection to nothing, every query returns no rows
+    """
+    rowcount = 0
+
+    def cursor(self):
+        return self
+
+    def execute(self, query, args=None):
+        pass
+
+    def executemany(self, query, args):
+        pass
+
+    # noinspection PyMethodMayBeStatic
+    def fetchall(self):
+        return []
+
+    # noinspection PyMethodMayBeStatic
+    def fetchone(self):
+        return None
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+    def query(self, query):
+        pass
+
+
+class NullDatabase(Database):
+    """
+    Loads nothing and throws away whatever is flushed, which still goes through the buffers,
+    queues, spool and flush thread like it would for a real database. For running the tracker
+    without a database, to load test or profile it.
+    """
+    def get_connection(self):
+        return NullConnection()
+
+    def _discard(self, conn, writer, rows):
+        pass
+
+    _write_users = _write_tokens = _write_snatches = _write_torrents = _write_peers = _discard
+
+    def _write_watermark(self, conn, category, seq):
+        pass
 
     def _clear_peer_data(self):
-        self.db.query('TRUNCATE xbt_files_users')
-        self.db.query('UPDATE torrents SET Seeders = 0, Leechers = 0')
+        pass
+
+
+def open_database(config, spool=None, clear_peers=True, readonly=False) -> Database:
+    """
+    Connect to the backend configured in database.backend, which is mysql, sqlite or null.
+    It's readonly when debug.readonly is set, whatever readonly says.
+    """
+    backend = config['database']['backend']
+    readonly = readonly or config['debug']['readonly']
+    if backend == 'mysql':
+        from .mysql import MySQLDatabase
+        return MySQLDatabase(config['mysql'], config['flush'], readonly, spool, clear_peers)
+    elif backend == 'sqlite':
+        from .sqlite import SQLiteDatabase
+        return SQLiteDatabase(config['sqlite'], config['flush'], readonly, spool, clear_peers)
+    elif backend == 'null':
+        return NullDatabase(dict(), config['flush'], readonly, spool, clear_peers)
+    raise ValueError(f'Unknown database backend {backend}')
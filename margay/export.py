@@ -0,0 +1,222 @@
+from array import array
+import asyncio
+import json
+import logging
+import os
+import struct
+import sys
+import threading
+from time import perf_counter, time
+from typing import Dict, List, Tuple
+
+MAGIC = b'MGYSWRM1'
+HEADER_LENGTH = struct.Struct('<I')
+# Numeric columns and their array type codes
+COLUMNS = (('torrent_id', 'q'), ('user_id', 'q'), ('seeder', 'B'), ('left', 'q'),
+           ('uploaded', 'q'), ('downloaded', 'q'), ('corrupt', 'q'), ('first_announced', 'q'),
+           ('last_announced', 'q'), ('announces', 'q'), ('port', 'H'))
+# Fixed width byte string columns and their width, the IP is empty for protected users just
+# like in xbt_files_users
+BYTE_COLUMNS = (('ip', 4), ('peer_id', 20))
+ALIGNMENT = 8
+# What the 'H' and 'q' columns hold, larger values are clamped so they can't fail an export
+MAX_PORT = 0xffff
+MAX_COUNTER = 2 ** 63 - 1
+
+
+def _pad(length) -> bytes:
+    return bytes(-length % ALIGNMENT)
+
+
+def read_swarms(path) -> Tuple[dict, Dict[str, object]]:
+    """
+    Read a snapshot written by SwarmExporter
+
+    :return: the header and every column, numeric ones as arrays and byte string ones as
+             lists of bytes
+    """
+    with open(path, 'rb') as snapshot:
+        data = snapshot.read()
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError(f'{path} is not a swarm snapshot')
+    length = HEADER_LENGTH.unpack_from(data, len(MAGIC))[0]
+    start = len(MAGIC) + HEADER_LENGTH.size
+    header = json.loads(data[start:start + length])
+    start += length + len(_pad(start + length))
+    columns = dict()
+    for column in header['columns']:
+        blob = data[start + column['offset']:start + column['offset'] + column['length']]
+        if column['type'].endswith('s'):
+            width = int(column['type'][:-1])
+            columns[column['name']] = [blob[i:i + width] for i in range(0, len(blob), width)]
+        else:
+            values = array(column['type'], blob)
+            if sys.byteorder == 'big':
+                values.byteswap()
+            columns[column['name']] = values
+    return header, columns
+
+
+class SwarmExporter(object):
+    """
+    Periodically writes every peer of every swarm to a columnar file, so analytics can
+    aggregate over the live swarms without going through xbt_files_users.
+
+    The file is MAGIC, the length of a JSON header and the header, which has the time the
+    snapshot was taken, the number of rows and the name, type (an array type code, or Ns for
+    N byte strings), offset and length of every column. The columns follow, each starting
+    at a multiple of 8 bytes, with offsets counted from the first one. Numbers are little
+    endian. read_swarms reads it back.
+
+    The peers are collected on the loop about chunk at a time (swarms aren't split), in
+    between requests, and written out by a thread to a temporary file that replaces the
+    previous snapshot once it's complete. Each swarm is consistent, the snapshot as a whole
+    spans however long collecting it took.
+    """
+    def __init__(self, worker, config):
+        self.logger = logging.getLogger()
+        self.worker = worker
+        self.loop = None
+        export = config['export']
+        self.path = export['path']
+        self.chunk = max(1, export['chunk'])
+
+        self.active = False
+        self.exports = 0
+        self.skipped = 0
+        self.failures = 0
+        self.last_rows = 0
+        self.last_taken = 0
+        self.collect_time = 0.0  # milliseconds spent on the loop by the last export
+        self.max_step = 0.0
+        self.write_time = 0.0
+
+    def export(self):
+        """
+        Start an export, unless the last one is still going. Has to run on the loop.
+        """
+        if self.active:
+            self.skipped += 1
+            return
+        self.loop = asyncio.get_event_loop()
+        self.active = True
+        self.collect_time = 0.0
+        self.max_step = 0.0
+        columns = {name: array(code) for name, code in COLUMNS}
+        columns.update({name: bytearray() for name, _ in BYTE_COLUMNS})
+        self.loop.call_soon(self._collect, list(self.worker.torrents.swarms), 0, columns,
+                            int(time()))
+
+    def _collect(self, info_hashes: List[str], position, columns, taken_at):
+        start = perf_counter()
+        try:
+            position = self._collect_chunk(info_hashes, position, columns)
+            if position < len(info_hashes):
+                self.loop.call_soon(self._collect, info_hashes, position, columns, taken_at)
+            else:
+                threading.Thread(target=self._write, args=(columns, taken_at)).start()
+        except Exception:
+            # nothing else would end the export, and every later one would be skipped
+            self.failures += 1
+            self.active = False
+            self.logger.exception('Collecting the swarms for an export failed')
+        finally:
+            step = (perf_counter() - start) * 1000
+            self.collect_time += step
+            self.max_step = max(self.max_step, step)
+
+    def _collect_chunk(self, info_hashes: List[str], position, columns) -> int:
+        """
+        Append the peers of about chunk peers' worth of swarms to the columns
+
+        :return: the position of the first swarm left
+        """
+        swarms = self.worker.torrents.swarms
+        users = self.worker.users
+        torrent_ids = columns['torrent_id']
+        user_ids = columns['user_id']
+        seeders = columns['seeder']
+        lefts = columns['left']
+        uploaded = columns['uploaded']
+        downloaded = columns['downloaded']
+        corrupt = columns['corrupt']
+        first_announced = columns['first_announced']
+        last_announced = columns['last_announced']
+        announces = columns['announces']
+        ports = columns['port']
+        ips = columns['ip']
+        peer_ids = columns['peer_id']
+        count = 0
+        while position < len(info_hashes) and count < self.chunk:
+            info_hash = info_hashes[position]
+            position += 1
+            tor = swarms.get(info_hash)
+            if tor is None:
+                continue
+            count += len(tor.seeders) + len(tor.leechers)
+            for peers, seeder in ((tor.seeders, 1), (tor.leechers, 0)):
+                for peer_key, peer in peers.items():
+                    torrent_ids.append(tor.id)
+                    user_ids.append(users.ids[peer.user])
+                    seeders.append(seeder)
+                    lefts.append(min(peer.left, MAX_COUNTER))
+                    uploaded.append(min(peer.uploaded, MAX_COUNTER))
+                    downloaded.append(min(peer.downloaded, MAX_COUNTER))
+                    corrupt.append(min(peer.corrupt, MAX_COUNTER))
+                    first_announced.append(peer.first_announced or 0)
+                    last_announced.append(peer.last_announced or 0)
+                    announces.append(peer.announces)
+                    ports.append(min(peer.port or 0, MAX_PORT))
+                    ip = b'' if users.protect[peer.user] else peer.ip
+                    ips += ip[:4].ljust(4, b'\0')
+                    # the peer key ends with the peer id
+                    peer_ids += peer_key[-20:].encode('latin-1').ljust(20, b'\0')
+        return position
+
+    def _write(self, columns, taken_at):
+        start = perf_counter()
+        rows = len(columns['torrent_id'])
+        blobs = []
+        described = []
+        offset = 0
+        for name, code in COLUMNS:
+            values = columns[name]
+            if sys.byteorder == 'big':
+                values.byteswap()
+            blob = values.tobytes()
+            described.append({'name': name, 'type': code, 'offset': offset,
+                              'length': len(blob)})
+            blobs.append(blob)
+            offset += len(blob) + len(_pad(len(blob)))
+        for name, width in BYTE_COLUMNS:
+            blob = bytes(columns[name])
+            described.append({'name': name, 'type': f'{width}s', 'offset': offset,
+                              'length': len(blob)})
+            blobs.append(blob)
+            offset += len(blob) + len(_pad(len(blob)))
+        header = json.dumps({'taken_at': taken_at, 'rows': rows,
+                             'columns': described}).encode()
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as snapshot:
+                snapshot.write(MAGIC + HEADER_LENGTH.pack(len(header)) + header)
+                snapshot.write(_pad(len(MAGIC) + HEADER_LENGTH.size + len(header)))
+                for blob in blobs:
+                    snapshot.write(blob)
+                    snapshot.write(_pad(len(blob)))
+            os.rename(tmp_path, self.path)
+            self.exports += 1
+            self.last_rows = rows
+            self.last_taken = taken_at
+        except OSError as e:
+            self.logger.error(f'Exporting the swarms to {self.path} failed: {e}')
+        finally:
+            self.write_time = (perf_counter() - start) * 1000
+            self.active = False
+
+    def report(self) -> str:
+        return f"{self.exports} exports to {self.path}, {self.skipped} skipped while one " \
+               f"was running, {self.failures} failed collecting\n" \
+               f"last: {self.last_rows} peers taken at {self.last_taken}, " \
+               f"{self.collect_time:.3f}ms on the loop (longest step {self.max_step:.3f}ms), " \
+               f"{self.write_time:.3f}ms writing\n"
@@ -0,0 +1,229 @@
+from array import array
+import asyncio
+import json
+import logging
+import os
+import pickle
+import socket
+import struct
+import subprocess
+import sys
+from typing import List, Tuple
+
+import margay.stats as stats
+
+# Set for a process that was started by an upgrade, to the path of the socket the old process
+# is waiting for it on
+HANDOFF_ENV = 'MARGAY_HANDOFF'
+# Length of the description of the listening sockets, sent along with their descriptors
+HEADER = struct.Struct('<I')
+# Most listening sockets handed over at once
+MAX_FDS = 16
+# Sent back by the new process once it's serving
+READY = b'R'
+
+
+def _descriptors(worker) -> Tuple[List[str], List[int]]:
+    kinds = []
+    fds = []
+    for kind, server in worker.listeners:
+        if kind == 'udp':
+            sockets = [server.get_extra_info('socket')]
+        else:
+            sockets = server.sockets
+        for sock in sockets:
+            kinds.append(kind)
+            fds.append(sock.fileno())
+    return kinds, fds
+
+
+class Upgrade(object):
+    """
+    Replaces this process with a new one running whatever is installed now, without the port
+    ever closing. A new process is started with the same command line and connects back to us
+    on a UNIX socket, once it has read its config. Then:
+
+    1. The schedule is stopped and we wait for the flush that's running, if any, so nothing is
+       in flight to the database.
+    2. The listening sockets are passed to it with SCM_RIGHTS.
+    3. Without giving the loop a chance to serve anything, we send the catalogs, the stats that
+       go with them and the rows waiting to be written, then stop serving and close our copies
+       of the sockets. Rows that are in the spool are left there for the new process to
+       replay, so the spool is closed first. Connections that come in from here on wait in the
+       kernel's backlog until the new process accepts them.
+    4. Once the new process says it's serving we exit.
+
+    If anything goes wrong until the state is sent the new process is killed and we carry on
+    serving: the sockets are still open and the database takes the rows back. Once it's sent
+    the new process is the one serving, if it never says so we exit anyway.
+    """
+    def __init__(self, worker, config):
+        self.logger = logging.getLogger()
+        self.worker = worker
+        self.config = config
+        self.path = config['upgrade']['path']
+        self.timeout = config['upgrade']['timeout']
+        self.process = None  # type: subprocess.Popen
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.path)
+        listener.listen(1)
+        listener.setblocking(False)
+        conn = None
+        try:
+            command = getattr(sys, 'orig_argv', [sys.executable] + sys.argv)
+            self.process = subprocess.Popen(command, env=dict(os.environ,
+                                                              **{HANDOFF_ENV: self.path}))
+            self.logger.info(f'Upgrading, started {" ".join(command)} as {self.process.pid}')
+            conn, _ = await asyncio.wait_for(loop.sock_accept(listener), self.timeout)
+            if not await self._quiesce():
+                raise asyncio.TimeoutError
+            kinds, fds = _descriptors(self.worker)
+            description = json.dumps(kinds).encode()
+            conn.setblocking(True)
+            conn.settimeout(self.timeout)
+            conn.sendmsg([HEADER.pack(len(description)) + description],
+                         [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array('i', fds))])
+        except (OSError, asyncio.TimeoutError) as e:
+            self.logger.error(f'Upgrade failed, carrying on: {e or "timed out"}')
+            if self.process is not None and self.process.poll() is None:
+                self.process.kill()
+            if conn is not None:
+                conn.close()
+            self.worker.schedule.start(loop)
+            return
+        finally:
+            listener.close()
+            os.remove(self.path)
+
+        if not self._hand_over(conn):
+            self.process.kill()
+            conn.close()
+            self.worker.schedule.start(loop)
+            return
+        try:
+            conn.setblocking(False)
+            ready = await asyncio.wait_for(loop.sock_recv(conn, 1), self.timeout)
+        except (OSError, asyncio.TimeoutError):
+            ready = b''
+        conn.close()
+        if ready == READY:
+            self.logger.info(f'Process {self.process.pid} took over, exiting')
+        else:
+            self.logger.error(f'Process {self.process.pid} never said it took over, exiting '
+                              f'anyway')
+        loop.stop()
+
+    async def _quiesce(self) -> bool:
+        """
+        Stop the schedule and wait for the running flush to finish
+        """
+        self.worker.schedule.cancel()
+        waited = 0.0
+        while self.worker.database.flush_active:
+            if waited >= self.timeout:
+                return False
+            await asyncio.sleep(0.1)
+            waited += 0.1
+        return True
+
+    def _hand_over(self, conn) -> bool:
+        """
+        Runs without giving the loop a chance to serve anything, from collecting the state
+        until we stopped serving
+
+        :return: whether the new process got the state, if not we're still serving
+        """
+        worker = self.worker
+        database = worker.database
+        publisher = worker.publisher
+        if publisher is not None and publisher.server is not None:
+            # the new process listens on the publisher's port itself, it has to be free by then
+            publisher.server.close()
+        readonly = database.readonly
+        spool = database.spool
+        smoother = worker.smoother
+        state = {
+            'torrents': worker.torrents,
+            'users': worker.users,
+            'del_reasons': worker.del_reasons,
+            'smoothing': (smoother.booked, smoother.arrivals, smoother.total, smoother.now),
+            'seeders': stats.seeders,
+            'leechers': stats.leechers,
+            'batches': database.handoff()
+        }
+        try:
+            with conn.makefile('wb') as stream:
+                pickle.dump(state, stream, pickle.HIGHEST_PROTOCOL)
+        except OSError:
+            self.logger.exception('Sending the state to the new process failed, carrying on')
+            database.resume(readonly, spool, state['batches'])
+            if publisher is not None:
+                publisher.server = None
+                asyncio.get_event_loop().create_task(self._listen(publisher))
+            return False
+        worker.stop_serving()
+        self.logger.info(f'Handed over {len(worker.torrents)} torrents with '
+                         f'{len(worker.torrents.swarms)} swarms, {len(worker.users)} users and '
+                         f'{sum(len(batch[1]) for batch in state["batches"])} unflushed rows')
+        return True
+
+    async def _listen(self, publisher):
+        try:
+            publisher.server = await publisher.listen()
+        except OSError as e:
+            self.logger.error(f'Could not publish swarm deltas again, standbys stay away until '
+                              f'a restart: {e}')
+
+
+class Takeover(object):
+    """
+    The new process's side of an Upgrade. The state is received before the database is
+    connected to, so the spool is closed by the time it's opened again.
+    """
+    def __init__(self, path, timeout):
+        self.logger = logging.getLogger()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(path)
+        self.listeners = []  # type: List[Tuple[str, socket.socket]]
+        self.state = dict()
+
+    def receive(self):
+        fds = array('i')
+        data, ancillary, _, _ = self.sock.recvmsg(
+            HEADER.size, socket.CMSG_SPACE(MAX_FDS * fds.itemsize))
+        for level, kind, payload in ancillary:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(payload[:len(payload) - len(payload) % fds.itemsize])
+        with self.sock.makefile('rb') as stream:
+            if len(data) < HEADER.size:
+                data += stream.read(HEADER.size - len(data))
+            kinds = json.loads(stream.read(HEADER.unpack(data)[0]))
+            for kind, fd in zip(kinds, fds):
+                self.listeners.append((kind, socket.socket(fileno=fd)))
+            self.state = pickle.load(stream)
+        self.logger.info(f'Took over {len(self.listeners)} listening sockets, '
+                         f'{len(self.state["torrents"])} torrents and '
+                         f'{len(self.state["users"])} users')
+
+    def restore(self, worker):
+        worker.torrents = self.state['torrents']
+        worker.users = self.state['users']
+        worker.del_reasons = self.state['del_reasons']
+        smoother = worker.smoother
+        smoother.booked, smoother.arrivals, smoother.total, smoother.now = \
+            self.state['smoothing']
+        stats.seeders = self.state['seeders']
+        stats.leechers = self.state['leechers']
+
+    def ready(self):
+        try:
+            self.sock.sendall(READY)
+        except OSError as e:
+            self.logger.warning(f'Could not tell the old process we took over: {e}')
+        self.sock.close()
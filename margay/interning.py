@@ -0,0 +1,28 @@
+class InternTable(object):
+    """
+    Bounded string interning. There are only a few hundred distinct user agents and peer id
+    client prefixes out there, so handing out one shared copy saves an allocation per announce
+    and per buffered row. Once the table is full new values are passed through untouched so
+    that a misbehaving client can't grow it without bound.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.table = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.table)
+
+    def intern(self, value):
+        interned = self.table.get(value)
+        if interned is not None:
+            self.hits += 1
+            return interned
+        self.misses += 1
+        if len(self.table) < self.max_size:
+            self.table[value] = value
+        return value
+
+    def clear(self):
+        self.table.clear()
@@ -0,0 +1,102 @@
+import logging
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+import queue
+import sys
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import margay.stats as stats
+
+FORMAT = "%(asctime)s [%(levelname)-5.5s]  %(message)s"
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Hands records to the writer thread without ever waiting for it. A record that doesn't fit
+    in the queue is dropped and counted, so a slow disk can't hold up the loop.
+    """
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            stats.log_dropped += 1
+
+
+def start_logging(config) -> Optional[QueueListener]:
+    """
+    Set up the root logger to write to the configured handlers from a background thread
+
+    :return: the listener that runs the thread, to be stopped on exit so the queue is written
+             out
+    """
+    settings = config['logging']
+    logger = logging.getLogger()
+    while logger.handlers:
+        logger.handlers.pop()
+    logger.setLevel(settings['log_level'])
+    if not settings['log']:
+        logger.addHandler(logging.NullHandler())
+        return None
+
+    log_format = logging.Formatter(FORMAT)
+    handlers = []
+    if settings['log_file']:
+        file_logger = TimedRotatingFileHandler(settings['log_path'], when='d', backupCount=5)
+        file_logger.setFormatter(log_format)
+        file_logger.setLevel(settings['log_level'])
+        handlers.append(file_logger)
+    if settings['log_console']:
+        console_logger = logging.StreamHandler(sys.stdout)
+        console_logger.setFormatter(log_format)
+        console_logger.setLevel(settings['log_level'])
+        handlers.append(console_logger)
+    listener = QueueListener(queue.Queue(max(1, settings['max_queue'])), *handlers,
+                             respect_handler_level=True)
+    logger.addHandler(DroppingQueueHandler(listener.queue))
+    listener.start()
+    return listener
+
+
+class LogSummary(object):
+    """
+    Collects the messages of things that can happen thousands of times in a row, like the
+    site removing users or a flush queue falling behind, and logs each of them once per flush
+    with how often it happened and the details of the last time. Messages are format strings
+    that get the count, e.g. 'Removed {:,} users'.
+    """
+    def __init__(self):
+        self.logger = logging.getLogger()
+        self.lock = threading.Lock()
+        self.counts = dict()  # type: Dict[Tuple[int, str], List]
+        self.last_dropped = 0
+
+    def add(self, level, message, detail='', count=1):
+        with self.lock:
+            entry = self.counts.get((level, message))
+            if entry is None:
+                self.counts[(level, message)] = [count, detail]
+            else:
+                entry[0] += count
+                entry[1] = detail
+        stats.log_summarized += 1
+
+    def info(self, message, detail='', count=1):
+        self.add(logging.INFO, message, detail, count)
+
+    def warning(self, message, detail='', count=1):
+        self.add(logging.WARNING, message, detail, count)
+
+    def flush(self):
+        with self.lock:
+            counts = self.counts
+            self.counts = dict()
+        for (level, message), (count, detail) in counts.items():
+            last = f', last {detail}' if detail != '' else ''
+            self.logger.log(level, message.format(count) + last)
+        dropped = stats.log_dropped - self.last_dropped
+        if dropped > 0:
+            self.last_dropped = stats.log_dropped
+            self.logger.warning(f'Dropped {dropped:,} log records, the log writer fell behind')
+
+
+summary = LogSummary()
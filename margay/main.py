@@ -1,15 +1,17 @@
 from argparse import ArgumentParser
 import logging
-from logging.handlers import TimedRotatingFileHandler
+import os
 import signal
-import sys
 import threading
+import tracemalloc
 
 from . import __version__
 from .config import Config
-from .database import Database
+from .database import open_database
+from .handoff import HANDOFF_ENV, Takeover
+from .logs import start_logging, summary
 from .site_comm import SiteComm
-from .schedule import Schedule
+from .spool import Spool
 from .worker import Worker
 
 
@@ -21,32 +23,30 @@ def run():
     args = parser.parse_args()
     config = Config(args.config, args.daemonize)
 
-    logger = logging.getLogger()
-    while logger.handlers:
-        logger.handlers.pop()
-    log_format = logging.Formatter("%(asctime)s [%(levelname)-5.5s]  %(message)s")
-    if config['logging']['log']:
-        if config['logging']['log_file']:
-            file_logger = TimedRotatingFileHandler(config['logging']['log_path'], when='d',
-                                                   backupCount=5)
-            file_logger.setFormatter(log_format)
-            file_logger.setLevel(config['logging']['log_level'])
-            #logger.addHandler(file_logger)
-        if config['logging']['log_console']:
-            console_logger = logging.StreamHandler(sys.stdout)
-            console_logger.setFormatter(log_format)
-            console_logger.setLevel(config['logging']['log_level'])
-            logger.addHandler(console_logger)
-    else:
-        logger.addHandler(logging.NullHandler())
-    logger.setLevel(config['logging']['log_level'])
+    listener = start_logging(config)
 
-    database = Database(config['mysql'], config['debug']['readonly'])
-    schedule = Schedule(config['timers']['schedule_interval'],
-                        config['timers']['reap_peers_interval'],
-                        database)
+    if config['memory']['tracemalloc_frames'] > 0:
+        tracemalloc.start(config['memory']['tracemalloc_frames'])
+
+    # started by the upgrade of a running tracker, which hands over its sockets and state. It
+    # has to be received before the spool is opened.
+    takeover = None
+    if HANDOFF_ENV in os.environ:
+        takeover = Takeover(os.environ.pop(HANDOFF_ENV), config['upgrade']['timeout'])
+        takeover.receive()
+
+    # a standby leaves the database and the spool to its primary until it takes over, see
+    # Worker.take_over
+    following = config['standby']['primary_host'] != ''
+    spool = None
+    if config['spool']['enabled'] and not config['debug']['readonly'] and not following:
+        spool = Spool(config['spool']['path'], config['spool']['max_size'])
+    database = open_database(config, spool, clear_peers=not following and takeover is None,
+                             readonly=following)
+    if takeover is not None:
+        database.adopt(takeover.state['batches'])
     site_comm = SiteComm(config)
-    worker = Worker(database, site_comm, config)
+    worker = Worker(database, site_comm, config, takeover)
 
     def sig_handler(sig, _):
         print("help")
@@ -62,6 +62,9 @@ def run():
         elif sig == signal.SIGUSR1:
             logger.info('Reloading from database')
             threading.Thread(target=worker.reload_lists)
+        elif sig == signal.SIGUSR2:
+            logger.info('Upgrading')
+            worker.upgrade()
 
     signal.signal(signal.SIGINT, sig_handler)
     signal.signal(signal.SIGTERM, sig_handler)
@@ -72,4 +75,7 @@ def run():
     try:
         worker.create_server(config['internal']['listen_port'])
     finally:
-        schedule.stop()
+        worker.schedule.stop()
+        summary.flush()
+        if listener is not None:
+            listener.stop()
@@ -0,0 +1,110 @@
+from collections import OrderedDict
+import heapq
+import sys
+import tracemalloc
+from typing import Dict, List, Tuple
+
+from .structs import Peer, Torrent
+import margay.stats as stats
+
+# Rough cost of one slot in a dict (hash, key and value pointers plus the slack of the table)
+# and in an OrderedDict, which additionally keeps a linked list node per key
+DICT_ENTRY = 3 * 8 * 3 // 2
+ORDERED_DICT_ENTRY = DICT_ENTRY + 56
+
+
+def _object_size(obj) -> int:
+    return sys.getsizeof(obj) + sys.getsizeof(obj.__dict__)
+
+
+def _row_size(row) -> int:
+    return sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row)
+
+
+class MemoryAccounting(object):
+    """
+    Estimates how much memory each of the long lived structures holds without walking them.
+    The object counts come from counters that are already maintained as things get inserted
+    and removed (the dict lengths and the seeder/leecher stats), and they're multiplied by a
+    per object size that is measured once up front. Flush queues are estimated from the size
+    of their first row.
+    """
+    def __init__(self):
+        # an idle torrent is a slot in the catalog arrays, its info hash and a dict entry
+        self.torrent_size = 8 + 1 + 8 + 8 + sys.getsizeof('x' * 20) + DICT_ENTRY
+        torrent = Torrent(0, 0)
+        self.swarm_size = (_object_size(torrent) + 2 * sys.getsizeof(OrderedDict()) +
+                           sys.getsizeof(torrent.tokened_users) + DICT_ENTRY)
+        # a user is a row in the catalog arrays, its packed passkey, the row number and a dict
+        # entry
+        self.user_size = (8 + 1 + 1 + 4 + 4 + 1 + sys.getsizeof(bytes(16)) +
+                          sys.getsizeof(1 << 20) + DICT_ENTRY)
+        peer = Peer()
+        peer.ip = b'\xff' * 4
+        peer.ip_port = b'x' * 6
+        # peer keys are one character of the peer id, the user id and the peer id, and every
+        # peer also has an (info hash, peer key) entry in its user's set of peers
+        self.peer_size = (_object_size(peer) + sys.getsizeof(peer.ip) +
+                          sys.getsizeof(peer.ip_port) + sys.getsizeof('x' * 28) +
+                          ORDERED_DICT_ENTRY + sys.getsizeof(('x', 'x')) + DICT_ENTRY)
+        self.del_reason_size = (sys.getsizeof({'reason': 0, 'time': 0}) +
+                                sys.getsizeof('x' * 20) + DICT_ENTRY)
+        self.whitelist_size = sys.getsizeof('x' * 8) + 8
+
+    def structures(self, worker) -> List[Tuple[str, int, int]]:
+        """
+        :return: (name, object count, estimated bytes) for every structure we track
+        """
+        peers = stats.seeders + stats.leechers
+        result = [
+            ('torrents', len(worker.torrents), len(worker.torrents) * self.torrent_size),
+            ('swarms', len(worker.torrents.swarms),
+             len(worker.torrents.swarms) * self.swarm_size),
+            ('users', len(worker.users), len(worker.users) * self.user_size),
+            ('peers', peers, peers * self.peer_size),
+            ('del_reasons', len(worker.del_reasons),
+             len(worker.del_reasons) * self.del_reason_size),
+            ('whitelist', len(worker.whitelist), len(worker.whitelist) * self.whitelist_size),
+            ('user_agents', len(worker.user_agents),
+             sum(sys.getsizeof(value) + DICT_ENTRY for value in worker.user_agents.table)),
+            ('clients', len(worker.clients),
+             sum(sys.getsizeof(value) + DICT_ENTRY for value in worker.clients.table))
+        ]
+        database = worker.database
+        for name, buffer in (('user_buffer', database.user_buffer),
+                             ('torrent_buffer', database.torrent_buffer),
+                             ('heavy_peer_buffer', database.heavy_peer_buffer),
+                             ('light_peer_buffer', database.light_peer_buffer),
+                             ('snatch_buffer', database.snatch_buffer),
+                             ('token_buffer', database.token_buffer)):
+            result.append(self._rows(name, list(buffer[:1]), len(buffer)))
+        for queue in database.queues:
+            name = f'{queue.name}_queue'
+            batches = list(queue.batches)
+            rows = sum(len(batch[1]) for batch in batches)
+            sample = batches[0][1][:1] if len(batches) > 0 else []
+            result.append(self._rows(name, sample, rows))
+        return result
+
+    # noinspection PyMethodMayBeStatic
+    def _rows(self, name, sample, count) -> Tuple[str, int, int]:
+        if count == 0 or len(sample) == 0:
+            return name, count, 0
+        return name, count, count * (_row_size(sample[0]) + 8)
+
+    # noinspection PyMethodMayBeStatic
+    def largest_swarms(self, torrents: Dict[str, Torrent], count=20) -> List[Tuple[int, int, int]]:
+        """
+        :return: (torrent id, seeders, leechers) of the largest swarms, largest first
+        """
+        largest = heapq.nlargest(count, torrents.values(),
+                                 key=lambda t: len(t.seeders) + len(t.leechers))
+        return [(t.id, len(t.seeders), len(t.leechers)) for t in largest
+                if len(t.seeders) + len(t.leechers) > 0]
+
+    # noinspection PyMethodMayBeStatic
+    def tracemalloc_top(self, count) -> List[str]:
+        if not tracemalloc.is_tracing():
+            return []
+        snapshot = tracemalloc.take_snapshot()
+        return [str(stat) for stat in snapshot.statistics('lineno')[:count]]
@@ -0,0 +1,153 @@
+import asyncio
+from collections import Counter, deque
+import logging
+import random
+from time import perf_counter
+from typing import Dict
+
+from aiohttp import ClientError, ClientSession, ClientTimeout, TCPConnector
+import bencode
+from yarl import URL
+
+# Latencies kept for the percentiles in the report
+LATENCY_SAMPLES = 1000
+
+
+def _percentile(values, fraction) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] if ordered else 0.0
+
+
+def _shape(response: dict) -> Dict[str, str]:
+    """
+    The keys of a response and the type of their values, which is what a candidate build has
+    to agree with us on. The values themselves depend on the state of each instance.
+    """
+    return {key: type(value).__name__ for key, value in response.items()}
+
+
+class Mirror(object):
+    """
+    Sends a sample of the announces and scrapes we get to a candidate build (which should run
+    with debug.readonly) and compares its responses with ours. The request is only started
+    once our response is ready, it's never waited for, and while max_pending of them are
+    still out more are skipped, so a slow or dead candidate can't hold anything up.
+
+    Responses are compared by shape (keys, value types, failure reason) and the latency of
+    both sides is kept for the report.
+    """
+    def __init__(self, config):
+        self.logger = logging.getLogger()
+        mirror = config['mirror']
+        self.base = f"http://{mirror['host']}:{mirror['port']}"
+        self.sample = mirror['sample'] / 100
+        self.max_pending = max(1, mirror['max_pending'])
+        self.timeout = mirror['timeout'] / 1000
+        self.session = None  # type: ClientSession
+
+        self.pending = 0
+        self.mirrored = 0
+        self.skipped = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.matched = 0
+        self.divergences = Counter()
+        self.examples = dict()  # type: Dict[str, str]
+        self.primary_latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.candidate_latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    def sampled(self) -> bool:
+        return random.random() < self.sample
+
+    def submit(self, passkey, action, query_string, headers, remote_ip, body: bytes,
+               latency: float):
+        """
+        :param body: our response
+        :param latency: how long we took, in seconds
+        """
+        if self.pending >= self.max_pending:
+            self.skipped += 1
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # not being served, like in a replay
+            self.skipped += 1
+            return
+        self.pending += 1
+        forwarded = {
+            'user-agent': headers.get('user-agent', ''),
+            'x-forwarded-for': headers.get('x-forwarded-for', remote_ip)
+        }
+        url = URL(f'{self.base}/{passkey}/{action}?{query_string}', encoded=True)
+        loop.create_task(self._mirror(url, forwarded, action, body, latency))
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+    async def _mirror(self, url, headers, action, expected, latency):
+        try:
+            if self.session is None:
+                self.session = ClientSession(timeout=ClientTimeout(total=self.timeout),
+                                             connector=TCPConnector(limit=self.max_pending))
+            start = perf_counter()
+            async with self.session.get(url, headers=headers) as response:
+                actual = await response.read()
+            candidate_latency = perf_counter() - start
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            return
+        except ClientError as e:
+            self.errors += 1
+            self.logger.debug(f'Mirroring to {self.base} failed: {e}')
+            return
+        finally:
+            self.pending -= 1
+        self.mirrored += 1
+        self.primary_latencies.append(latency)
+        self.candidate_latencies.append(candidate_latency)
+        self._compare(action, expected, actual)
+
+    def _compare(self, action, expected, actual):
+        try:
+            ours = bencode.decode(expected)
+        except Exception:
+            # we answered something that isn't bencoded (like an invalid action) so there's
+            # nothing to compare
+            return
+        try:
+            theirs = bencode.decode(actual)
+        except Exception:
+            self._diverged(action, 'undecodable', actual[:100])
+            return
+        if ours.get('failure reason') != theirs.get('failure reason'):
+            self._diverged(action, 'failure reason', f"{ours.get('failure reason')} != "
+                                                     f"{theirs.get('failure reason')}")
+        elif _shape(ours) != _shape(theirs):
+            self._diverged(action, 'shape', f'{_shape(ours)} != {_shape(theirs)}')
+        else:
+            self.matched += 1
+
+    def _diverged(self, action, kind, example):
+        key = f'{action} {kind}'
+        self.divergences[key] += 1
+        self.examples[key] = str(example)
+
+    def report(self) -> str:
+        output = f"{self.mirrored} mirrored, {self.matched} matched, " \
+                 f"{sum(self.divergences.values())} diverged\n" \
+                 f"{self.skipped} skipped, {self.pending} pending, {self.errors} failed, " \
+                 f"{self.timeouts} timed out\n"
+        for name, latencies in (('primary', self.primary_latencies),
+                                ('candidate', self.candidate_latencies)):
+            output += f"{name} latency: p50 {_percentile(latencies, 0.5) * 1000:.3f}ms, " \
+                      f"p99 {_percentile(latencies, 0.99) * 1000:.3f}ms\n"
+        if len(self.primary_latencies) > 0:
+            delta = (sum(self.candidate_latencies) - sum(self.primary_latencies)) / \
+                    len(self.primary_latencies)
+            output += f"latency delta: {delta * 1000:+.3f}ms on average, the candidate's " \
+                      f"includes the round trip\n"
+        for key, count in self.divergences.most_common():
+            output += f"{key}: {count}, last {self.examples[key]}\n"
+        return output
@@ -0,0 +1,171 @@
+# noinspection PyPackageRequirements
+import MySQLdb
+
+from .bulk import BulkWriter, merge_torrents, merge_users
+from .database import Database, ip_string
+import margay.stats as stats
+
+
+class MySQLDatabase(Database):
+    """
+    The site's MySQL database. The loaders read from a replica instead when one is configured
+    and it's caught up, and the flush threads write with multi-row statements through a
+    BulkWriter, optionally merged through staging tables.
+    """
+    errors = (MySQLdb.Error,)
+
+    def __init__(self, settings, flush, readonly=False, spool=None, clear_peers=True):
+        # the loaders read from the replica when there is one and it's caught up
+        self.replica = None
+        super().__init__(settings, flush, readonly, spool, clear_peers)
+
+    def get_connection(self):
+        return MySQLdb.connect(host=self.settings['host'], user=self.settings['user'],
+                               passwd=self.settings['passwd'], db=self.settings['db'],
+                               port=self.settings['port'])
+
+    def get_replica_connection(self):
+        return MySQLdb.connect(host=self.settings['replica_host'], user=self.settings['user'],
+                               passwd=self.settings['passwd'], db=self.settings['db'],
+                               port=self.settings['replica_port'] or self.settings['port'])
+
+    def reader(self, purpose):
+        """
+        :return: the replica connection if one is configured and it's no further behind than
+                 max_replica_lag seconds, otherwise the primary
+        """
+        if self.settings['replica_host'] == '':
+            return self.db
+        lag = None
+        # a connection that has been idle since the last load may have been closed on us, so
+        # it gets one reconnect
+        for attempt in range(2):
+            try:
+                if self.replica is None:
+                    self.replica = self.get_replica_connection()
+                lag = self._replica_lag()
+                break
+            except MySQLdb.Error as e:
+                if self.replica is not None:
+                    self.replica.close()
+                    self.replica = None
+                if attempt == 1:
+                    self.logger.warning(f'Replica unavailable for {purpose}: {e}')
+        stats.replica_lag = -1 if lag is None else lag
+        if lag is not None and lag <= self.settings['max_replica_lag']:
+            stats.replica_reads += 1
+            self.logger.info(f'Reading {purpose} from the replica ({lag}s behind)')
+            return self.replica
+        stats.replica_fallbacks += 1
+        if lag is not None:
+            self.logger.warning(f'Reading {purpose} from the primary, the replica is {lag}s '
+                                f'behind')
+        elif self.replica is not None:
+            self.logger.warning(f'Reading {purpose} from the primary, the replica isn\'t '
+                                f'replicating')
+        return self.db
+
+    def _replica_lag(self):
+        """
+        :return: Seconds_Behind_Master (Seconds_Behind_Source on newer servers), None if the
+                 server isn't replicating
+        """
+        cursor = self.replica.cursor()
+        try:
+            cursor.execute('SHOW SLAVE STATUS')
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            columns = [column[0] for column in cursor.description]
+            for name in ('Seconds_Behind_Master', 'Seconds_Behind_Source'):
+                if name in columns:
+                    lag = row[columns.index(name)]
+                    return None if lag is None else int(lag)
+            return None
+        finally:
+            cursor.close()
+
+    def get_writer(self, conn) -> BulkWriter:
+        return BulkWriter(conn, self.settings['max_statement_size'])
+
+    def _write_users(self, conn, writer: BulkWriter, rows):
+        if self.settings['staging_tables']:
+            writer.merge('ID int(10) unsigned NOT NULL PRIMARY KEY, '
+                         'Uploaded bigint(20) NOT NULL, Downloaded bigint(20) NOT NULL',
+                         'users_main_delta', 'ID, Uploaded, Downloaded', merge_users(rows),
+                         'UPDATE users_main AS u JOIN users_main_delta AS d ON d.ID = u.ID '
+                         'SET u.Uploaded = u.Uploaded + d.Uploaded, '
+                         'u.Downloaded = u.Downloaded + d.Downloaded')
+        else:
+            writer.insert('INSERT INTO users_main (ID, Uploaded, Downloaded) VALUES ', rows,
+                          ' ON DUPLICATE KEY UPDATE Uploaded = Uploaded + Values(Uploaded), '
+                          'Downloaded = Downloaded + Values(Downloaded)')
+
+    # noinspection PyMethodMayBeStatic
+    def _write_tokens(self, conn, writer: BulkWriter, rows):
+        # the row of a token always exists already, a plain INSERT would fail on its key
+        writer.insert('INSERT INTO users_freeleeches (UserID, TorrentID, Downloaded) VALUES ',
+                      rows, ' ON DUPLICATE KEY UPDATE Downloaded = Downloaded + '
+                      'VALUES(Downloaded)')
+
+    # noinspection PyMethodMayBeStatic
+    def _write_snatches(self, conn, writer: BulkWriter, rows):
+        writer.insert('INSERT INTO xbt_snatched (uid, fid, tstamp, IP) VALUES ',
+                      (row[:3] + (ip_string(row[3]),) for row in rows))
+
+    def _write_torrents(self, conn, writer: BulkWriter, rows):
+        if self.settings['staging_tables']:
+            writer.merge('ID int(10) NOT NULL PRIMARY KEY, Seeders int(6) NOT NULL, '
+                         'Leechers int(6) NOT NULL, Snatched int(10) unsigned NOT NULL, '
+                         'Balance bigint(20) NOT NULL, Active tinyint(1) NOT NULL',
+                         'torrents_delta', 'ID, Seeders, Leechers, Snatched, Balance, Active',
+                         merge_torrents(rows),
+                         'UPDATE torrents AS t JOIN torrents_delta AS d ON d.ID = t.ID '
+                         'SET t.Seeders = d.Seeders, t.Leechers = d.Leechers, '
+                         't.Snatched = t.Snatched + d.Snatched, t.Balance = d.Balance, '
+                         't.last_action = IF(d.Active, NOW(), t.last_action)')
+        else:
+            writer.insert('INSERT INTO torrents (ID, Seeders, Leechers, Snatched, Balance) '
+                          'VALUES ', rows,
+                          ' ON DUPLICATE KEY UPDATE Seeders=VALUES(Seeders), '
+                          'Leechers=VALUES(Leechers), '
+                          'Snatched = Snatched + VALUES(Snatched), '
+                          'Balance=VALUES(Balance), '
+                          'last_action=IF(VALUES(Seeders) > 0, NOW(), last_action)')
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM torrents WHERE info_hash = ''")
+        cursor.close()
+
+    # noinspection PyMethodMayBeStatic
+    def _write_peers(self, conn, writer: BulkWriter, rows):
+        # light peer rows only carry uid, fid, timespent, announced, peer_id and mtime
+        if len(rows[0]) == 6:
+            writer.insert('INSERT INTO xbt_files_users (uid, fid, timespent, announced, '
+                          'peer_id, mtime) VALUES ',
+                          (row[:4] + (row[4].encode('latin-1'),) + row[5:] for row in rows),
+                          ' ON DUPLICATE KEY UPDATE upspeed=0, downspeed=0, '
+                          'timespent=VALUES(timespent), announced=VALUES(announced), '
+                          'mtime=VALUES(mtime)')
+        else:
+            writer.insert('INSERT INTO xbt_files_users (uid, fid, active, uploaded, '
+                          'downloaded, upspeed, downspeed, remaining, corrupt, timespent, '
+                          'announced, ip, peer_id, useragent, mtime) VALUES ',
+                          (row[:11] + (ip_string(row[11]), row[12].encode('latin-1')) +
+                           row[13:] for row in rows),
+                          ' ON DUPLICATE KEY UPDATE active=VALUES(active), '
+                          'uploaded=VALUES(uploaded), downloaded=VALUES(downloaded), '
+                          'upspeed=VALUES(upspeed), downspeed=VALUES(downspeed), '
+                          'remaining=VALUES(remaining), corrupt=VALUES(corrupt), '
+                          'timespent=VALUES(timespent), announced=VALUES(announced), '
+                          'mtime=VALUES(mtime)')
+
+    # noinspection PyMethodMayBeStatic
+    def _write_watermark(self, conn, category, seq):
+        cursor = conn.cursor()
+        cursor.execute('INSERT INTO margay_spool (category, seq) VALUES (%s, %s) '
+                       'ON DUPLICATE KEY UPDATE seq = VALUES(seq)', (category, seq))
+        cursor.close()
+
+    def _clear_peer_data(self):
+        self.db.query('TRUNCATE xbt_files_users')
+        self.db.query('UPDATE torrents SET Seeders = 0, Leechers = 0')
@@ -0,0 +1,198 @@
+import asyncio
+import logging
+
+import margay.stats as stats
+
+RESPONSE = b'HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nContent-Length: %d\r\n%s\r\n'
+CLOSE = b'Connection: close\r\n'
+ERROR = b'HTTP/1.1 500 Internal Server Error\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+
+
+class AnnounceProtocol(asyncio.Protocol):
+    """
+    Front door for every connection to the tracker. It keeps the connection counts in stats,
+    enforces max_connections and the connection and keepalive timeouts, and when the fast path
+    is enabled serves GET /{passkey}/announce itself: the request line and the few headers we
+    care about are picked out in a single pass and the request goes straight to Worker.work,
+    skipping aiohttp's router, multidicts and request and response objects. Anything else
+    (another method or action, a request body, a request that's too big) is delegated to
+    aiohttp's own protocol together with whatever has been buffered so far, and that connection
+    is aiohttp's from then on. Without the fast path every connection is delegated right away.
+    """
+    def __init__(self, worker, fallback, config):
+        """
+        :param worker: Worker that handles the announces
+        :param fallback: aiohttp protocol factory, usually AppRunner.server
+        :param config: tracker configuration
+        """
+        self.logger = logging.getLogger()
+        self.worker = worker
+        self.fallback = fallback
+        self.fast_path = config['internal']['fast_path']
+        self.max_connections = config['internal']['max_connections']
+        self.connection_timeout = config['internal']['connection_timeout']
+        self.keepalive_timeout = config['internal']['keepalive_timeout']
+        self.max_request_size = config['tracker']['max_request_size']
+        self.transport = None  # type: asyncio.Transport
+        self.delegate = None  # type: asyncio.Protocol
+        self.buffer = bytearray()
+        self.remote_ip = ''
+        self.accepted = False
+        self.timer = None  # type: asyncio.TimerHandle
+        self.timer_at = 0
+        self.deadline = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if stats.open_connections >= self.max_connections:
+            stats.rejected_connections += 1
+            transport.close()
+            return
+        self.accepted = True
+        stats.open_connections += 1
+        stats.opened_connections += 1
+
+        peername = transport.get_extra_info('peername')
+        # UNIX domain sockets don't have a peer address
+        if isinstance(peername, tuple):
+            self.remote_ip = peername[0]
+        if self.fast_path:
+            self._set_timeout(self.connection_timeout)
+        else:
+            self._fall_back()
+
+    def connection_lost(self, exc):
+        if not self.accepted:
+            return
+        stats.open_connections -= 1
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.delegate is not None:
+            self.delegate.connection_lost(exc)
+
+    def pause_writing(self):
+        if self.delegate is not None:
+            self.delegate.pause_writing()
+
+    def resume_writing(self):
+        if self.delegate is not None:
+            self.delegate.resume_writing()
+
+    def eof_received(self):
+        if self.delegate is not None:
+            return self.delegate.eof_received()
+        return False
+
+    def data_received(self, data):
+        stats.bytes_read += len(data)
+        if self.delegate is not None:
+            self.delegate.data_received(data)
+            return
+        if len(self.buffer) == 0:
+            # the connection is no longer idle, so the request has to arrive in time
+            self._set_timeout(self.connection_timeout)
+        self.buffer += data
+        while len(self.buffer) > 0:
+            end = self.buffer.find(b'\r\n\r\n')
+            if end < 0:
+                if len(self.buffer) > self.max_request_size:
+                    self._fall_back()
+                return
+            request = self._parse(bytes(self.buffer[:end]))
+            if request is None:
+                self._fall_back()
+                return
+            del self.buffer[:end + 4]
+
+            passkey, query, headers, keep_alive = request
+            keep_alive = keep_alive and self.keepalive_timeout > 0
+            try:
+                body = self.worker.work(passkey, 'announce', query, headers, self.remote_ip)
+            except Exception:
+                self.logger.exception('Error handling announce')
+                self.transport.write(ERROR)
+                self.transport.close()
+                return
+            response = RESPONSE % (len(body), b'' if keep_alive else CLOSE) + body
+            stats.bytes_written += len(response)
+            self.transport.write(response)
+            if not keep_alive:
+                self.transport.close()
+                return
+            self._set_timeout(self.keepalive_timeout)
+
+    def _set_timeout(self, timeout):
+        """
+        Connections only ever push their deadline back, so rather than rescheduling a timer on
+        every request the one timer we have checks the current deadline when it fires. It only
+        gets rescheduled when the deadline moves closer, going from an idle keepalive to waiting
+        for a request.
+        """
+        loop = asyncio.get_event_loop()
+        self.deadline = loop.time() + timeout
+        if self.timer is None or self.deadline < self.timer_at:
+            if self.timer is not None:
+                self.timer.cancel()
+            self.timer_at = self.deadline
+            self.timer = loop.call_at(self.deadline, self._timed_out)
+
+    def _timed_out(self):
+        loop = asyncio.get_event_loop()
+        if self.delegate is not None:
+            self.timer = None
+        elif loop.time() < self.deadline:
+            self.timer_at = self.deadline
+            self.timer = loop.call_at(self.deadline, self._timed_out)
+        else:
+            self.timer = None
+            self.transport.close()
+
+    # noinspection PyMethodMayBeStatic
+    def _parse(self, head: bytes):
+        """
+        :return: (passkey, query string, headers, keep alive) or None if the request isn't a
+                 plain announce
+        """
+        lines = head.split(b'\r\n')
+        method, _, rest = lines[0].partition(b' ')
+        target, _, version = rest.partition(b' ')
+        if method != b'GET' or (version != b'HTTP/1.1' and version != b'HTTP/1.0'):
+            return None
+        path, _, query = target.partition(b'?')
+        parts = path.split(b'/')
+        if len(parts) != 3 or parts[2] != b'announce' or len(query) == 0:
+            return None
+
+        headers = dict()
+        keep_alive = version == b'HTTP/1.1'
+        for line in lines[1:]:
+            name, _, value = line.partition(b':')
+            name = name.strip().lower()
+            if name == b'x-forwarded-for':
+                headers['x-forwarded-for'] = value.strip().decode('latin-1')
+            elif name == b'user-agent':
+                headers['user-agent'] = value.strip().decode('utf-8', 'replace')
+            elif name == b'connection':
+                value = value.strip().lower()
+                if value == b'close':
+                    keep_alive = False
+                elif value == b'keep-alive':
+                    keep_alive = True
+            elif name == b'content-length':
+                if value.strip() != b'0':
+                    return None
+            elif name == b'transfer-encoding' or name == b'upgrade' or name == b'expect':
+                return None
+        return parts[1].decode('latin-1'), query.decode('latin-1'), headers, keep_alive
+
+    def _fall_back(self):
+        # aiohttp runs its own keepalive timer
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.delegate = self.fallback()
+        self.delegate.connection_made(self.transport)
+        if len(self.buffer) > 0:
+            self.delegate.data_received(bytes(self.buffer))
+        self.buffer = bytearray()
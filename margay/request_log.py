@@ -0,0 +1,62 @@
+from array import array
+from time import strftime, gmtime
+
+from .structs import Action, Event, Result
+
+
+class RequestLog(object):
+    """
+    Ring buffer of the most recent requests. Every field lives in its own array that is
+    allocated up front, so recording a request from the hot path only overwrites a few slots
+    and never allocates anything.
+    """
+    def __init__(self, size):
+        self.size = max(0, size)
+        self.timestamps = array('d', bytes(8 * self.size))
+        self.actions = array('B', bytes(self.size))
+        self.torrents = array('q', bytes(8 * self.size))
+        self.users = array('q', bytes(8 * self.size))
+        self.events = array('B', bytes(self.size))
+        self.latencies = array('Q', bytes(8 * self.size))  # microseconds
+        self.results = array('B', bytes(self.size))
+        self.position = 0
+        self.recorded = 0
+
+    def record(self, timestamp, context, latency):
+        """
+        :param timestamp: unix time the request came in
+        :param context: RequestContext of the request
+        :param latency: how long the request took in microseconds
+        """
+        if self.size == 0:
+            return
+        i = self.position
+        self.timestamps[i] = timestamp
+        self.actions[i] = context.action
+        self.torrents[i] = context.torrent
+        self.users[i] = context.user
+        self.events[i] = context.event
+        self.latencies[i] = latency
+        self.results[i] = context.result
+        i += 1
+        self.position = i if i < self.size else 0
+        self.recorded += 1
+
+    def dump(self, count=None) -> str:
+        """
+        :param count: only dump the most recent count requests
+        :return: one line per request, oldest first
+        """
+        available = min(self.recorded, self.size)
+        if count is None or count > available:
+            count = available
+        output = ''
+        for n in range(count):
+            i = (self.position - count + n) % self.size
+            timestamp = strftime('%Y-%m-%d %H:%M:%S', gmtime(self.timestamps[i]))
+            output += f'{timestamp} {Action(self.actions[i]).name.lower()} ' \
+                      f'torrent={self.torrents[i]} user={self.users[i]} ' \
+                      f'event={Event(self.events[i]).name.lower()} ' \
+                      f'latency={self.latencies[i]}us ' \
+                      f'result={Result(self.results[i]).name.lower()}\n'
+        return output
@@ -1,51 +1,158 @@
+import asyncio
 import logging
-from threading import Thread, Timer
+import random
+from time import perf_counter, sleep, time
+from typing import Callable, List
 
+from .logs import summary
 import margay.stats as stats
 
 
-class Schedule(Thread):
-    def __init__(self, interval, reap_interval, database):
-        super().__init__()
+class Job(object):
+    def __init__(self, name, interval, function: Callable[[], None], jitter):
+        self.name = name
+        self.interval = interval
+        self.function = function
+        # fraction of the interval a run may be pushed back by, so jobs that share an interval
+        # (and trackers that were started together) don't all fire at once
+        self.jitter = jitter
+        self.base = 0.0
+        self.due = 0.0
+        self.handle = None  # type: asyncio.TimerHandle
+        self.runs = 0
+        self.failures = 0
+        self.overruns = 0
+        self.last_duration = 0.0  # milliseconds
+        self.max_duration = 0.0
+        self.total_duration = 0.0
+        self.max_lateness = 0.0
+
+    def schedule(self, now):
+        self.base += self.interval
+        if self.base - now < self.interval / 2:
+            # this run was late, rather than catching up on missed runs or running again right
+            # away start over from now
+            self.base = now + self.interval
+        self.due = self.base + random.uniform(0, self.jitter * self.interval)
+
+
+class Schedule(object):
+    """
+    Runs the tracker's periodic jobs on its event loop: flushing to the database, computing
+    the connection and request rates, reaping peers and expiring del reasons. Running them on
+    the loop means they never race an announce, but also that a slow job holds up requests,
+    so every run is timed, and a run that takes longer than its interval is counted as an
+    overrun and logged.
+    """
+    def __init__(self, worker, database, config):
         self.logger = logging.getLogger()
-        self._timer = None
-        self.is_running = False
+        self.worker = worker
+        self.database = database
+        self.loop = None  # type: asyncio.AbstractEventLoop
+        self.running = False
         self.counter = 0
         self.last_opened_connections = 0
         self.last_request_count = 0
-        self.interval = interval
-        self.reap_interval = reap_interval
-        self.database = database
-        self._reap = self.reap_interval
-        self.start()
+        self.last_rates = 0.0
+
+        timers = config['timers']
+        self.drain_timeout = timers['drain_timeout']
+        jitter = timers['schedule_jitter'] / 100
+        self.jobs = [
+            Job('flush', timers['schedule_interval'], self.database.flush, jitter),
+            Job('rates', timers['schedule_interval'], self._rates, 0),
+            Job('reap_peers', timers['reap_peers_interval'], self.worker.reap_peers, jitter),
+            Job('reap_del_reasons', timers['reap_peers_interval'],
+                self.worker.reap_del_reasons, jitter),
+            Job('log_summary', config['logging']['summary_interval'], summary.flush, 0)
+        ]  # type: List[Job]
+        if self.worker.exporter is not None:
+            self.jobs.append(Job('export', config['export']['interval'],
+                                 self.worker.exporter.export, jitter))
 
-    def start(self):
-        if not self.is_running:
-            self._timer = Timer(self.interval, self._run)
-            self._timer.start()
-            self.is_running = True
+    def start(self, loop):
+        if self.running:
+            return
+        self.loop = loop
+        self.running = True
+        self.last_rates = perf_counter()
+        now = loop.time()
+        for job in self.jobs:
+            job.base = now
+            job.schedule(now)
+            job.handle = loop.call_at(job.due, self._run, job)
+
+    def cancel(self):
+        if self.running:
+            self.running = False
+            for job in self.jobs:
+                if job.handle is not None:
+                    job.handle.cancel()
+                    job.handle = None
 
     def stop(self):
-        self._timer.cancel()
-        self.is_running = False
+        """
+        Cancel everything that's scheduled, then flush what's buffered and wait up to
+        drain_timeout seconds for it to reach the database
+        """
+        self.cancel()
+        self.database.flush()
+        deadline = time() + self.drain_timeout
+        while self.database.backlog() > 0 and time() < deadline:
+            sleep(0.1)
+        backlog = self.database.backlog()
+        if backlog > 0:
+            self.logger.warning(f'Stopped with {backlog} rows still waiting to be flushed')
+        else:
+            self.logger.info('Flushed everything to the database')
 
-    def _run(self):
-        self.is_running = False
-        self.start()
+    def _run(self, job: Job):
+        if not self.running:
+            return
+        lateness = (self.loop.time() - job.due) * 1000
+        start = perf_counter()
+        try:
+            job.function()
+        except Exception:
+            job.failures += 1
+            self.logger.exception(f'Scheduled job {job.name} failed')
+        duration = (perf_counter() - start) * 1000
+        job.runs += 1
+        job.last_duration = duration
+        job.total_duration += duration
+        job.max_duration = max(job.max_duration, duration)
+        job.max_lateness = max(job.max_lateness, lateness)
+        if duration > job.interval * 1000:
+            job.overruns += 1
+            self.logger.warning(f'Scheduled job {job.name} took {duration:.0f}ms, longer than '
+                                f'its {job.interval}s interval')
+        if self.running:
+            now = self.loop.time()
+            job.schedule(now)
+            job.handle = self.loop.call_at(job.due, self._run, job)
 
-        self._reap -= self.interval
+    def _rates(self):
+        now = perf_counter()
+        elapsed = max(now - self.last_rates, 0.001)
+        stats.connection_rate = int((stats.opened_connections - self.last_opened_connections) /
+                                    elapsed)
+        stats.request_rate = int((stats.requests - self.last_request_count) / elapsed)
+        self.last_opened_connections = stats.opened_connections
+        self.last_request_count = stats.requests
+        self.last_rates = now
 
         if self.counter % 20 == 0:
             self.logger.info(f'{stats.open_connections} open, '
                              f'{stats.opened_connections} connections ({stats.connection_rate}/s) '
                              f'{stats.requests} requests ({stats.request_rate}/s)')
-
-        self.last_opened_connections = stats.opened_connections
-        self.last_request_count = stats.requests
-
-        self.database.flush()
-
-        if self._reap <= 0:
-            self._reap = self.reap_interval
-
         self.counter += 1
+
+    def report(self) -> str:
+        output = ''
+        for job in self.jobs:
+            average = job.total_duration / job.runs if job.runs > 0 else 0
+            output += f"{job.name}: every {job.interval}s, {job.runs} runs, " \
+                      f"{job.failures} failed, {job.overruns} overran, " \
+                      f"last {job.last_duration:.3f}ms, average {average:.3f}ms, " \
+                      f"max {job.max_duration:.3f}ms, max {job.max_lateness:.3f}ms late\n"
+        return output
@@ -3,6 +3,8 @@ import threading
 
 import requests
 
+from .logs import summary
+
 
 class SiteComm(object):
     def __init__(self, config):
@@ -41,7 +43,7 @@ class SiteComm(object):
             self.expire_token_buffer += ','
         self.expire_token_buffer += token_pair
         if len(self.expire_token_buffer) > 350:
-            self.logger.info('Flushing overloaded token buffer')
+            summary.info('Flushed the full token buffer {:,} times')
             if not self.readonly:
                 with self.expire_queue_lock:
                     self.token_queue.append(self.expire_token_buffer)
@@ -0,0 +1,114 @@
+from array import array
+import logging
+import zlib
+
+# Seconds ahead that returning announces are booked for, longer intervals aren't smoothed
+HORIZON = 16384
+# Offsets tried for a peer before settling for the least booked one
+PROBES = 48
+
+
+class AnnounceSmoother(object):
+    """
+    Spreads announces out evenly over time. Every interval we hand out tells us when that peer
+    will be back, so those returns are booked per second, and each peer is given the first
+    second of its window that isn't booked beyond the envelope: the average rate of everything
+    booked plus slack percent, or a fixed max_rate. A peer's search starts at an offset hashed
+    from its peer key within spread seconds, which is the jitter peers get when things are calm.
+    After a restart or a mass event, when all of those seconds fill up, peers are pushed out
+    further, up to max_spread, so the next round of announces comes in flat instead of as
+    another storm.
+
+    Arrivals are counted per second as well, for the report.
+    """
+    def __init__(self, config):
+        self.logger = logging.getLogger()
+        self.enabled = True
+        self.spread = 0
+        self.max_spread = 0
+        self.slack = 0.0
+        self.max_rate = 0
+
+        self.booked = array('i', bytes(4 * HORIZON))
+        self.arrivals = array('i', bytes(4 * HORIZON))
+        self.total = 0
+        self.now = None
+        self.pushed = 0
+        self.overbooked = 0
+
+        self.load_config(config)
+
+    def load_config(self, config):
+        self.enabled = config['smoothing']['enabled']
+        self.spread = max(0, config['smoothing']['spread'])
+        self.max_spread = max(self.spread, config['smoothing']['max_spread'])
+        self.slack = config['smoothing']['slack'] / 100
+        self.max_rate = config['smoothing']['max_rate']
+
+    def interval(self, key: str, base: int, now: int) -> int:
+        """
+        :param key: the peer key, so a peer's offset only depends on who it is
+        :param base: the interval the peer would get without smoothing
+        :param now: the current time in seconds
+        """
+        self._advance(now)
+        self.arrivals[now % HORIZON] += 1
+        start = zlib.crc32(key.encode('latin-1')) % (self.spread + 1)
+        if base + self.max_spread >= HORIZON:
+            return base + start
+
+        booked = self.booked
+        if self.max_rate > 0:
+            envelope = self.max_rate
+        else:
+            envelope = self.total / (base + self.spread / 2) * (1 + self.slack)
+        best = start
+        least = -1
+        for probe in range(PROBES):
+            offset = start + probe * probe
+            if offset > self.max_spread:
+                break
+            count = booked[(now + base + offset) % HORIZON]
+            if count < envelope:
+                best = offset
+                least = -1
+                break
+            if least < 0 or count < least:
+                best = offset
+                least = count
+        if least >= 0:
+            self.overbooked += 1
+        if best > self.spread:
+            self.pushed += 1
+        booked[(now + base + best) % HORIZON] += 1
+        self.total += 1
+        return base + best
+
+    def _advance(self, now):
+        """
+        Forget the bookings and arrivals of the seconds that have gone by since the last call
+        """
+        last = self.now
+        self.now = now
+        if last is None or now <= last:
+            return
+        for second in range(last + 1, last + 1 + min(now - last, HORIZON)):
+            slot = second % HORIZON
+            self.total -= self.booked[slot]
+            self.booked[slot] = 0
+            self.arrivals[slot] = 0
+
+    def report(self) -> str:
+        if self.now is None:
+            return "no announces yet\n"
+        window = 60
+        recent = [self.arrivals[second % HORIZON] for second in range(self.now - window + 1,
+                                                                       self.now + 1)]
+        upcoming = [self.booked[second % HORIZON] for second in range(self.now + 1,
+                                                                      self.now + 1 + 3600)]
+        return f"enabled: {self.enabled}\n" \
+               f"last {window}s: {sum(recent) / window:.1f} announces/s, peak {max(recent)}/s\n" \
+               f"next hour: {sum(upcoming) / 3600:.1f} announces/s booked, " \
+               f"peak {max(upcoming)}/s\n" \
+               f"{self.total} returns booked, {self.pushed} pushed past spread, " \
+               f"{self.overbooked} over the envelope\n"
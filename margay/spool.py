@@ -0,0 +1,144 @@
+import logging
+import marshal
+import os
+import struct
+import threading
+import zlib
+from typing import Dict, List, Tuple
+
+# length of the payload, crc32 of the payload, record kind
+HEADER = struct.Struct('<IIB')
+
+BATCH = 0
+CONFIRM = 1
+
+
+class Spool(object):
+    """
+    Append-only write-ahead log of the batches handed to the flush threads. A batch is written
+    by the flush thread before it goes to the database and a confirmation is written once the
+    database has committed it. Writes go straight to the kernel so they survive the process
+    dying, while the fsync is batched to once per flush round. Once nothing is outstanding the
+    file is truncated. Only the flush thread uses it while serving, never the loop.
+    """
+    def __init__(self, path, max_size=64 * 1024 * 1024):
+        self.logger = logging.getLogger()
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.RLock()
+        self.sequence = 0
+        self.pending = dict()  # type: Dict[int, Tuple[str, list]]
+        self.size = 0
+        self.dirty = False
+        self.fd = None
+
+    def open(self, floor=0) -> List[Tuple[int, str, list]]:
+        """
+        Open the spool and return the batches that were never confirmed, in the order they
+        were written. The file is rewritten so that it holds exactly those batches. They keep
+        their sequence numbers, which never go backwards: new batches are numbered after them
+        and after floor, the highest sequence number the database has committed.
+
+        A batch can have been committed without its confirmation making it to disk, the
+        database keeps the sequence number it committed last for that (see
+        Database._replay_spool).
+        """
+        batches = dict()
+        if os.path.exists(self.path):
+            confirmed = set()
+            for kind, payload in self._read(self.path):
+                if kind == BATCH:
+                    batches[payload[0]] = (payload[1], payload[2])
+                elif kind == CONFIRM:
+                    confirmed.add(payload)
+            for seq in confirmed:
+                batches.pop(seq, None)
+
+        with self.lock:
+            self.pending.clear()
+            for seq in sorted(batches):
+                self.pending[seq] = batches[seq]
+            self.sequence = max([floor] + list(batches))
+            self._rewrite()
+
+        if len(self.pending) > 0:
+            self.logger.info(f'Replaying {len(self.pending)} unconfirmed batches from '
+                             f'{self.path}')
+        return [(seq, category, rows) for seq, (category, rows) in self.pending.items()]
+
+    def close(self) -> None:
+        with self.lock:
+            if self.fd is not None:
+                self.sync()
+                os.close(self.fd)
+                self.fd = None
+
+    def append(self, category: str, rows: list) -> int:
+        with self.lock:
+            self.sequence += 1
+            self.pending[self.sequence] = (category, rows)
+            self._write(BATCH, (self.sequence, category, rows))
+            return self.sequence
+
+    def confirm(self, seq: int) -> None:
+        with self.lock:
+            if self.pending.pop(seq, None) is None:
+                return
+            if len(self.pending) == 0:
+                os.ftruncate(self.fd, 0)
+                self.size = 0
+                self.dirty = True
+            elif self.size > self.max_size:
+                self._rewrite()
+            else:
+                self._write(CONFIRM, seq)
+
+    def sync(self) -> None:
+        with self.lock:
+            if self.dirty and self.fd is not None:
+                os.fsync(self.fd)
+                self.dirty = False
+
+    def _write(self, kind, payload) -> None:
+        data = marshal.dumps(payload)
+        record = HEADER.pack(len(data), zlib.crc32(data), kind) + data
+        os.write(self.fd, record)
+        self.size += len(record)
+        self.dirty = True
+
+    def _rewrite(self) -> None:
+        """
+        Atomically replace the spool with one that only holds the pending batches
+        """
+        tmp_path = self.path + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        size = 0
+        for seq, (category, rows) in self.pending.items():
+            data = marshal.dumps((seq, category, rows))
+            record = HEADER.pack(len(data), zlib.crc32(data), BATCH) + data
+            os.write(fd, record)
+            size += len(record)
+        os.fsync(fd)
+        os.close(fd)
+        os.rename(tmp_path, self.path)
+        if self.fd is not None:
+            os.close(self.fd)
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        self.size = size
+        self.dirty = False
+
+    def _read(self, path):
+        with open(path, 'rb') as spool_file:
+            data = spool_file.read()
+        pos = 0
+        while pos + HEADER.size <= len(data):
+            length, crc, kind = HEADER.unpack_from(data, pos)
+            pos += HEADER.size
+            payload = data[pos:pos + length]
+            if len(payload) != length or zlib.crc32(payload) != crc:
+                # a torn write from when we died, nothing after it can be trusted
+                self.logger.warning(f'Discarding corrupt tail of {path} at offset '
+                                    f'{pos - HEADER.size}')
+                return
+            pos += length
+            yield kind, marshal.loads(payload)
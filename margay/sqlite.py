@@ -0,0 +1,128 @@
+import re
+import sqlite3
+from typing import List
+
+from .database import Database, ip_string
+
+# Secondary keys of a MySQL CREATE TABLE, which SQLite only has as separate indexes
+KEY = re.compile(r'(UNIQUE )?KEY `(\w+)` \((.*)\)$')
+ENUM = re.compile(r'enum\([^)]*\)')
+# Prefix lengths of keys on blob and text columns, like `info_hash`(40)
+PREFIX = re.compile(r'\(\d+\)')
+
+
+def translate_schema(schema: str) -> List[str]:
+    """
+    Turn the CREATE TABLE statements of margay.sql into ones SQLite accepts: enums become text,
+    unsigned, AUTO_INCREMENT and the table options are dropped and keys become indexes
+    (without prefix lengths)
+    """
+    statements = []
+    for create in schema.split(';'):
+        match = re.search(r'CREATE TABLE IF NOT EXISTS `(\w+)`', create)
+        if match is None:
+            continue
+        table = match.group(1)
+        columns = []
+        indexes = []
+        for line in create.splitlines()[1:]:
+            line = line.strip().rstrip(',')
+            key = KEY.match(line)
+            if key is not None:
+                unique, name, keys = key.groups()
+                keys = PREFIX.sub('', keys)
+                indexes.append(f'CREATE {unique or ""}INDEX IF NOT EXISTS `{table}_{name}` '
+                               f'ON `{table}` ({keys})')
+            elif line.startswith('`') or line.startswith('PRIMARY KEY'):
+                line = ENUM.sub('text', line)
+                columns.append(line.replace(' unsigned', '').replace(' AUTO_INCREMENT', ''))
+        statements.append(f'CREATE TABLE IF NOT EXISTS `{table}` (\n  ' + ',\n  '.join(columns) +
+                          '\n)')
+        statements.extend(indexes)
+    return statements
+
+
+class SQLiteDatabase(Database):
+    """
+    A local SQLite file with the tables of margay.sql, the ones it doesn't have yet are created
+    when it's opened. For running the tracker on its own, in CI or to load test it against a
+    database that's really written to. info_hash and peer_id are stored as blobs, like MySQL
+    stores them.
+    """
+    errors = (sqlite3.Error,)
+
+    def __init__(self, settings, flush, readonly=False, spool=None, clear_peers=True):
+        conn = sqlite3.connect(settings['path'])
+        # only creates the tables that are missing
+        with open(settings['schema']) as schema:
+            for statement in translate_schema(schema.read()):
+                conn.execute(statement)
+        conn.commit()
+        # readers aren't blocked by the flush thread writing
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.close()
+        super().__init__(settings, flush, readonly, spool, clear_peers)
+
+    def get_connection(self):
+        # the loaders run on the reload threads, the flush threads open their own
+        return sqlite3.connect(self.settings['path'], timeout=30, check_same_thread=False)
+
+    # noinspection PyMethodMayBeStatic
+    def _write_users(self, conn, writer, rows):
+        conn.executemany('UPDATE users_main SET Uploaded = Uploaded + ?, '
+                         'Downloaded = Downloaded + ? WHERE ID = ?',
+                         ((row[1], row[2], row[0]) for row in rows))
+
+    # noinspection PyMethodMayBeStatic
+    def _write_tokens(self, conn, writer, rows):
+        conn.executemany('UPDATE users_freeleeches SET Downloaded = Downloaded + ? '
+                         'WHERE UserID = ? AND TorrentID = ?',
+                         ((row[2], row[0], row[1]) for row in rows))
+
+    # noinspection PyMethodMayBeStatic
+    def _write_snatches(self, conn, writer, rows):
+        conn.executemany('INSERT INTO xbt_snatched (uid, fid, tstamp, IP) VALUES (?, ?, ?, ?)',
+                         (row[:3] + (ip_string(row[3]),) for row in rows))
+
+    # noinspection PyMethodMayBeStatic
+    def _write_torrents(self, conn, writer, rows):
+        conn.executemany("UPDATE torrents SET Seeders = ?, Leechers = ?, "
+                         "Snatched = Snatched + ?, Balance = ?, "
+                         "last_action = CASE WHEN ? > 0 THEN datetime('now') "
+                         "ELSE last_action END WHERE ID = ?",
+                         (row[1:] + (row[1], row[0]) for row in rows))
+        conn.execute('DELETE FROM torrents WHERE length(info_hash) = 0')
+
+    # noinspection PyMethodMayBeStatic
+    def _write_peers(self, conn, writer, rows):
+        # light peer rows only carry uid, fid, timespent, announced, peer_id and mtime
+        if len(rows[0]) == 6:
+            conn.executemany('INSERT INTO xbt_files_users (uid, fid, timespent, announced, '
+                             'peer_id, mtime) VALUES (?, ?, ?, ?, ?, ?) '
+                             'ON CONFLICT (peer_id, fid, uid) DO UPDATE SET upspeed=0, '
+                             'downspeed=0, timespent=excluded.timespent, '
+                             'announced=excluded.announced, mtime=excluded.mtime',
+                             (row[:4] + (row[4].encode('latin-1'),) + row[5:] for row in rows))
+        else:
+            conn.executemany('INSERT INTO xbt_files_users (uid, fid, active, uploaded, '
+                             'downloaded, upspeed, downspeed, remaining, corrupt, timespent, '
+                             'announced, ip, peer_id, useragent, mtime) '
+                             'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) '
+                             'ON CONFLICT (peer_id, fid, uid) DO UPDATE SET '
+                             'active=excluded.active, uploaded=excluded.uploaded, '
+                             'downloaded=excluded.downloaded, upspeed=excluded.upspeed, '
+                             'downspeed=excluded.downspeed, remaining=excluded.remaining, '
+                             'corrupt=excluded.corrupt, timespent=excluded.timespent, '
+                             'announced=excluded.announced, mtime=excluded.mtime',
+                             (row[:11] + (ip_string(row[11]), row[12].encode('latin-1')) +
+                              row[13:] for row in rows))
+
+    # noinspection PyMethodMayBeStatic
+    def _write_watermark(self, conn, category, seq):
+        conn.execute('INSERT INTO margay_spool (category, seq) VALUES (?, ?) '
+                     'ON CONFLICT (category) DO UPDATE SET seq = excluded.seq', (category, seq))
+
+    def _clear_peer_data(self):
+        self.db.execute('DELETE FROM xbt_files_users')
+        self.db.execute('UPDATE torrents SET Seeders = 0, Leechers = 0')
+        self.db.commit()
@@ -0,0 +1,317 @@
+import asyncio
+import logging
+import struct
+from typing import Dict, List
+
+from .structs import Peer, Torrent
+import margay.stats as stats
+
+# Every record is its kind and the length of what follows, which for an update from the site
+# can be well over 64 KiB (like removing thousands of users at once)
+RECORD = struct.Struct('<BI')
+# A peer that was added or changed, with the counters of its torrent. The peer key follows.
+PEER = struct.Struct('<20sqqqqqqqqqIHBBBB4s')
+# A peer that left, the peer key follows the info hash
+PEER_REMOVED = struct.Struct('<20s')
+
+PUT = 1
+REMOVE = 2
+# The query string of an update from the site, so the standby's catalogs get the same changes
+UPDATE = 3
+
+# Swarms written per step of the snapshot a new standby starts with
+SNAPSHOT_CHUNK = 1000
+
+
+def _peer_record(info_hash: str, peer_key: str, peer: Peer, seeder, uid, tor: Torrent) -> bytes:
+    key = peer_key.encode('latin-1')
+    payload = PEER.pack(info_hash.encode('latin-1'), uid, tor.completed, tor.balance,
+                        peer.uploaded, peer.downloaded, peer.corrupt, peer.left,
+                        peer.first_announced, peer.last_announced, peer.announces, peer.port,
+                        seeder, peer.visible, peer.invalid_ip, len(peer.ip), peer.ip) + key
+    return RECORD.pack(PUT, len(payload)) + payload
+
+
+class DeltaPublisher(object):
+    """
+    Streams every change to the swarms to the standbys that are connected to us. A standby
+    first gets a snapshot of every peer and from then on each peer that announces, each peer
+    that leaves and each update the site sends, so it keeps an up to date copy it can take
+    over with. Records are collected in a buffer and written out every flush_interval
+    milliseconds, nothing is collected while no standby is connected.
+    """
+    def __init__(self, worker, config):
+        self.logger = logging.getLogger()
+        self.worker = worker
+        self.loop = None  # type: asyncio.AbstractEventLoop
+        self.server = None
+        self.subscribers = []  # type: List[asyncio.Transport]
+        self.buffer = bytearray()
+        self.records = 0
+        self.snapshots = 0
+        self.dropped = 0
+
+        standby = config['standby']
+        self.listen_host = standby['listen_host']
+        self.listen_port = standby['listen_port']
+        self.flush_interval = max(1, standby['flush_interval']) / 1000
+        self.max_buffer = standby['max_buffer']
+
+    def start(self, loop):
+        self.loop = loop
+        self.server = loop.run_until_complete(self.listen())
+        loop.call_later(self.flush_interval, self._flush)
+        self.logger.info(f'======== Publishing swarm deltas on {self.listen_host}:'
+                         f'{self.listen_port} ========')
+
+    async def listen(self):
+        return await self.loop.create_server(lambda: PublisherProtocol(self), self.listen_host,
+                                             self.listen_port)
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+        for transport in self.subscribers:
+            transport.close()
+
+    def put(self, info_hash, peer_key, peer: Peer, seeder, uid, tor: Torrent):
+        self.buffer += _peer_record(info_hash, peer_key, peer, seeder, uid, tor)
+        self.records += 1
+
+    def remove(self, info_hash, peer_key):
+        payload = PEER_REMOVED.pack(info_hash.encode('latin-1')) + peer_key.encode('latin-1')
+        self.buffer += RECORD.pack(REMOVE, len(payload)) + payload
+        self.records += 1
+
+    def update(self, query_string: str):
+        payload = query_string.encode('latin-1')
+        self.buffer += RECORD.pack(UPDATE, len(payload)) + payload
+        self.records += 1
+
+    def attach(self, transport):
+        self.logger.info(f'Standby {transport.get_extra_info("peername")} connected, sending '
+                         f'a snapshot of {len(self.worker.torrents.swarms)} swarms')
+        self.snapshots += 1
+        self.subscribers.append(transport)
+        self._snapshot(transport, list(self.worker.torrents.swarms))
+
+    def detach(self, transport):
+        if transport in self.subscribers:
+            self.subscribers.remove(transport)
+            self.logger.info(f'Standby {transport.get_extra_info("peername")} disconnected')
+
+    def _snapshot(self, transport, info_hashes):
+        """
+        Write the peers of a chunk of the swarms and schedule the next chunk, so a large
+        snapshot doesn't hold up requests. Deltas that were collected until now are written
+        first, the swarms are read after them so they're never older than a delta.
+        """
+        if transport.is_closing():
+            return
+        self._write()
+        swarms = self.worker.torrents.swarms
+        users = self.worker.users
+        chunk = bytearray()
+        for info_hash in info_hashes[:SNAPSHOT_CHUNK]:
+            tor = swarms.get(info_hash)
+            if tor is None:
+                continue
+            for peers, seeder in ((tor.seeders, True), (tor.leechers, False)):
+                for peer_key, peer in peers.items():
+                    chunk += _peer_record(info_hash, peer_key, peer, seeder,
+                                          users.ids[peer.user], tor)
+        transport.write(chunk)
+        if len(info_hashes) > SNAPSHOT_CHUNK:
+            self.loop.call_soon(self._snapshot, transport, info_hashes[SNAPSHOT_CHUNK:])
+
+    def _flush(self):
+        self._write()
+        self.loop.call_later(self.flush_interval, self._flush)
+
+    def _write(self):
+        if len(self.buffer) == 0:
+            return
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        for transport in list(self.subscribers):
+            if transport.get_write_buffer_size() > self.max_buffer:
+                # it will have to start over with a new snapshot
+                self.logger.warning(f'Standby {transport.get_extra_info("peername")} fell '
+                                    f'too far behind, disconnecting it')
+                self.dropped += 1
+                self.detach(transport)
+                transport.abort()
+                continue
+            transport.write(data)
+
+    def report(self) -> str:
+        return f"{len(self.subscribers)} standbys connected\n" \
+               f"{self.records} records published\n" \
+               f"{self.snapshots} snapshots sent\n" \
+               f"{self.dropped} standbys dropped for falling behind\n"
+
+
+class PublisherProtocol(asyncio.Protocol):
+    def __init__(self, publisher: DeltaPublisher):
+        self.publisher = publisher
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.publisher.attach(transport)
+
+    def data_received(self, data):
+        pass
+
+    def connection_lost(self, exc):
+        self.publisher.detach(self.transport)
+
+
+class StandbyProtocol(asyncio.Protocol):
+    """
+    Applies the stream of a primary's DeltaPublisher to our own catalogs. Peers refer to their
+    user by row, which differs between instances, so the records carry the user id instead and
+    it's looked up in an id to row index that's rebuilt whenever an id is missing from it.
+    """
+    def __init__(self, worker):
+        self.logger = logging.getLogger()
+        self.worker = worker
+        self.buffer = bytearray()
+        self.rows = dict()  # type: Dict[int, int]
+        self.applied = 0
+        self.skipped = 0
+        self.lost = None  # type: asyncio.Future
+
+    def connection_made(self, transport):
+        self.lost = asyncio.get_event_loop().create_future()
+        self.logger.info(f'Following the primary at {transport.get_extra_info("peername")}')
+
+    def data_received(self, data):
+        self.buffer += data
+        buffer = self.buffer
+        offset = 0
+        with self.worker.database.torrent_list_lock:
+            while len(buffer) - offset >= RECORD.size:
+                kind, length = RECORD.unpack_from(buffer, offset)
+                end = offset + RECORD.size + length
+                if end > len(buffer):
+                    break
+                payload = bytes(buffer[offset + RECORD.size:end])
+                offset = end
+                if kind == PUT:
+                    self._put(payload)
+                elif kind == REMOVE:
+                    self._remove(payload)
+                elif kind == UPDATE:
+                    self.worker.apply_update(payload.decode('latin-1'))
+                self.applied += 1
+        del buffer[:offset]
+
+    def connection_lost(self, exc):
+        self.logger.warning(f'Lost the primary after {self.applied} records, with '
+                            f'{stats.seeders} seeders and {stats.leechers} leechers')
+        if not self.lost.done():
+            self.lost.set_result(True)
+
+    def _row(self, uid):
+        row = self.rows.get(uid)
+        users = self.worker.users
+        if row is None and len(users.rows) != len(self.rows):
+            self.rows = {users.ids[row]: row for row in users.rows.values()}
+            row = self.rows.get(uid)
+        return row
+
+    def _put(self, payload):
+        (info_hash, uid, completed, balance, uploaded, downloaded, corrupt, left, first_announced,
+         last_announced, announces, port, seeder, visible, invalid_ip, ip_length,
+         ip) = PEER.unpack_from(payload)
+        info_hash = info_hash.decode('latin-1')
+        peer_key = payload[PEER.size:].decode('latin-1')
+        tor = self.worker.torrents.swarm(info_hash)
+        row = self._row(uid)
+        if tor is None or row is None:
+            self.skipped += 1
+            return
+        users = self.worker.users
+        if seeder:
+            peers, others = tor.seeders, tor.leechers
+        else:
+            peers, others = tor.leechers, tor.seeders
+        peer = peers.get(peer_key)
+        if peer is None:
+            peer = others.pop(peer_key, None)
+            if peer is None:
+                peer = Peer()
+                peer.user = row
+                users.add_peer(row, info_hash, peer_key)
+            else:
+                self._count(peer.user, not seeder, -1)
+            self._count(row, seeder, 1)
+            peers[peer_key] = peer
+        if peer.user != row:
+            self._count(peer.user, seeder, -1)
+            self._count(row, seeder, 1)
+            users.remove_peer(peer.user, info_hash, peer_key)
+            users.add_peer(row, info_hash, peer_key)
+            peer.user = row
+        peer.uploaded = uploaded
+        peer.downloaded = downloaded
+        peer.corrupt = corrupt
+        peer.left = left
+        peer.first_announced = first_announced
+        peer.last_announced = last_announced
+        peer.announces = announces
+        peer.port = port
+        peer.visible = bool(visible)
+        peer.invalid_ip = bool(invalid_ip)
+        peer.ip = ip[:ip_length]
+        peer.ip_port = b'' if invalid_ip else peer.ip + port.to_bytes(2, 'big')
+        tor.completed = completed
+        tor.balance = balance
+
+    def _remove(self, payload):
+        info_hash = PEER_REMOVED.unpack_from(payload)[0].decode('latin-1')
+        peer_key = payload[PEER_REMOVED.size:].decode('latin-1')
+        tor = self.worker.torrents.swarms.get(info_hash)
+        if tor is None:
+            return
+        for peers, seeder in ((tor.seeders, True), (tor.leechers, False)):
+            peer = peers.pop(peer_key, None)
+            if peer is not None:
+                self._count(peer.user, seeder, -1)
+                self.worker.users.remove_peer(peer.user, info_hash, peer_key)
+
+    def _count(self, row, seeder, change):
+        if seeder:
+            self.worker.users.seeding[row] += change
+            stats.seeders += change
+        else:
+            self.worker.users.leeching[row] += change
+            stats.leechers += change
+
+
+async def follow(worker, host, port, retry_interval, retries):
+    """
+    Follow the primary at host:port until it goes away. Until the first connection succeeds
+    the primary is assumed to still be starting up, after that a lost connection is retried
+    a few times (the primary drops standbys that fall behind, and the new snapshot catches
+    them up) before we take over.
+    """
+    logger = logging.getLogger()
+    loop = asyncio.get_event_loop()
+    followed = False
+    failures = 0
+    while not followed or failures < retries:
+        try:
+            _, protocol = await loop.create_connection(lambda: StandbyProtocol(worker), host,
+                                                       port)
+        except OSError as e:
+            failures += 1
+            logger.info(f'Primary at {host}:{port} not reachable ({e}), retrying')
+            await asyncio.sleep(retry_interval)
+            continue
+        followed = True
+        failures = 0
+        await protocol.lost
+    logger.warning(f'Primary at {host}:{port} is gone, taking over')
+    worker.take_over()
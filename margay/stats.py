@@ -2,6 +2,7 @@ import time
 
 open_connections = 0
 opened_connections = 0
+rejected_connections = 0
 connection_rate = 0
 requests = 0
 request_rate = 0
@@ -12,4 +13,21 @@ succ_announcements = 0
 scrapes = 0
 bytes_read = 0
 bytes_written = 0
+flush_backlog = 0
+loop_lag = 0
+loop_lag_max = 0  # milliseconds, as measured by the watchdog
+loop_lag_histogram = [0] * 10  # see watchdog.LAG_BUCKETS
+loop_stalls = 0
+backpressure_level = 0
+backpressure_interval_factor = 1.0
+backpressure_numwant_factor = 1.0
+light_peers_shed = 0
+gc_collections = 0
+gc_pause_total = 0.0  # milliseconds
+gc_pause_max = 0.0
+replica_reads = 0
+replica_fallbacks = 0
+log_dropped = 0
+log_summarized = 0
+replica_lag = -1  # seconds, -1 when there's no replica or it isn't replicating
 start_time = int(time.time())
\ No newline at end of file
@@ -24,9 +24,9 @@ class Peer(object):
         self.port = None
         self.visible = False
         self.invalid_ip = False
-        self.user = None  # type: User
-        self.ip = None
-        self.ip_port = ''
+        self.user = -1  # row in the UserCatalog
+        self.ip = b''  # packed
+        self.ip_port = b''
         self.port = None
 
 
@@ -43,6 +43,52 @@ class Torrent(object):
         self.tokened_users = []
 
 
+class Action(IntEnum):
+    INVALID = 0
+    ANNOUNCE = 1
+    SCRAPE = 2
+    UPDATE = 3
+    REPORT = 4
+
+
+class Event(IntEnum):
+    NONE = 0
+    STARTED = 1
+    COMPLETED = 2
+    STOPPED = 3
+
+
+class Result(IntEnum):
+    OK = 0
+    FAILURE = 1
+    INVALID = 2
+    ERROR = 3
+
+
+class RequestContext(object):
+    """
+    What the request that is currently being handled is about. There is only ever one of these
+    and it is reset for every request rather than allocated.
+    """
+    __slots__ = ('action', 'torrent', 'user', 'event', 'swarm', 'result')
+
+    def __init__(self):
+        self.action = Action.INVALID
+        self.torrent = 0
+        self.user = 0
+        self.event = Event.NONE
+        self.swarm = 0
+        self.result = Result.OK
+
+    def reset(self, action):
+        self.action = action
+        self.torrent = 0
+        self.user = 0
+        self.event = Event.NONE
+        self.swarm = 0
+        self.result = Result.OK
+
+
 class ErrorCodes(IntEnum):
     DUPE = 0
     TRUMP = 1
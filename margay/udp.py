@@ -0,0 +1,159 @@
+import asyncio
+import hashlib
+import logging
+import os
+import struct
+from time import time
+
+import margay.stats as stats
+
+PROTOCOL_ID = 0x41727101980
+
+CONNECT = 0
+ANNOUNCE = 1
+SCRAPE = 2
+ERROR = 3
+
+# BEP 41 announce options
+END_OF_OPTIONS = 0
+NOP = 1
+URL_DATA = 2
+
+EVENTS = ('', 'completed', 'started', 'stopped')
+
+HEADER = struct.Struct('!qii')  # connection id, action, transaction id
+CONNECT_RESPONSE = struct.Struct('!iiq')
+ANNOUNCE_REQUEST = struct.Struct('!20s20sqqqiIIiH')
+ANNOUNCE_RESPONSE = struct.Struct('!iiiii')
+SCRAPE_COUNTS = struct.Struct('!iii')
+RESPONSE_HEADER = struct.Struct('!ii')
+
+# how long a connection id stays valid, BEP 15 says a client may use it for a minute
+CONNECTION_ID_LIFETIME = 60
+
+
+class UdpTrackerProtocol(asyncio.DatagramProtocol):
+    """
+    UDP tracker protocol (BEP 15) in front of the same Worker that serves HTTP announces. As
+    UDP has no path, the passkey travels in the BEP 41 URL data option, which clients fill
+    with the path and query of the announce URL (/{passkey}/announce). Connection ids are a
+    keyed hash of the client address and the current minute, so we don't have to remember
+    anything between the connect and the announce.
+    """
+    def __init__(self, worker):
+        self.logger = logging.getLogger()
+        self.worker = worker
+        self.transport = None  # type: asyncio.DatagramTransport
+        self.secret = os.urandom(16)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        stats.bytes_read += len(data)
+        if len(data) < HEADER.size:
+            return
+        connection_id, action, transaction_id = HEADER.unpack_from(data)
+        try:
+            if action == CONNECT:
+                if connection_id != PROTOCOL_ID:
+                    return
+                response = CONNECT_RESPONSE.pack(CONNECT, transaction_id,
+                                                 self.connection_id(addr, int(time())))
+            elif not self.valid_connection_id(connection_id, addr):
+                response = self.error(transaction_id, 'Connection ID expired')
+            elif action == ANNOUNCE:
+                response = self.announce(data, transaction_id, addr)
+            elif action == SCRAPE:
+                response = self.scrape(data, transaction_id)
+            else:
+                response = self.error(transaction_id, 'Invalid action')
+        except Exception:
+            self.logger.exception('Error handling UDP request')
+            response = self.error(transaction_id, 'Internal error')
+        stats.bytes_written += len(response)
+        self.transport.sendto(response, addr)
+
+    def connection_id(self, addr, now: int) -> int:
+        bucket = now // CONNECTION_ID_LIFETIME
+        digest = hashlib.blake2b(f'{addr[0]}:{addr[1]}:{bucket}'.encode(), digest_size=8,
+                                 key=self.secret).digest()
+        return int.from_bytes(digest, 'big', signed=True)
+
+    def valid_connection_id(self, connection_id, addr) -> bool:
+        now = int(time())
+        return connection_id == self.connection_id(addr, now) or \
+            connection_id == self.connection_id(addr, now - CONNECTION_ID_LIFETIME)
+
+    # noinspection PyMethodMayBeStatic
+    def error(self, transaction_id, message) -> bytes:
+        return RESPONSE_HEADER.pack(ERROR, transaction_id) + message.encode('utf-8')
+
+    def announce(self, data, transaction_id, addr) -> bytes:
+        if len(data) < HEADER.size + ANNOUNCE_REQUEST.size:
+            return self.error(transaction_id, 'Malformed announce')
+        info_hash, peer_id, downloaded, left, uploaded, event, _, _, numwant, port = \
+            ANNOUNCE_REQUEST.unpack_from(data, HEADER.size)
+        if event >= len(EVENTS):
+            return self.error(transaction_id, 'Invalid event')
+        path = self.url_data(data, HEADER.size + ANNOUNCE_REQUEST.size)
+        parts = path.partition('?')[0].split('/')
+        if len(parts) < 2 or parts[1] == '':
+            return self.error(transaction_id, 'Passkey not found')
+
+        params = {
+            'info_hash': info_hash.decode('latin-1'),
+            'peer_id': peer_id.decode('latin-1'),
+            'port': port,
+            'uploaded': uploaded,
+            'downloaded': downloaded,
+            'left': left,
+            'event': EVENTS[event],
+            'compact': '1'
+        }
+        if numwant >= 0:
+            params['numwant'] = numwant
+        # We never trust the IP field, unlike an HTTP request there is no proxy in between
+        response = self.worker.udp_announce(parts[1], params, addr[0])
+        if 'failure reason' in response:
+            return self.error(transaction_id, response['failure reason'])
+        return ANNOUNCE_RESPONSE.pack(ANNOUNCE, transaction_id, response['interval'],
+                                      response['incomplete'], response['complete']) + \
+            response['peers']
+
+    # noinspection PyMethodMayBeStatic
+    def url_data(self, data, offset) -> str:
+        """
+        :return: the concatenated URL data options of a BEP 41 announce
+        """
+        path = b''
+        while offset < len(data):
+            option = data[offset]
+            if option == END_OF_OPTIONS:
+                break
+            elif option == NOP:
+                offset += 1
+            elif option == URL_DATA and offset + 1 < len(data):
+                length = data[offset + 1]
+                path += data[offset + 2:offset + 2 + length]
+                offset += 2 + length
+            else:
+                break
+        return path.decode('latin-1')
+
+    def scrape(self, data, transaction_id) -> bytes:
+        info_hashes = [data[i:i + 20].decode('latin-1')
+                       for i in range(HEADER.size, len(data) - 19, 20)]
+        result = self.worker.udp_scrape(info_hashes)
+        if 'failure reason' in result:
+            return self.error(transaction_id, result['failure reason'])
+        files = result['files']
+        response = RESPONSE_HEADER.pack(SCRAPE, transaction_id)
+        for info_hash in info_hashes:
+            counts = files.get(info_hash)
+            if counts is None:
+                response += SCRAPE_COUNTS.pack(0, 0, 0)
+            else:
+                response += SCRAPE_COUNTS.pack(counts['complete'], counts['downloaded'],
+                                               counts['incomplete'])
+        return response
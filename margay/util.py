@@ -1,4 +1,6 @@
 import binascii
+from typing import Dict, List
+from urllib.parse import unquote_to_bytes
 
 
 def hex_decode(inp: str) -> str:
@@ -34,6 +36,30 @@ def hex_decode(inp: str) -> str:
     return out
 
 
+def _unquote(value: str) -> str:
+    # info hashes and peer ids are arbitrary bytes, latin-1 maps each of them to exactly one
+    # character so they survive decoding untouched and are always 20 characters long
+    return unquote_to_bytes(value).decode('latin-1')
+
+
+def parse_query(query: str) -> Dict[str, str]:
+    """
+    Parse a raw query string in a single pass. Only the first value of a repeated key is kept,
+    use query_values for those.
+    """
+    params = dict()
+    for pair in query.split('&'):
+        key, _, value = pair.partition('=')
+        if key not in params:
+            params[key] = _unquote(value) if '%' in value else value
+    return params
+
+
+def query_values(query: str, key: str) -> List[str]:
+    prefix = key + '='
+    return [_unquote(pair[len(prefix):]) for pair in query.split('&') if pair.startswith(prefix)]
+
+
 if __name__ == '__main__':
     #a = 'A959693FCAC904B7247537B3327740BFCEAF7851'
     #b = b'0xA959693FCAC904B7247537B3327740BFCEAF7851'
@@ -0,0 +1,110 @@
+import logging
+import sys
+import threading
+from time import perf_counter, sleep, time
+import traceback
+
+import margay.stats as stats
+
+# Upper bounds (in milliseconds) of the buckets of stats.loop_lag_histogram, the last bucket
+# counts everything above the largest bound
+LAG_BUCKETS = (1, 5, 10, 50, 100, 250, 500, 1000, 5000)
+
+
+class Watchdog(object):
+    """
+    Measures how long the event loop takes to get to a callback from another thread, every
+    interval milliseconds. When the loop hasn't gotten to it after threshold milliseconds,
+    something is running on it synchronously, so the watchdog grabs the loop thread's stack
+    right then, together with the request context, and logs it. Stalls are logged at most once
+    every log_interval seconds, the ones in between are only counted.
+    """
+    def __init__(self, worker, config):
+        self.logger = logging.getLogger()
+        self.worker = worker
+        self.loop = None
+        self.loop_thread = None
+        self.running = False
+        self.pong = threading.Event()
+        self.lag = 0.0
+
+        watchdog = config['watchdog']
+        self.interval = max(1, watchdog['interval']) / 1000
+        self.threshold = max(1, watchdog['threshold']) / 1000
+        self.log_interval = watchdog['log_interval']
+
+        self.last_logged = 0.0
+        self.suppressed = 0
+        self.last_stall = ''
+
+    def start(self, loop):
+        """
+        Has to be called from the loop's thread
+        """
+        if self.running:
+            return
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+        self.running = True
+        threading.Thread(target=self._watch, name='watchdog', daemon=True).start()
+
+    def stop(self):
+        self.running = False
+
+    def _watch(self):
+        while self.running:
+            self.pong.clear()
+            sent = perf_counter()
+            try:
+                self.loop.call_soon_threadsafe(self._pong, sent)
+            except RuntimeError:
+                # the loop is closed
+                break
+            if not self.pong.wait(self.threshold):
+                self._stalled()
+                while self.running and not self.pong.wait(1):
+                    pass
+            self._record(self.lag)
+            sleep(self.interval)
+
+    def _pong(self, sent):
+        self.lag = perf_counter() - sent
+        self.pong.set()
+
+    def _record(self, lag):
+        milliseconds = lag * 1000
+        for bucket, bound in enumerate(LAG_BUCKETS):
+            if milliseconds <= bound:
+                stats.loop_lag_histogram[bucket] += 1
+                break
+        else:
+            stats.loop_lag_histogram[-1] += 1
+        stats.loop_lag_max = max(stats.loop_lag_max, int(milliseconds))
+
+    def _stalled(self):
+        stats.loop_stalls += 1
+        frame = sys._current_frames().get(self.loop_thread)
+        stack = ''.join(traceback.format_stack(frame)) if frame is not None else ''
+        context = self.worker.context
+        self.last_stall = f"stalled for over {self.threshold * 1000:.0f}ms at {int(time())} " \
+                          f"handling {context.action.name} of torrent {context.torrent} " \
+                          f"({context.swarm} peers) for user {context.user}\n{stack}"
+        now = perf_counter()
+        if now - self.last_logged < self.log_interval:
+            self.suppressed += 1
+            return
+        suppressed = f' ({self.suppressed} more since the last one)' if self.suppressed else ''
+        self.logger.warning(f'Event loop {self.last_stall.rstrip()}{suppressed}')
+        self.last_logged = now
+        self.suppressed = 0
+
+    def report(self) -> str:
+        output = f"{stats.loop_stalls} stalls, longest lag {stats.loop_lag_max}ms\n"
+        lower = 0
+        for bound, count in zip(LAG_BUCKETS, stats.loop_lag_histogram):
+            output += f"{lower}-{bound}ms: {count}\n"
+            lower = bound
+        output += f">{LAG_BUCKETS[-1]}ms: {stats.loop_lag_histogram[-1]}\n"
+        if self.last_stall != '':
+            output += f"last stall: {self.last_stall}"
+        return output
@@ -1,19 +1,60 @@
+import asyncio
 import ipaddress
 from enum import Enum, auto
 import logging
+import os
 import re
-from time import time
+import socket
+from time import perf_counter, time
 import threading
-from typing import Dict, List
+from typing import Any, Dict, List, Tuple
 
 # noinspection PyPackageRequirements
 import bencode
 from aiohttp import web
 
-from .structs import ErrorCodes, LeechType, Peer, Torrent, User
+from .backpressure import Backpressure
+from .capture import Capture
+from .catalog import TorrentCatalog, UserCatalog
+from .collector import GarbageCollector
+from .export import SwarmExporter
+from .handoff import Takeover, Upgrade
+from .interning import InternTable
+from .logs import summary
+from .memory import MemoryAccounting
+from .mirror import Mirror
+from .protocol import AnnounceProtocol
+from .request_log import RequestLog
+from .schedule import Schedule
+from .smoothing import AnnounceSmoother
+from .spool import Spool
+from .standby import DeltaPublisher, follow
+from .structs import Action, ErrorCodes, Event, LeechType, Peer, RequestContext, Result
+from .udp import UdpTrackerProtocol
+from .watchdog import Watchdog
+from .util import parse_query, query_values
 import margay.stats as stats
 
 REGEX = re.compile(r'info_hash=([%a-zA-Z0-9]+)')
+# Peers the reaper goes through before letting the loop serve requests again
+REAP_CHUNK = 10000
+# Largest port and byte counters a peer can announce, the standby records and the swarm exports
+# pack them as unsigned shorts and signed 64-bit ints
+MAX_PORT = 0xffff
+MAX_COUNTER = 2 ** 63 - 1
+
+ACTIONS = {
+    'announce': Action.ANNOUNCE,
+    'scrape': Action.SCRAPE,
+    'update': Action.UPDATE,
+    'report': Action.REPORT
+}
+
+EVENTS = {
+    'started': Event.STARTED,
+    'completed': Event.COMPLETED,
+    'stopped': Event.STOPPED
+}
 
 
 class Status(Enum):
@@ -23,14 +64,17 @@ class Status(Enum):
 
 
 class Worker(object):
-    def __init__(self, database, site_comm, config):
+    def __init__(self, database, site_comm, config, takeover: Takeover = None):
         self.logger = logging.getLogger()
         self.database = database
         self.site_comm = site_comm
         self.config = config
-        self.torrents = dict()  # type: Dict[str, Torrent]
-        self.users = dict()  # type: Dict[str, User]
+        self.torrents = TorrentCatalog()
+        self.users = UserCatalog()
         self.whitelist = list()  # type: List[str]
+        # whitelist decisions by peer id client prefix, see _whitelist_changed
+        self.whitelisted = dict()  # type: Dict[str, bool]
+        self.client_prefix_length = 0
 
         self.del_reasons = dict()
         self.del_reasons_lock = threading.RLock()
@@ -38,14 +82,46 @@ class Worker(object):
         self.announce_interval = 0
         self.del_reason_lifetime = 0
         self.peers_timeout = 0
+        self.reaping = False
         self.numwant_limit = 0
         self.site_password = ''
         self.report_password = ''
 
         self.status = Status.OPEN
-
-        self.reaper_active = False
-
+        self.loop = None  # type: asyncio.AbstractEventLoop
+        # what we're listening on, by kind (http, unix or udp)
+        self.listeners = []  # type: List[Tuple[str, Any]]
+        self.takeover = takeover
+        self.upgrading = False
+
+        self.backpressure = Backpressure(self.database, self.config)
+        self.backpressure_interval = 1
+        self.smoother = AnnounceSmoother(config)
+        self.memory = MemoryAccounting()
+        self.gc = GarbageCollector(config)
+        self.exporter = None  # type: SwarmExporter
+        if config['export']['enabled']:
+            self.exporter = SwarmExporter(self, config)
+        self.schedule = Schedule(self, self.database, config)
+        self.watchdog = None  # type: Watchdog
+        if config['watchdog']['enabled']:
+            self.watchdog = Watchdog(self, config)
+        self.user_agents = InternTable(config['tracker']['intern_table_size'])
+        self.clients = InternTable(config['tracker']['intern_table_size'])
+        self.context = RequestContext()
+        self.request_log = RequestLog(config['tracker']['request_log_size'])
+        self.capture = None  # type: Capture
+        self.publisher = None  # type: DeltaPublisher
+        self.mirror = None  # type: Mirror
+        if config['mirror']['enabled']:
+            self.mirror = Mirror(config)
+        if config['standby']['publish']:
+            self.publisher = DeltaPublisher(self, config)
+        if config['capture']['enabled']:
+            self.capture = Capture(config['capture']['path'], config['capture']['max_size'])
+
+        if takeover is not None:
+            takeover.restore(self)
         self.load_config(self.config)
         self.reload_lists()
 
@@ -56,9 +132,13 @@ class Worker(object):
         self.numwant_limit = config['tracker']['numwant_limit']
         self.site_password = config['gazelle']['site_password']
         self.report_password = config['gazelle']['report_password']
+        self.backpressure_interval = max(1, config['backpressure']['check_interval'])
 
     def reload_config(self, config):
         self.load_config(config)
+        self.backpressure.reload_config(config)
+        self.smoother.load_config(config)
+        self.gc.reload_config(config)
 
     def shutdown(self):
         if self.status == Status.OPEN:
@@ -71,77 +151,349 @@ class Worker(object):
         else:
             return False
 
+    def upgrade(self):
+        """
+        Hand everything over to a new process, see Upgrade. Can be called from a signal handler.
+        """
+        if self.loop is None or self.upgrading or self.status != Status.OPEN:
+            return
+        self.upgrading = True
+
+        async def run():
+            try:
+                await Upgrade(self, self.config).run()
+            finally:
+                self.upgrading = False
+
+        self.loop.call_soon_threadsafe(self.loop.create_task, run())
+
+    def take_over(self):
+        """
+        Start writing to the database and the spool, which the primary we followed did until it
+        went away
+        """
+        if self.config['debug']['readonly']:
+            return
+        spool = None
+        if self.config['spool']['enabled']:
+            spool = Spool(self.config['spool']['path'], self.config['spool']['max_size'])
+        self.database.promote(spool)
+
+    def stop_serving(self):
+        self.status = Status.PAUSED
+        for _, server in self.listeners:
+            server.close()
+        if self.publisher is not None:
+            # the port is the new process's now, standbys reconnect to it for a new snapshot
+            self.publisher.close()
+
     def reload_lists(self):
         self.status = Status.PAUSED
-        self.torrents = self.database.load_torrents(self.torrents)
-        self.users = self.database.load_users(self.users)
-        self.whitelist = self.database.load_whitelist()
+        self.gc.loading()
+        try:
+            self.torrents = self.database.load_torrents(self.torrents, self.users)
+            self.users = self.database.load_users(self.users)
+            # users that are gone take their peers with them
+            for user in [user for user in self.users.peers if self.users.deleted[user]]:
+                self.evict_peers(user)
+            self.whitelist = self.database.load_whitelist()
+        finally:
+            self.gc.loaded()
+        self._whitelist_changed()
         self.status = Status.OPEN
 
-    def create_server(self, port):
+    def create_app(self):
         app = web.Application()
         app.router.add_get('/', self.handler_null)
         app.router.add_get('/{passkey}/{action}', self.handler_work)
-        self.logger.info(f'======== Running on http://127.0.0.1:{port} ========')
-        web.run_app(app, host='127.0.0.1', print=False, port=port, handle_signals=False)
+        app.on_startup.append(self._start_backpressure)
+        app.on_startup.append(self._start_schedule)
+        app.on_startup.append(self._start_watchdog)
+        return app
 
-    async def handler_null(self):
-        return self.handle_null()
+    def create_server(self, port):
+        internal = self.config['internal']
+        if internal['uvloop']:
+            try:
+                # noinspection PyPackageRequirements
+                import uvloop
+                asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            except ImportError:
+                self.logger.warning('uvloop is not installed, using the default event loop')
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.loop = loop
+
+        # aiohttp enforces the keepalive timeout and read buffer itself for the connections
+        # that are handed to it
+        runner = web.AppRunner(self.create_app(), handle_signals=False, access_log=None,
+                               keepalive_timeout=internal['keepalive_timeout'],
+                               read_bufsize=internal['max_read_buffer'])
+        loop.run_until_complete(runner.setup())
+
+        def factory():
+            return AnnounceProtocol(self, runner.server, self.config)
+
+        udp = self.config['udp']
+        if self.takeover is not None:
+            # the sockets of the process we took over from, which never stopped listening
+            for kind, sock in self.takeover.listeners:
+                if kind == 'http':
+                    server = loop.run_until_complete(loop.create_server(factory, sock=sock))
+                elif kind == 'unix':
+                    server = loop.run_until_complete(loop.create_unix_server(factory, sock=sock))
+                else:
+                    server, _ = loop.run_until_complete(loop.create_datagram_endpoint(
+                        lambda: UdpTrackerProtocol(self), sock=sock))
+                self.listeners.append((kind, server))
+                self.logger.info(f'======== Running on {kind} socket {sock.getsockname()} '
+                                 f'========')
+        else:
+            self.listeners.append(('http', loop.run_until_complete(loop.create_server(
+                factory, internal['listen_host'], port, backlog=internal['max_connections']))))
+            self.logger.info(f'======== Running on http://{internal["listen_host"]}:{port} '
+                             f'========')
+            if internal['listen_path'] != '':
+                if os.path.exists(internal['listen_path']):
+                    os.remove(internal['listen_path'])
+                self.listeners.append(('unix', loop.run_until_complete(loop.create_unix_server(
+                    factory, internal['listen_path'], backlog=internal['max_connections']))))
+                self.logger.info(f'======== Running on unix:{internal["listen_path"]} ========')
+            if udp['enabled']:
+                transport, _ = loop.run_until_complete(loop.create_datagram_endpoint(
+                    lambda: UdpTrackerProtocol(self), (udp['listen_host'], udp['listen_port'])))
+                self.listeners.append(('udp', transport))
+                self.logger.info(f'======== Running on udp://{udp["listen_host"]}:'
+                                 f'{udp["listen_port"]} ========')
+        if self.publisher is not None:
+            self.publisher.start(loop)
+        standby = self.config['standby']
+        if standby['primary_host'] != '':
+            loop.create_task(follow(self, standby['primary_host'], standby['primary_port'],
+                                    standby['retry_interval'], standby['retries']))
+        if self.takeover is not None:
+            self.takeover.ready()
+            self.takeover = None
+        try:
+            loop.run_forever()
+        finally:
+            for _, server in self.listeners:
+                server.close()
+            if self.publisher is not None:
+                self.publisher.close()
+            if self.mirror is not None:
+                loop.run_until_complete(self.mirror.close())
+            if self.watchdog is not None:
+                self.watchdog.stop()
+            if self.capture is not None:
+                self.capture.close()
+            loop.run_until_complete(runner.cleanup())
+
+    def _whitelist_changed(self):
+        """
+        Whitelist entries are peer id prefixes, so whether a client is allowed only depends on
+        the first client_prefix_length characters of its peer id. Those decisions are cached
+        and have to be thrown away whenever the whitelist changes.
+        """
+        with self.database.whitelist_lock:
+            self.client_prefix_length = max((len(client) for client in self.whitelist),
+                                            default=0)
+            self.whitelisted = dict()
+            self.clients.clear()
+
+    async def _start_schedule(self, _):
+        self.schedule.start(asyncio.get_event_loop())
+
+    async def _start_watchdog(self, _):
+        if self.watchdog is not None:
+            self.watchdog.start(asyncio.get_event_loop())
+
+    async def _start_backpressure(self, app):
+        app['backpressure'] = asyncio.ensure_future(self._monitor_backpressure())
+
+    async def _monitor_backpressure(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            expected = loop.time() + self.backpressure_interval
+            await asyncio.sleep(self.backpressure_interval)
+            self.backpressure.update(max(0.0, loop.time() - expected))
+
+    async def handler_null(self, _):
+        return web.Response(body=self.handle_null(), content_type='text/plain')
 
     # noinspection PyMethodMayBeStatic
     def handle_null(self):
-        return web.Response(text='Nothing to see here.')
+        return b'Nothing to see here.'
 
     def error(self, message):
-        response = {'failure reason': message, 'min interval': 5400, 'interval': 5400}
-        return self.response(response)
+        return self.response(self.failure(message))
+
+    def failure(self, message):
+        self.context.result = Result.FAILURE
+        return {'failure reason': message, 'min interval': 5400, 'interval': 5400}
 
     def warning(self, message):
         return self.response({'warning message': message})
 
     async def handler_work(self, request):
-        action = request.match_info.get('action').lower()
-        actions = ['announce', 'scrape', 'update', 'report']
-        if action not in actions:
-            return web.Response(text='Invalid action.')
-        if len(request.query) == 0:
+        body = self.work(request.match_info.get('passkey'), request.match_info.get('action'),
+                         request.rel_url.raw_query_string, request.headers, request.remote)
+        return web.Response(body=body, content_type='text/plain')
+
+    def work(self, passkey, action, query_string, headers, remote_ip=''):
+        """
+        Handle a request independently of the web server it came in through
+
+        :param passkey: first component of the path
+        :param action: second component of the path
+        :param query_string: the raw, still percent encoded query string
+        :param headers: request headers, looked up by their lowercase names
+        :param remote_ip: address of whoever connected to us, used without X-Forwarded-For
+        :return: the response body
+        """
+        name = action
+        action = ACTIONS.get(action.lower(), Action.INVALID)
+        if self.capture is not None and (action == Action.ANNOUNCE or action == Action.SCRAPE):
+            self.capture.record(time(), action, passkey, query_string, headers, remote_ip)
+        if self.mirror is not None and (action == Action.ANNOUNCE or action == Action.SCRAPE) \
+                and self.mirror.sampled():
+            start = perf_counter()
+            body = self._handle(action, self._work, passkey, query_string, headers, remote_ip)
+            self.mirror.submit(passkey, name, query_string, headers, remote_ip, body,
+                               perf_counter() - start)
+            return body
+        return self._handle(action, self._work, passkey, query_string, headers, remote_ip)
+
+    def udp_announce(self, passkey, params, remote_ip):
+        """
+        Announce that came in through the UDP tracker, see work
+
+        :return: the response as a dict
+        """
+        return self._handle(Action.ANNOUNCE, self._udp_announce, passkey, params, remote_ip)
+
+    def udp_scrape(self, info_hashes):
+        """
+        Scrape that came in through the UDP tracker, see work
+
+        :return: the counts like scrape under files, or a failure reason
+        """
+        return self._handle(Action.SCRAPE, self._udp_scrape, info_hashes)
+
+    def _handle(self, action, handler, *args):
+        """
+        Run handler with the request context set up and log the request once it's done
+        """
+        start = perf_counter()
+        timestamp = time()
+        context = self.context
+        context.reset(action)
+        try:
+            return handler(*args)
+        except Exception:
+            context.result = Result.ERROR
+            raise
+        finally:
+            self.request_log.record(timestamp, context, int((perf_counter() - start) * 1000000))
+
+    def _udp_announce(self, passkey, params, remote_ip):
+        stats.requests += 1
+        if self.status != Status.OPEN:
+            return self.failure('The tracker is temporarily unavailable.')
+        with self.database.user_list_lock:
+            user = self.users.get(passkey)
+        if user is None:
+            return self.failure('Passkey not found')
+        self.context.user = self.users.ids[user]
+        stats.announcements += 1
+        return self.announce(params, {}, remote_ip, user)
+
+    def _udp_scrape(self, info_hashes):
+        stats.requests += 1
+        if self.status != Status.OPEN:
+            return self.failure('The tracker is temporarily unavailable.')
+        stats.scrapes += 1
+        return {'files': self.scrape(info_hashes)}
+
+    def _work(self, passkey, query_string, headers, remote_ip):
+        action = self.context.action
+        stats.requests += 1
+        if action == Action.INVALID:
+            self.context.result = Result.INVALID
+            return b'Invalid action.'
+        if query_string == '':
+            self.context.result = Result.INVALID
             return self.handle_null()
 
         if self.status != Status.OPEN:
             return self.error('The tracker is temporarily unavailable.')
 
-        passkey = request.match_info.get('passkey')
-        if action == 'update' or action == 'report':
+        if action == Action.UPDATE or action == Action.REPORT:
             if passkey != self.site_password:
                 return self.error('Authentication failure.')
 
-        if action == 'update':
-            return self.handle_update(request)
-        elif action == 'report':
-            return self.handle_report(request)
+        if action == Action.UPDATE:
+            if self.publisher is not None and len(self.publisher.subscribers) > 0:
+                # the standbys catching up is no reason to fail the site's request
+                try:
+                    self.publisher.update(query_string)
+                except Exception:
+                    self.logger.exception('Publishing an update to the standbys failed')
+            return self.handle_update(parse_query(query_string))
+        elif action == Action.REPORT:
+            return self.handle_report(parse_query(query_string))
 
         with self.database.user_list_lock:
-            if passkey not in self.users:
-                return self.error('Passkey not found')
-            user = self.users[passkey]
-
-        if action == 'announce':
-            return self.handle_announce(request, user)
-        elif action == 'scrape':
-            return self.handle_scrape(request)
-
-    def handle_announce(self, request, user):
-        params = request.query
+            user = self.users.get(passkey)
+        if user is None:
+            return self.error('Passkey not found')
+        self.context.user = self.users.ids[user]
+
+        if action == Action.ANNOUNCE:
+            stats.announcements += 1
+            return self.handle_announce(parse_query(query_string), headers, remote_ip, user)
+        elif action == Action.SCRAPE:
+            stats.scrapes += 1
+            return self.handle_scrape(query_values(query_string, 'info_hash'))
+
+    def handle_announce(self, params, headers, remote_ip, user):
+        return self.response(self.announce(params, headers, remote_ip, user))
+
+    def announce(self, params, headers, remote_ip, user):
+        """
+        :param user: row of the announcing user in the user catalog
+        :return: the response as a dict, either the announce itself or a failure reason
+        """
+        users = self.users
+        # the peer lists are filtered on this for every candidate
+        user_ids = users.ids
+        uid = user_ids[user]
+        leech = users.leech[user]
+        protect = users.protect[user]
+        info_hash = params.get('info_hash')
         with self.database.torrent_list_lock:
-            tor = self.torrents[params['info_hash']]  # type: Torrent
+            tor = self.torrents.swarm(info_hash)
+        if tor is None:
+            return self.failure('Unregistered torrent')
+        self.context.torrent = tor.id
+        self.context.swarm = len(tor.seeders) + len(tor.leechers)
         cur_time = int(time())
-        if params['compact'] != '1':
-            return self.error('Your client does not support compact announces')
+        if params.get('compact') != '1':
+            return self.failure('Your client does not support compact announces')
 
         left = max(0, int(params['left']))
         uploaded = max(0, int(params['uploaded']))
         downloaded = max(0, int(params['downloaded']))
-        corrupt = max(0, int(params['corrupt']))
+        corrupt = max(0, int(params.get('corrupt', 0)))
+        port = int(params['port'])
+        # checked before the swarm is touched, a peer that can't be packed would fail the
+        # announce halfway
+        if not 0 <= port <= MAX_PORT:
+            return self.failure('Invalid port')
+        if max(left, uploaded, downloaded, corrupt) > MAX_COUNTER:
+            return self.failure('Invalid transfer counts')
+        event = params.get('event', '')
+        self.context.event = EVENTS.get(event, Event.NONE)
 
         snatched = 0
         active = 1
@@ -155,25 +507,30 @@ class Worker(object):
         inc_l = inc_s = dec_l = dec_s = False
 
         if 'peer_id' not in params:
-            return self.error('No peer ID')
+            return self.failure('No peer ID')
         elif len(params['peer_id']) != 20:
-            return self.error('Invalid peer ID')
-
-        with self.database.whitelist_lock:
-            if len(self.whitelist) > 0:
-                found = False
-                for client in self.whitelist:
-                    if params['peer_id'].startswith(client):
-                        found = True
-
-                if not found:
-                    return self.error('Your client is not on the whitelist')
-
-        peer_key = params['peer_id'][12 + (tor.id & 7)] + str(user.id) + params['peer_id']
-
-        if params['event'] == 'completed':
+            return self.failure('Invalid peer ID')
+
+        if self.client_prefix_length > 0:
+            client = self.clients.intern(params['peer_id'][:self.client_prefix_length])
+            found = self.whitelisted.get(client)
+            if found is None:
+                with self.database.whitelist_lock:
+                    found = False
+                    for whitelisted in self.whitelist:
+                        if client.startswith(whitelisted):
+                            found = True
+                    if len(self.whitelisted) < self.clients.max_size:
+                        self.whitelisted[client] = found
+
+            if not found:
+                return self.failure('Your client is not on the whitelist')
+
+        peer_key = params['peer_id'][12 + (tor.id & 7)] + str(uid) + params['peer_id']
+
+        if event == 'completed':
             completed_torrent = left == 0
-        elif params['event'] == 'stopped':
+        elif event == 'stopped':
             stopped_torrent = True
             peer_changed = True
             update_torrent = True
@@ -198,29 +555,32 @@ class Worker(object):
                 else:
                     peer = tor.seeders[peer_key]
                     completed_torrent = False
-            elif peer_key in tor.seeders:
+            else:
                 peer = tor.leechers[peer_key]
-                dec_s = True
         else:
             if peer_key not in tor.seeders:
                 if peer_key not in tor.leechers:
                     peer = Peer()
                     tor.seeders[peer_key] = peer
                     inserted = True
+                    inc_s = True
                 else:
                     peer = tor.leechers[peer_key]
                     tor.seeders[peer_key] = peer
                     del tor.leechers[peer_key]
                     peer_changed = True
-                    dec_l = True
+                    dec_l = inc_s = True
+            else:
+                peer = tor.seeders[peer_key]
 
         upspeed = 0
         downspeed = 0
 
-        if inserted or params['event'] == 'started':
+        if inserted or event == 'started':
             update_torrent = True
             if inserted:
                 peer.user = user
+                users.add_peer(user, info_hash, peer_key)
             peer.first_announced = cur_time
             peer.last_announced = 0
             peer.uploaded = uploaded
@@ -261,18 +621,18 @@ class Worker(object):
                     upspeed = uploaded_change / (cur_time - peer.last_announced)
                     downspeed = downloaded_change / (cur_time - peer.last_announced)
 
-                tokened = user.id in tor.tokened_users
+                tokened = uid in tor.tokened_users
                 if tor.free_torrent == LeechType.NEUTRAL:
                     downloaded_change = 0
                     uploaded_change = 0
                 elif tor.free_torrent == LeechType.FREE or tokened:
                     if tokened:
                         expire_token = True
-                        self.database.record_token(user.id, tor.id, downloaded_change)
+                        self.database.record_token(uid, tor.id, downloaded_change)
                     downloaded_change = 0
 
                 if uploaded_change or downloaded_change:
-                    self.database.record_user(user.id, uploaded_change, downloaded_change)
+                    self.database.record_user(uid, uploaded_change, downloaded_change)
 
         peer.left = left
 
@@ -280,22 +640,32 @@ class Worker(object):
             ip = params['ip']
         elif 'ipv4' in params:
             ip = params['ipv4']
+        elif 'x-forwarded-for' in headers:
+            ip = headers['x-forwarded-for'].split(',')[0].strip()
         else:
-            ip = request.headers['x-forwarded-for'].split(',')[0]
+            ip = remote_ip
 
-        port = int(params['port'])
+        # Peers keep their IP packed, it's smaller than the string and it's what goes into the
+        # compact peer list anyway
+        try:
+            packed_ip = socket.inet_pton(socket.AF_INET, ip)
+        except OSError:
+            packed_ip = b''
 
-        if inserted or port != peer.port or ip != peer.ip:
-            peer.ip = ip
+        if inserted or port != peer.port or packed_ip != peer.ip:
+            peer.ip = packed_ip
             peer.port = port
-            parsed = ipaddress.ip_address(ip)
-            if parsed.is_private or parsed.is_unspecified or parsed.is_reserved or parsed.is_loopback:
+            if len(packed_ip) != 4:
                 invalid_ip = True
+            else:
+                parsed = ipaddress.IPv4Address(packed_ip)
+                if parsed.is_private or parsed.is_unspecified or parsed.is_reserved or \
+                        parsed.is_loopback:
+                    invalid_ip = True
             if not invalid_ip:
-                peer.ip_port = parsed.packed + port.to_bytes(length=2, byteorder='big')
-            if len(peer.ip_port) != 6:
-                peer.ip_port = ''
-                invalid_ip = True
+                peer.ip_port = packed_ip + port.to_bytes(length=2, byteorder='big')
+            else:
+                peer.ip_port = b''
             peer.invalid_ip = invalid_ip
         else:
             invalid_ip = peer.invalid_ip
@@ -304,22 +674,25 @@ class Worker(object):
 
         # Peer is visible in the lists if they have their leech priviledges and they're not
         # using an invalid IP address
-        peer.visible = (peer.left == 0 or user.leech) and not peer.invalid_ip
+        peer.visible = (peer.left == 0 or leech) and not peer.invalid_ip
 
         if peer_changed:
-            record_ip = '' if user.protect else ip
-            self.database.record_peer_heavy(user.id, tor.id, active, uploaded, downloaded,
+            record_ip = b'' if protect else peer.ip
+            self.database.record_peer_heavy(uid, tor.id, active, uploaded, downloaded,
                                             upspeed, downspeed, left, corrupt,
                                             (cur_time - peer.first_announced), peer.announces,
                                             record_ip, params['peer_id'],
-                                            request.headers['user-agent'])
+                                            self.user_agents.intern(headers.get('user-agent', '')))
+        elif self.backpressure.shed_light:
+            stats.light_peers_shed += 1
         else:
-            self.database.record_peer_light(user.id, tor.id, (cur_time - peer.first_announced),
+            self.database.record_peer_light(uid, tor.id, (cur_time - peer.first_announced),
                                             peer.announces, params['peer_id'])
 
         numwant = self.numwant_limit
         if 'numwant' in params:
-            numwant = min(params['numwant'], numwant)
+            numwant = min(int(params['numwant']), numwant)
+        numwant = self.backpressure.numwant(numwant)
 
         if stopped_torrent:
             numwant = 0
@@ -332,8 +705,8 @@ class Worker(object):
             update_torrent = True
             tor.completed += 1
 
-            record_ip = '' if user.protect else ip
-            self.database.record_snatch(user.id, tor.id, cur_time, record_ip)
+            record_ip = b'' if protect else peer.ip
+            self.database.record_snatch(uid, tor.id, cur_time, record_ip)
 
             if not inserted:
                 tor.seeders[peer_key] = peer
@@ -341,9 +714,9 @@ class Worker(object):
                 dec_l = inc_s = True
 
             if expire_token:
-                self.site_comm.expire_token(tor.id, user.id)
-                tor.tokened_users.remove(user.id)
-        elif not user.leech and left > 0:
+                self.site_comm.expire_token(tor.id, uid)
+                tor.tokened_users.remove(uid)
+        elif not leech and left > 0:
             numwant = 0
 
         peers = b''
@@ -377,16 +750,19 @@ class Worker(object):
                             i = 0
                         seeder = tor.seeders[seeders_list[i]]
                         # Don't show users to themselves or leech disabled users
-                        if seeder.user.deleted or seeder.user.id == user.id or not seeder.visible:
+                        if user_ids[seeder.user] == uid or not seeder.visible:
                             i += 1
                             continue
                         found_peers += 1
                         peers += seeder.ip_port
+                        tor.last_selected_seeder = seeders_list[i]
+                        i += 1
 
                 if found_peers < numwant and len(tor.leechers) > 1:
                     for key in tor.leechers:
                         leecher = tor.leechers[key]
-                        if leecher.user.deleted or leecher.ip_port == peer.ip_port or leecher.user.id == user.id or not leecher.visible:
+                        if leecher.ip_port == peer.ip_port or user_ids[leecher.user] == uid or \
+                                not leecher.visible:
                             continue
                         found_peers += 1
                         peers += leecher.ip_port
@@ -395,7 +771,7 @@ class Worker(object):
             elif len(tor.leechers) > 0:
                 for key in tor.leechers:
                     leecher = tor.leechers[key]
-                    if leecher.user.id == user.id or not leecher.visible:
+                    if user_ids[leecher.user] == uid or not leecher.visible:
                         continue
                     found_peers += 1
                     peers += leecher.ip_port
@@ -406,26 +782,28 @@ class Worker(object):
         stats.succ_announcements += 1
         if dec_l or dec_s or inc_l or inc_s:
             if inc_l:
-                peer.user.leeching += 1
+                users.leeching[peer.user] += 1
                 stats.leechers += 1
             if inc_s:
-                peer.user.seeding += 1
+                users.seeding[peer.user] += 1
                 stats.seeders += 1
             if dec_l:
-                peer.user.leeching -= 1
+                users.leeching[peer.user] -= 1
                 stats.leechers -= 1
             if dec_s:
-                peer.user.seeding -= 1
+                users.seeding[peer.user] -= 1
                 stats.seeders -= 1
 
         if peer.user != user:
             if not stopped_torrent:
                 if left > 0:
-                    user.leeching += 1
-                    peer.user.leeching -= 1
+                    users.leeching[user] += 1
+                    users.leeching[peer.user] -= 1
                 else:
-                    user.seeding += 1
-                    peer.user.seeding -= 1
+                    users.seeding[user] += 1
+                    users.seeding[peer.user] -= 1
+            users.remove_peer(peer.user, info_hash, peer_key)
+            users.add_peer(user, info_hash, peer_key)
             peer.user = user
 
         if stopped_torrent:
@@ -433,6 +811,14 @@ class Worker(object):
                 del tor.leechers[peer_key]
             else:
                 del tor.seeders[peer_key]
+            users.remove_peer(user, info_hash, peer_key)
+
+        publisher = self.publisher
+        if publisher is not None and len(publisher.subscribers) > 0:
+            if stopped_torrent:
+                publisher.remove(info_hash, peer_key)
+            else:
+                publisher.put(info_hash, peer_key, peer, left == 0, uid, tor)
 
         if update_torrent or tor.last_flushed + 3600 < cur_time:
             tor.last_flushed = cur_time
@@ -440,14 +826,22 @@ class Worker(object):
             self.database.record_torrent(tor.id, len(tor.seeders), len(tor.leechers), snatched,
                                          tor.balance)
 
-        if not user.leech and left > 0:
-            return self.error('Access denied, leeching forbidden')
+        if not leech and left > 0:
+            return self.failure('Access denied, leeching forbidden')
+
+        if self.smoother.enabled and not stopped_torrent:
+            interval = self.smoother.interval(
+                peer_key, self.backpressure.interval(self.announce_interval), cur_time)
+        else:
+            # ensure a more even distribution of announces/second
+            interval = self.backpressure.interval(self.announce_interval +
+                                                  min(600, len(tor.seeders)))
 
         response = {
             'complete': len(tor.seeders),
             'downloaded': tor.completed,
             'incomplete': len(tor.leechers),
-            'interval': self.announce_interval + min(600, len(tor.seeders)),  # ensure a more even distribution of announces/second
+            'interval': interval,
             'min interval': self.announce_interval,
             'peers': peers
         }
@@ -456,51 +850,66 @@ class Worker(object):
             response['warning message'] = 'Illegal character found in IP address. IPv6 is not ' \
                                           'supported'
 
-        return web.Response(text=bencode.encode(response))
-
-    def handle_scrape(self, request):
-        response = {'files': {}}
-        for infohash in request.query['info_hash']:
-            if infohash not in self.torrents:
-                continue
-            t = self.torrents[infohash]
-            response['files'][infohash] = {
-                'complete': len(t.seeders),
-                'incomplete': len(t.leechers),
-                'downloaded': t.completed
-            }
-        return web.Response(text=bencode.encode(response))
-
-    def handle_update(self, request):
-        params = request.query
+        return response
+
+    def handle_scrape(self, info_hashes):
+        files = dict()
+        for info_hash, counts in self.scrape(info_hashes).items():
+            # bencode keys are byte strings, info hashes are kept as latin-1 so this is exact
+            files[info_hash.encode('latin-1')] = counts
+        return self.response({'files': files})
+
+    def scrape(self, info_hashes):
+        """
+        :return: the counts of every known torrent by info hash
+        """
+        files = dict()
+        with self.database.torrent_list_lock:
+            for info_hash in info_hashes:
+                if info_hash not in self.torrents:
+                    continue
+                seeders, leechers, completed = self.torrents.counts(info_hash)
+                files[info_hash] = {
+                    'complete': seeders,
+                    'incomplete': leechers,
+                    'downloaded': completed
+                }
+        return files
+
+    def apply_update(self, query_string):
+        """
+        Apply an update that was sent to the primary we're the standby of
+        """
+        self.handle_update(parse_query(query_string))
+
+    def handle_update(self, params):
         if params['action'] == 'change_passkey':
             oldpasskey = params['oldpasskey']
             newpasskey = params['newpasskey']
             with self.database.user_list_lock:
-                if oldpasskey not in self.users:
-                    self.logger.warning(f'No user with passkey {oldpasskey} exists when '
-                                        f'attempting to change passkey to {newpasskey}')
+                if newpasskey in self.users:
+                    summary.warning('Refused {:,} passkey changes to a passkey that is taken',
+                                    f'{oldpasskey} to {newpasskey}')
                 else:
-                    self.users[newpasskey] = self.users[oldpasskey]
-                    del self.users[oldpasskey]
-                    self.logger.info(f'Changed passkey from {oldpasskey} to {newpasskey} for '
-                                     f'user {self.users[newpasskey].id}')
+                    user = self.users.rename(oldpasskey, newpasskey)
+                    if user is None:
+                        summary.warning('{:,} passkey changes for unknown users',
+                                        f'{oldpasskey} to {newpasskey}')
+                    else:
+                        summary.info('Changed {:,} passkeys', f'{oldpasskey} to {newpasskey} '
+                                                              f'for user {self.users.ids[user]}')
         elif params['action'] == 'add_torrent':
             info_hash = params['info_hash']
+            if params['freetorrent'] == '0':
+                fl = LeechType.NORMAL
+            elif params['freetorrent'] == '1':
+                fl = LeechType.FREE
+            else:
+                fl = LeechType.NEUTRAL
             with self.database.torrent_list_lock:
-                if info_hash not in self.torrents:
-                    torrent = Torrent(params['id'], 0)
-                else:
-                    torrent = self.torrents[info_hash]
-                if params['freetorrent'] == '0':
-                    torrent.free_torrent = LeechType.NORMAL
-                elif params['freetorrent'] == '1':
-                    torrent.free_torrent = LeechType.FREE
-                else:
-                    torrent.free_torrent = LeechType.NEUTRAL
-                self.torrents[info_hash] = torrent
-                self.logger.info(f"Added torrent {torrent.id}. FL: {torrent.free_torrent} "
-                                 f"{params['freetorrent']}")
+                self.torrents.add(info_hash, int(params['id']), fl)
+                summary.info('Added {:,} torrents', f"{self.torrents.id(info_hash)} with FL {fl} "
+                                                    f"{params['freetorrent']}")
         elif params['action'] == 'update_torrent':
             info_hash = params['info_hash']
             if params['freetorrent'] == '0':
@@ -511,10 +920,12 @@ class Worker(object):
                 fl = LeechType.NEUTRAL
             with self.database.torrent_list_lock:
                 if info_hash in self.torrents:
-                    self.torrents[info_hash].free_torrent = fl
-                    self.logger.info(f'Updated torrent {self.torrents[info_hash].id} to FL {fl}')
+                    self.torrents.set_free_torrent(info_hash, fl)
+                    summary.info('Updated FL of {:,} torrents',
+                                 f'{self.torrents.id(info_hash)} to {fl}')
                 else:
-                    self.logger.warning(f'Failed to find torrent {info_hash} to FL {fl}')
+                    summary.warning('Failed to find {:,} torrents to update FL of',
+                                    f'{info_hash} to {fl}')
         elif params['action'] == 'update_torrents':
             # Each decoded infohash is exactly 20 characters long
             # TODO: this probably doesn't work and needs more work
@@ -527,96 +938,115 @@ class Worker(object):
                 fl = LeechType.NEUTRAL
             with self.database.torrent_list_lock:
                 pos = 0
+                updated = 0
                 while pos < len(info_hashes):
                     info_hash = info_hashes[pos:pos+20]
                     if info_hash in self.torrents:
-                        self.torrents[info_hash].free_torrent = fl
-                        self.logger.info(f'Updated torrent {self.torrents[info_hash].id} '
-                                         f'to FL {fl}')
+                        self.torrents.set_free_torrent(info_hash, fl)
+                        updated += 1
                     else:
-                        self.logger.warning(f'Failed to find torrent {info_hash} to FL {fl}')
+                        summary.warning('Failed to find {:,} torrents to update FL of',
+                                        f'{info_hash} to {fl}')
+                    pos += 20
+                summary.info('Updated FL of {:,} torrents', f'{updated} of them to {fl}', updated)
         elif params['action'] == 'add_token':
             info_hash = params['info_hash']
             userid = int(params['userid'])
             with self.database.torrent_list_lock:
                 if info_hash in self.torrents:
-                    self.torrents[info_hash].tokened_users.remove(userid)
+                    self.torrents.add_token(info_hash, userid)
                 else:
-                    self.logger.warning(f'Failed to find torrent to add a token for user {userid}')
+                    summary.warning('Failed to find {:,} torrents to add a token to',
+                                    f'{info_hash} for user {userid}')
         elif params['action'] == 'remove_token':
             info_hash = params['info_hash']
             userid = int(params['userid'])
             with self.database.torrent_list_lock:
                 if info_hash in self.torrents:
-                    self.torrents[info_hash].tokened_users.remove(userid)
+                    self.torrents.remove_token(info_hash, userid)
                 else:
-                    self.logger.warning(f'Failed to find torrent {info_hash} to remove token '
-                                        f'for user {userid}')
+                    summary.warning('Failed to find {:,} torrents to remove a token from',
+                                    f'{info_hash} for user {userid}')
         elif params['action'] == 'delete_torrent':
             info_hash = params['info_hash']
             reason = int(params['reason']) if 'reason' in params else -1
             with self.database.torrent_list_lock:
                 if info_hash in self.torrents:
-                    torrent = self.torrents[info_hash]
-                    self.logger.info(f'Deleting torrent {torrent.id} for the '
-                                     f'reason {ErrorCodes.get_del_reason(reason)}')
-                    stats.leechers -= len(torrent.leechers)
-                    stats.seeders -= len(torrent.seeders)
-                    for peer_key in torrent.leechers:
-                        torrent.leechers[peer_key].user.leeching -= 1
-                    for peer_key in torrent.seeders:
-                        torrent.seeders[peer_key].user.seeding -= 1
+                    summary.info('Deleted {:,} torrents', f'{self.torrents.id(info_hash)} for '
+                                     f'the reason {ErrorCodes.get_del_reason(reason)}')
                     with self.del_reasons_lock:
-                        self.del_reasons[info_hash] = {'reason': reason, time: int(time())}
-                        del self.torrents[info_hash]
+                        self.del_reasons[info_hash] = {'reason': reason, 'time': int(time())}
+                    torrent = self.torrents.remove(info_hash)
+                    if torrent is not None:
+                        stats.leechers -= len(torrent.leechers)
+                        stats.seeders -= len(torrent.seeders)
+                        for peer_key, peer in torrent.leechers.items():
+                            self.users.leeching[peer.user] -= 1
+                            self.users.remove_peer(peer.user, info_hash, peer_key)
+                        for peer_key, peer in torrent.seeders.items():
+                            self.users.seeding[peer.user] -= 1
+                            self.users.remove_peer(peer.user, info_hash, peer_key)
                 else:
-                    self.logger.warning(f'Failed to find torrent {info_hash} to delete')
+                    summary.warning('Failed to find {:,} torrents to delete', info_hash)
         elif params['action'] == 'add_user':
             passkey = params['passkey']
             userid = int(params['id'])
             with self.database.user_list_lock:
-                if passkey not in self.users:
-                    self.users[passkey] = User(userid, True, params['visible'] == '0')
-                    self.logger.info(f'Added user {passkey} with id {userid}')
+                user = self.users.get(passkey)
+                if user is None:
+                    self.users.add(passkey, userid, True, params['visible'] == '0')
+                    summary.info('Added {:,} users', f'{passkey} with id {userid}')
                 else:
-                    self.logger.warning(f'Tried to add already known user {passkey} '
-                                        f'with id {self.users[passkey].id}')
-                    self.users[passkey].deleted = True
+                    # like Ocelot, the known user is kept as it is
+                    summary.warning('Tried to add {:,} already known users',
+                                    f'{passkey} with id {self.users.ids[user]}')
         elif params['action'] == 'remove_user':
             passkey = params['passkey']
             with self.database.user_list_lock:
-                if passkey in self.users:
-                    self.logger.info(f'Removed user {passkey} with id {self.users[passkey].id}')
-                    self.users[passkey].deleted = True
-                    del self.users[passkey]
+                user = self.users.remove(passkey)
+                if user is not None:
+                    evicted = self.evict_peers(user)
+                    summary.info('Removed {:,} users', f'{passkey} with id {self.users.ids[user]} '
+                                                       f'and {evicted} peers')
         elif params['action'] == 'remove_users':
             # Each passkey is 32 characters long
             passkeys = params['passkeys']
             with self.database.user_list_lock:
                 i = 0
+                removed = 0
+                evicted = 0
                 while i < len(passkeys):
                     passkey = passkeys[i:i+32]
-                    if passkey in self.users:
-                        self.logger.info(f'Removed user {passkey}')
-                        self.users[passkey].deleted = True
-                        del self.users[passkey]
+                    user = self.users.remove(passkey)
+                    if user is not None:
+                        evicted += self.evict_peers(user)
+                        removed += 1
                     i += 32
+                summary.info('Removed {:,} users', f'{removed} of them at once with {evicted} '
+                                                   f'peers', removed)
         elif params['action'] == 'update_user':
             passkey = params['passkey']
             can_leech = False if params['can_leech'] == '0' else True
             protect_ip = True if params['visible'] == '0' else False
             with self.database.user_list_lock:
-                if passkey not in self.users:
-                    self.logger.warning(f'No user with passkey {passkey} found when attempting to '
-                                        f'change leeching status!')
+                user = self.users.get(passkey)
+                if user is None:
+                    summary.warning('{:,} updates of unknown users', passkey)
                 else:
-                    self.users[passkey].protect = protect_ip
-                    self.users[passkey].leech = can_leech
-                    self.logger.info(f'Updated user {passkey}')
+                    self.users.protect[user] = protect_ip
+                    self.users.leech[user] = can_leech
+                    # leechers only show up in peer lists while their user can leech
+                    with self.database.torrent_list_lock:
+                        for info_hash, peer_key in self.users.peers.get(user, ()):
+                            peer = self.torrents.swarms[info_hash].leechers.get(peer_key)
+                            if peer is not None:
+                                peer.visible = can_leech and not peer.invalid_ip
+                    summary.info('Updated {:,} users', passkey)
         elif params['action'] == 'add_whitelist':
             peer_id = params['peer_id']
             with self.database.whitelist_lock:
                 self.whitelist.append(peer_id)
+                self._whitelist_changed()
                 self.logger.info(f'Whitelisted {peer_id}')
         elif params['action'] == 'remove_whitelist':
             peer_id = params['peer_id']
@@ -625,6 +1055,7 @@ class Worker(object):
                     self.whitelist.remove(peer_id)
                 except ValueError:
                     pass
+                self._whitelist_changed()
                 self.logger.info(f'De-whitelisted {peer_id}')
         elif params['action'] == 'edit_whitelist':
             new_peer_id = params['new_peer_id']
@@ -635,6 +1066,7 @@ class Worker(object):
                 except ValueError:
                     pass
                 self.whitelist.append(new_peer_id)
+                self._whitelist_changed()
                 self.logger.info(f'Edited whitelist item from {old_peer_id} to {new_peer_id}')
         elif params['action'] == 'update_announce_interval':
             self.announce_interval = int(params['announce_interval'])
@@ -645,16 +1077,15 @@ class Worker(object):
             self.logger.info(f"Info for torrent '{info_hash}'")
             with self.database.torrent_list_lock:
                 if info_hash in self.torrents:
-                    self.logger.info(f'Torrent {self.torrents[info_hash].id}, '
-                                     f'freetorrent = {self.torrents[info_hash].free_torrent}')
+                    self.logger.info(f'Torrent {self.torrents.id(info_hash)}, '
+                                     f'freetorrent = {self.torrents.free_torrent(info_hash)}')
                 else:
                     self.logger.warning(f'Failed to find torrent {info_hash}')
-                    
-        return web.Response(text='success')
 
-    def handle_report(self, request):
-        params = request.query
-        action = params['get']
+        return b'success'
+
+    def handle_report(self, params):
+        action = params.get('get', '')
         output = ''
         if action == '':
             output += "Invalid action\n"
@@ -669,6 +1100,7 @@ class Worker(object):
             output += f"Uptime {up_d} days, {up_h:02}:{up_m:02}:{up_s:02}\n" \
                       f"{stats.opened_connections} connections opened\n" \
                       f"{stats.open_connections} open connections\n" \
+                      f"{stats.rejected_connections} connections rejected\n" \
                       f"{stats.connection_rate} connections/s\n" \
                       f"{stats.requests} requests handled\n" \
                       f"{stats.request_rate} requests/s\n" \
@@ -678,72 +1110,177 @@ class Worker(object):
                       f"{stats.leechers} leechers tracked\n" \
                       f"{stats.seeders} seeders tracked\n" \
                       f"{stats.bytes_read} bytes read\n" \
-                      f"{stats.bytes_written} bytes written\n"
+                      f"{stats.bytes_written} bytes written\n" \
+                      f"{stats.flush_backlog} rows waiting to be flushed\n" \
+                      f"{stats.loop_lag}ms event loop lag\n" \
+                      f"{stats.loop_stalls} event loop stalls\n" \
+                      f"{stats.log_summarized} log messages summarized\n" \
+                      f"{stats.log_dropped} log records dropped\n" \
+                      f"{stats.backpressure_level} backpressure level\n" \
+                      f"{stats.backpressure_interval_factor} announce interval factor\n" \
+                      f"{stats.backpressure_numwant_factor} numwant factor\n" \
+                      f"{stats.light_peers_shed} light peer updates shed\n" \
+                      f"{stats.gc_collections} garbage collections\n" \
+                      f"{stats.gc_pause_total:.3f}ms spent collecting garbage\n" \
+                      f"{stats.gc_pause_max:.3f}ms longest garbage collection\n" \
+                      f"{stats.replica_reads} loads from the replica\n" \
+                      f"{stats.replica_fallbacks} loads from the primary\n" \
+                      f"{stats.replica_lag}s replica lag\n"
         elif action == 'user':
             key = params['key']
             if len(key) == 0:
                 output += "Invalid action\n"
             else:
                 with self.database.user_list_lock:
-                    if key in self.users:
-                        output += f"{self.users[key].leeching} leeching\n" \
-                                  f"{self.users[key].seeding} seeding\n"
+                    user = self.users.get(key)
+                    if user is not None:
+                        output += f"{self.users.leeching[user]} leeching\n" \
+                                  f"{self.users.seeding[user]} seeding\n"
+        elif action == 'requests':
+            count = int(params['count']) if 'count' in params else None
+            output += f"{self.request_log.recorded} requests logged\n"
+            output += self.request_log.dump(count)
+        elif action == 'schedule':
+            output += self.schedule.report()
+        elif action == 'gc':
+            output += self.gc.report()
+        elif action == 'flush':
+            output += self.database.report()
+        elif action == 'smoothing':
+            output += self.smoother.report()
+        elif action == 'export':
+            if self.exporter is None:
+                output += "swarm export is disabled\n"
+            else:
+                output += self.exporter.report()
+        elif action == 'watchdog':
+            if self.watchdog is None:
+                output += "watchdog is disabled\n"
+            else:
+                output += self.watchdog.report()
+        elif action == 'mirror':
+            if self.mirror is None:
+                output += "not mirroring\n"
+            else:
+                output += self.mirror.report()
+        elif action == 'standby':
+            if self.publisher is None:
+                output += "not publishing\n"
+            else:
+                output += self.publisher.report()
+        elif action == 'memory':
+            total_count = total_bytes = 0
+            for name, count, size in self.memory.structures(self):
+                total_count += count
+                total_bytes += size
+                output += f"{name}: {count} objects, {size} bytes\n"
+            output += f"total: {total_count} objects, {total_bytes} bytes\n"
+            with self.database.torrent_list_lock:
+                swarms = self.memory.largest_swarms(self.torrents.swarms)
+            output += "largest swarms:\n"
+            for tid, seeders, leechers in swarms:
+                output += f"{tid}: {seeders} seeders, {leechers} leechers\n"
+            if 'top' in params:
+                top = self.memory.tracemalloc_top(int(params['top']))
+                if len(top) == 0:
+                    output += "tracemalloc is not tracing\n"
+                else:
+                    output += "top allocations:\n" + "\n".join(top) + "\n"
         else:
             output += "Invalid action\n"
-        return web.Response(text=output)
+        return output.encode('utf-8')
 
     # noinspection PyMethodMayBeStatic
     def response(self, response):
-        return web.Response(text=bencode.bencode(response))
+        return bencode.encode(response)
 
-    def start_reaper(self):
-        if not self.reaper_active:
-            threading.Thread(target=self._do_start_reaper)
+    def evict_peers(self, user) -> int:
+        """
+        Take every peer of a removed user out of their swarms right away, rather than leaving
+        them to the reaper, and hand the user's row back out
 
-    def _do_start_reaper(self):
-        self.reaper_active = True
-        self.reap_peers()
-        self.reap_del_reasons()
-        self.reaper_active = False
+        :return: the number of peers evicted
+        """
+        users = self.users
+        with self.database.torrent_list_lock:
+            peers = users.peers.pop(user, ())
+            for info_hash, peer_key in peers:
+                tor = self.torrents.swarms[info_hash]
+                if tor.leechers.pop(peer_key, None) is not None:
+                    users.leeching[user] -= 1
+                    stats.leechers -= 1
+                elif tor.seeders.pop(peer_key, None) is not None:
+                    users.seeding[user] -= 1
+                    stats.seeders -= 1
+                self.database.record_torrent(tor.id, len(tor.seeders), len(tor.leechers), 0,
+                                             tor.balance)
+            users.release(user)
+        return len(peers)
 
     def reap_peers(self):
+        """
+        Start reaping the peers that haven't announced in peers_timeout seconds, which goes
+        through the swarms about REAP_CHUNK peers at a time so it doesn't hold up requests
+        """
+        if self.reaping:
+            self.logger.warning('Peer reaper is still running, skipped')
+            return
         self.logger.info('Starting peer reaper')
-        cur_time = int(time())
-        reaped_l = reaped_s = 0
-        cleared_torrents = 0
-        for info_hash in self.torrents:
-            reaped_this = False
-            torrent = self.torrents[info_hash]
-            for peer_key in torrent.leechers:
-                if torrent.leechers[peer_key].last_announced + self.peers_timeout < cur_time:
-                    with self.database.torrent_list_lock:
-                        torrent.leechers[peer_key].user.leeching -= 1
+        self.reaping = True
+        # reaped leechers, reaped seeders, cleared torrents and collapsed swarms
+        counts = [0, 0, 0, 0]
+        asyncio.get_event_loop().call_soon(self._reap_chunk, list(self.torrents.swarms), 0,
+                                           int(time()), counts)
+
+    def _reap_chunk(self, info_hashes: List[str], position, cur_time, counts: List[int]):
+        visited = 0
+        with self.database.torrent_list_lock:
+            # only torrents with a swarm can have peers to reap
+            while position < len(info_hashes) and visited < REAP_CHUNK:
+                info_hash = info_hashes[position]
+                position += 1
+                torrent = self.torrents.swarms.get(info_hash)
+                if torrent is None:
+                    continue
+                visited += len(torrent.leechers) + len(torrent.seeders) + 1
+                reaped_l = reaped_s = 0
+                for peer_key, peer in list(torrent.leechers.items()):
+                    if peer.last_announced + self.peers_timeout < cur_time:
+                        self.users.leeching[peer.user] -= 1
+                        self.users.remove_peer(peer.user, info_hash, peer_key)
                         del torrent.leechers[peer_key]
-                        reaped_this = True
                         reaped_l += 1
-            for peer_key in torrent.seeders:
-                if torrent.seeders[peer_key].last_announced + self.peers_timeout < cur_time:
-                    with self.database.torrent_list_lock:
-                        torrent.seeders[peer_key].user.seeding -= 1
+                for peer_key, peer in list(torrent.seeders.items()):
+                    if peer.last_announced + self.peers_timeout < cur_time:
+                        self.users.seeding[peer.user] -= 1
+                        self.users.remove_peer(peer.user, info_hash, peer_key)
                         del torrent.seeders[peer_key]
-                        reaped_this = True
                         reaped_s += 1
-            if reaped_this and len(torrent.seeders) == 0 and len(torrent.leechers) == 0:
-                self.database.record_torrent(torrent.id, 0, 0, 0, torrent.balance)
-                cleared_torrents += 1
-        if reaped_l > 0 or reaped_s > 0:
-            stats.leechers -= reaped_l
-            stats.seeders -= reaped_s
-        self.logger.info(f'Reaped {reaped_l} leechers and {reaped_s} seeders. '
-                         f'Reset {cleared_torrents} torrents')
+                stats.leechers -= reaped_l
+                stats.seeders -= reaped_s
+                counts[0] += reaped_l
+                counts[1] += reaped_s
+                if len(torrent.seeders) == 0 and len(torrent.leechers) == 0:
+                    if reaped_l > 0 or reaped_s > 0:
+                        self.database.record_torrent(torrent.id, 0, 0, 0, torrent.balance)
+                        counts[2] += 1
+                    self.torrents.collapse(info_hash)
+                    counts[3] += 1
+        if position < len(info_hashes):
+            asyncio.get_event_loop().call_soon(self._reap_chunk, info_hashes, position,
+                                               cur_time, counts)
+            return
+        self.reaping = False
+        self.logger.info(f'Reaped {counts[0]} leechers and {counts[1]} seeders. '
+                         f'Reset {counts[2]} torrents, collapsed {counts[3]} idle swarms')
 
     def reap_del_reasons(self):
         self.logger.info('Starting del reason reaper')
         max_time = int(time()) - self.del_reason_lifetime
         reaped = 0
-        for key in self.del_reasons:
-            if self.del_reasons[key]['time'] <= max_time:
-                with self.del_reasons_lock:
+        with self.del_reasons_lock:
+            for key, del_reason in list(self.del_reasons.items()):
+                if del_reason['time'] <= max_time:
                     del self.del_reasons[key]
                     reaped += 1
 
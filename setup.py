@@ -11,11 +11,12 @@ setup(
     classifiers=[
         'Development Status :: 2 - Pre-Alpha',
         'Environment :: Console',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.7',
         'Programming Language :: Cython',
         'Intended Audience :: Developers',
         'License :: OSI Approved :: MIT License'
     ],
+    python_requires='>=3.7',
     install_requires=[
         'aiohttp',
         'bencode.py',